@@ -1,10 +1,18 @@
 import os
 import sys
 import json
-from copy import deepcopy
+from copy import copy
 import numpy as np
+import simnibs
 from simnibs import mesh_io, run_simnibs, sim_struct
-from simnibs.utils import TI_utils as TI
+
+# The shared modules (FEM solution cache, solver pool, TI kernels, leadfield access) are in ../optimizer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'optimizer'))
+import element_locator
+import fem_cache
+import leadfield_access
+import solver_pool
+import ti_engine
 
 ###########################################
 
@@ -25,28 +33,21 @@ from simnibs.utils import TI_utils as TI
 #   - Loads the selected montages from a JSON file located in the ../utils directory relative to the subject directory.
 #   - Runs the simulation for each montage and saves the resulting mesh files.
 #   - Calculates and stores the maximal amplitude of the temporal interference (TI) envelope for multi-polar montages.
+#   - Runs the montages concurrently on a process pool (see optimizer/solver_pool.py), set with the environment variables
+#     TI_MAX_WORKERS (concurrent montages, default 1), TI_SOLVER_THREADS (solver threads per montage) and
+#     TI_SOLVE_MEMORY_GB (memory of one montage solve, caps the concurrent montages to the available memory).
+#   - Reuses the E fields of electrode pairs solved before with the same settings (see optimizer/fem_cache.py), so only
+#     the pairs not in the cache are solved.
+#   - With TI_LEADFIELD=auto (or the path of a leadfield HDF5), builds the pair fields of montages whose electrodes are
+#     on the leadfield cap by superposing leadfield rows instead of solving, if the leadfield was solved with the same
+#     settings (subject mesh, conductivities, EEG cap, electrode geometry, as recorded by optimizer/leadfield.py);
+#     other montages fall back to run_simnibs. The leadfield fields are mapped onto the head mesh of the cached solves
+#     (stored with the solution cache), so these montages are written as TI.msh like the solved ones; until a first
+#     solve has cached the head mesh, or if the leadfield mesh does not cover it, montages are solved.
 
 ###########################################
 
 
-# Get subject ID, simulation type, and montages from command-line arguments
-subject_id = sys.argv[1]
-sim_type = sys.argv[2]  # The anisotropy type
-subject_dir = sys.argv[3]
-simulation_dir = sys.argv[4]
-montage_names = sys.argv[5:]  # The list of montages
-
-# Define the correct path for the JSON file
-utils_dir = os.path.join(subject_dir, '..', 'utils')
-montage_file = os.path.join(utils_dir, 'montage_list.json')
-
-# Load montages from JSON file
-with open(montage_file) as f:
-    all_montages = json.load(f)
-
-# Check and process montages for unipolar montages
-montages = {name: all_montages['uni_polar_montages'].get(name) for name in montage_names}
-
 # Validate montage structure
 def validate_montage(montage, montage_name):
     if not montage or len(montage) < 2 or len(montage[0]) < 2:
@@ -54,26 +55,118 @@ def validate_montage(montage, montage_name):
         return False
     return True
 
-# Base paths
-base_subpath = os.path.join(subject_dir, f"m2m_{subject_id}")
-base_pathfem = os.path.join(simulation_dir, f"sim_{subject_id}", "FEM")
-conductivity_path = base_subpath
-tensor_file = os.path.join(conductivity_path, "DTI_coregT1_tensor.nii.gz")
+# Current of each electrode pair (A), electrode geometry and the head tissues kept in the output mesh
+CURRENT = 0.005
+ELECTRODE = {"shape": "ellipse", "dimensions": [8, 8], "thickness": [4, 4]}
+TAGS_KEEP = np.hstack((np.arange(1, 100), np.arange(1001, 1100)))
+# Precision of the TI kernels (optimizer/ti_engine.py); TI_FLOAT32=1 halves their work memory
+KERNEL_DTYPE = np.float32 if os.getenv("TI_FLOAT32", "0") == "1" else None
 
-# Ensure the base_pathfem directory exists
-if not os.path.exists(base_pathfem):
-    os.makedirs(base_pathfem)
+# Leadfields written by optimizer/leadfield.py
+LEADFIELD_DIRS = ("leadfield_vol_{subject_id}", "leadfield_{subject_id}")
+LEADFIELD_FILENAME = "{subject_id}_leadfield_EGI_template.hdf5"
 
-# Function to run simulations
-def run_simulation(montage_name, montage):
-    if not validate_montage(montage, montage_name):
-        return
+# Simulation settings, set by configure in the main process and in every worker process
+sim_type = None
+base_subpath = None
+base_pathfem = None
+tensor_file = None
+eeg_cap = None
+solution_cache = None
+leadfield = None
+leadfield_head = None
+
+# Function to set the simulation settings from the command-line arguments
+def configure(subject_id, anisotropy_type, subject_dir, simulation_dir):
+    global sim_type, base_subpath, base_pathfem, tensor_file, eeg_cap, solution_cache, leadfield
+    sim_type = anisotropy_type
+    base_subpath = os.path.join(subject_dir, f"m2m_{subject_id}")
+    base_pathfem = os.path.join(simulation_dir, f"sim_{subject_id}", "FEM")
+    conductivity_path = base_subpath
+    tensor_file = os.path.join(conductivity_path, "DTI_coregT1_tensor.nii.gz")
+    eeg_cap = os.path.join(base_subpath, "eeg_positions", "EGI_template.csv")
+    settings = fem_cache.solution_settings(base_subpath, os.path.join(base_subpath, f"{subject_id}.msh"),
+                                           sim_type, tensor_file, eeg_cap, ELECTRODE, simnibs.__version__)
+    solution_cache = fem_cache.PairSolutionCache(base_subpath, settings)
+    leadfield = open_leadfield(subject_id, subject_dir)
+
+# Function to open the leadfield set with TI_LEADFIELD; returns (leadfield, mesh, idx_lf), or None to solve every pair
+def open_leadfield(subject_id, subject_dir):
+    setting = os.getenv("TI_LEADFIELD", "")
+    if not setting or setting == "off":
+        return None
+    if setting == "auto":
+        candidates = [os.path.join(subject_dir, d.format(subject_id=subject_id),
+                                   LEADFIELD_FILENAME.format(subject_id=subject_id)) for d in LEADFIELD_DIRS]
+        leadfield_hdf = next((path for path in candidates if os.path.exists(path)), None)
+    else:
+        leadfield_hdf = setting if os.path.exists(setting) else None
+    if leadfield_hdf is None:
+        print(f"No leadfield found for TI_LEADFIELD={setting}; all montages are solved with run_simnibs.")
+        return None
+    # The leadfield is only used if it was solved with the settings of the simulations
+    expected = dict(solution_cache.settings, conductivities=[c.value for c in sim_struct.TDCSLIST().cond])
+    recorded = leadfield_access.read_settings(leadfield_hdf)
+    if recorded != expected:
+        reason = "has no recorded settings" if recorded is None else "was solved with other settings"
+        print(f"The leadfield {leadfield_hdf} {reason}; all montages are solved with run_simnibs.")
+        return None
+    return leadfield_access.load_leadfield(leadfield_hdf)
+
+# Function to find the leadfield element of each head element (-1 if none); the field of a surface triangle is
+# that of its tetrahedron, as in the meshes written by run_simnibs
+def map_leadfield_elements(head, leadfield_mesh):
+    locator = element_locator.ElementLocator.from_mesh(leadfield_mesh)
+    elements = np.full(head.elm.nr, -1)
+    tetrahedra = np.flatnonzero(head.elm.elm_type == 4)
+    elements[tetrahedra] = locator.match(head.elements_baricenters().value[tetrahedra])
+    triangles = np.flatnonzero(head.elm.elm_type == 2)
+    if len(triangles):
+        th = head.find_corresponding_tetrahedra()
+        elements[triangles] = np.where(th > 0, elements[th - 1], -1)
+    return elements
+
+# Function to get the cached head mesh and the leadfield element of each of its elements; None until a solve has
+# cached the head mesh, or if some head elements are not in the leadfield mesh
+def get_leadfield_head():
+    global leadfield_head
+    head = solution_cache.load_head()
+    if head is None:
+        return None
+    if leadfield_head is None or leadfield_head[0] is not head:
+        _, leadfield_mesh, _ = leadfield
+        elements = solution_cache.load_leadfield_elements(leadfield_mesh.elm.nr)
+        if elements is None:
+            elements = map_leadfield_elements(head, leadfield_mesh)
+            solution_cache.store_leadfield_elements(elements, leadfield_mesh.elm.nr)
+        missing = np.count_nonzero(elements < 0)
+        if missing:
+            print(f"{missing} head elements are not in the leadfield mesh; all montages are solved with run_simnibs.")
+        leadfield_head = (head, elements)
+    return leadfield_head if np.all(leadfield_head[1] >= 0) else None
+
+# Function to build the E fields of electrode pairs on the head mesh from the leadfield; None if an electrode is not
+# on the cap or the leadfield cannot be mapped onto the head mesh
+def leadfield_pair_fields(pairs):
+    if leadfield is None:
+        return None
+    lf, _, idx_lf = leadfield
+    if not all(isinstance(centre, str) and centre in idx_lf for pair in pairs for centre in pair):
+        return None
+    mapped = get_leadfield_head()
+    if mapped is None:
+        return None
+    head, elements = mapped
+    fields = ti_engine.get_pair_fields([(e_plus, e_minus, CURRENT) for e_plus, e_minus in pairs], lf, idx_lf)
+    return head, [field[elements] for field in fields]
 
+# Function to run the FEM solves of electrode pairs; returns the cropped head mesh and the E field of each pair
+def solve_pairs(pathfem, pairs):
     S = sim_struct.SESSION()
     S.subpath = base_subpath
     S.anisotropy_type = sim_type
-    S.pathfem = os.path.join(base_pathfem, f"TI_{montage_name}")
-    S.eeg_cap = os.path.join(base_subpath, "eeg_positions", "EGI_template.csv")
+    S.pathfem = pathfem
+    S.eeg_cap = eeg_cap
     S.map_to_surf = False
     S.map_to_fsavg = False
     S.map_to_vol = False
@@ -84,62 +177,104 @@ def run_simulation(montage_name, montage):
     # Load the conductivity tensors
     S.dti_nii = tensor_file
 
-    # First electrode pair
-    tdcs = S.add_tdcslist()
-    tdcs.anisotropy_type = sim_type  # Set anisotropy_type to the input sim_type
-    tdcs.currents = [0.005, -0.005]
-    
-    electrode = tdcs.add_electrode()
-    electrode.channelnr = 1
-    electrode.centre = montage[0][0]
-    electrode.shape = "ellipse"
-    electrode.dimensions = [8, 8]
-    electrode.thickness = [4, 4]
-
-    electrode = tdcs.add_electrode()
-    electrode.channelnr = 2
-    electrode.centre = montage[0][1]
-    electrode.shape = "ellipse"
-    electrode.dimensions = [8, 8]
-    electrode.thickness = [4, 4]
-
-    # Second electrode pair
-    tdcs_2 = S.add_tdcslist(deepcopy(tdcs))
-    tdcs_2.currents = [0.005, -0.005]
-    tdcs_2.electrode[0].centre = montage[1][0]
-    tdcs_2.electrode[1].centre = montage[1][1]
+    # One tDCS simulation per electrode pair
+    for pair in pairs:
+        tdcs = S.add_tdcslist()
+        tdcs.anisotropy_type = sim_type  # Set anisotropy_type to the input sim_type
+        tdcs.currents = [CURRENT, -CURRENT]
+        for channel, centre in enumerate(pair, start=1):
+            electrode = tdcs.add_electrode()
+            electrode.channelnr = channel
+            electrode.centre = centre
+            electrode.shape = ELECTRODE["shape"]
+            electrode.dimensions = list(ELECTRODE["dimensions"])
+            electrode.thickness = list(ELECTRODE["thickness"])
 
     run_simnibs(S)
 
     subject_identifier = base_subpath.split('_')[-1]
     anisotropy_type = S.anisotropy_type
 
-    m1_file = os.path.join(S.pathfem, f"{subject_identifier}_TDCS_1_{anisotropy_type}.msh")
-    m2_file = os.path.join(S.pathfem, f"{subject_identifier}_TDCS_2_{anisotropy_type}.msh")
+    # The head geometry is reused from the cache or read and cropped once; only the E field is read from the others
+    mesh_files = [os.path.join(S.pathfem, f"{subject_identifier}_TDCS_{i + 1}_{anisotropy_type}.msh")
+                  for i in range(len(pairs))]
+    head, fields = fem_cache.load_pair_solutions(mesh_files, TAGS_KEEP, solution_cache)
+    return head, fields
 
-    m1 = mesh_io.read_msh(m1_file)
-    m2 = mesh_io.read_msh(m2_file)
+# Function to run simulations
+def run_simulation(montage_name, montage):
+    if not validate_montage(montage, montage_name):
+        return montage_name
 
-    tags_keep = np.hstack((np.arange(1, 100), np.arange(1001, 1100)))
-    m1 = m1.crop_mesh(tags=tags_keep)
-    m2 = m2.crop_mesh(tags=tags_keep)
+    pathfem = os.path.join(base_pathfem, f"TI_{montage_name}")
+    pairs = [montage[0], montage[1]]
+    superposed = leadfield_pair_fields(pairs)
+    if superposed is not None:
+        head, (ef1, ef2) = superposed
+        print(f"Montage {montage_name}: electrode pair fields superposed from the leadfield.")
+    else:
+        # Only the electrode pairs not in the solution cache are solved
+        head, (ef1, ef2), n_solved = fem_cache.pair_fields(
+            solution_cache, pairs, CURRENT, lambda missing: solve_pairs(pathfem, missing))
+        if n_solved < 2:
+            print(f"Montage {montage_name}: {2 - n_solved} of 2 electrode pairs reused from the solution cache.")
+    os.makedirs(pathfem, exist_ok=True)
 
-    ef1 = m1.field["E"]
-    ef2 = m2.field["E"]
-    TImax = TI.get_maxTI(ef1.value, ef2.value)
+    TImax = ti_engine.get_maxTI_chunked(ef1, ef2, dtype=KERNEL_DTYPE)
 
-    mout = deepcopy(m1)
+    # The output mesh shares the geometry of the head mesh
+    mout = copy(head)
     mout.elmdata = []
+    mout.nodedata = []
     mout.add_element_field(TImax, "TI_max")
-    mesh_io.write_msh(mout, os.path.join(S.pathfem, "TI.msh"))
+    mesh_io.write_msh(mout, os.path.join(pathfem, "TI.msh"))
 
     v = mout.view(visible_tags=[1002, 1006], visible_fields="TI_max")
-    v.write_opt(os.path.join(S.pathfem, "TI.msh"))
+    v.write_opt(os.path.join(pathfem, "TI.msh"))
+
+    return montage_name
+
+
+def main():
+    # Get subject ID, simulation type, and montages from command-line arguments
+    subject_id = sys.argv[1]
+    anisotropy_type = sys.argv[2]  # The anisotropy type
+    subject_dir = sys.argv[3]
+    simulation_dir = sys.argv[4]
+    montage_names = sys.argv[5:]  # The list of montages
+    settings = (subject_id, anisotropy_type, subject_dir, simulation_dir)
+    configure(*settings)
+
+    # Define the correct path for the JSON file
+    utils_dir = os.path.join(subject_dir, '..', 'utils')
+    montage_file = os.path.join(utils_dir, 'montage_list.json')
+
+    # Load montages from JSON file
+    with open(montage_file) as f:
+        all_montages = json.load(f)
+
+    # Check and process montages for unipolar montages
+    montages = {name: all_montages['uni_polar_montages'].get(name) for name in montage_names}
+
+    # Ensure the base_pathfem directory exists
+    if not os.path.exists(base_pathfem):
+        os.makedirs(base_pathfem)
+
+    jobs = []
+    for name in montage_names:
+        if name in montages and montages[name]:
+            jobs.append((name, montages[name]))
+        else:
+            print(f"Montage {name} not found or invalid. Skipping.")
+
+    # Run the simulations for each selected montage, several at once if the node allows it
+    workers, threads = solver_pool.plan_from_environment(len(jobs))
+    if workers > 1:
+        print(f"Running {len(jobs)} montages on {workers} processes with {threads} solver threads each.")
+    for name in solver_pool.imap_jobs(run_simulation, jobs, workers, threads,
+                                      initializer=configure, initargs=settings):
+        print(f"Montage {name} done.")
 
-# Run the simulations for each selected montage
-for name in montage_names:
-    if name in montages and montages[name]:
-        run_simulation(name, montages[name])
-    else:
-        print(f"Montage {name} not found or invalid. Skipping.")
 
+if __name__ == "__main__":
+    main()
@@ -2,44 +2,61 @@
 import os
 import sys
 import json
-from copy import deepcopy
+from copy import copy
 import numpy as np
+import simnibs
 from simnibs import mesh_io, run_simnibs, sim_struct
-from simnibs.utils import TI_utils as TI
-
-# Get subject ID, simulation type, and montages from command-line arguments
-subject_id = sys.argv[1]
-sim_type = sys.argv[2]  # The anisotropy type
-subject_dir = sys.argv[3]
-simulation_dir = sys.argv[4]
-montage_names = sys.argv[5:]  # The list of montages
-
-# Define the correct path for the JSON file
-utils_dir = os.path.join(subject_dir, '..', 'utils')
-montage_file = os.path.join(utils_dir, 'montage_list.json')
-
-# Load montages from JSON file
-with open(montage_file) as f:
-    all_montages = json.load(f)
-
-# Create the montages dictionary based on the selected montages
-montages = {name: all_montages['uni_polar_montages'].get(name, all_montages['multi_polar_montages'].get(name))
-            for name in montage_names}
-
-# Base paths
-base_subpath = os.path.join(subject_dir, f"m2m_{subject_id}")
-base_pathfem = os.path.join(simulation_dir, f"sim_{subject_id}", "FEM")
-conductivity_path = base_subpath
-tensor_file = os.path.join(conductivity_path, "DTI_coregT1_tensor.nii.gz")
-
-# Ensure the base_pathfem directory exists
-if not os.path.exists(base_pathfem):
-    os.makedirs(base_pathfem)
-
-def get_TI_vectors(E1_org, E2_org):
+
+# The shared modules (FEM solution cache, TI kernels) are in ../optimizer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'optimizer'))
+import fem_cache
+import ti_engine
+
+###########################################
+
+# Multipolar TI simulations: the TI vectors of each montage are computed in memory and the montages are paired
+# (1st with 2nd, 3rd with 4th, ...) into the maximal amplitude of the multipolar TI envelope (mTI_<m1>_<m2>.msh).
+# The head mesh is read once per run; the TI_<montage>.msh meshes with the TI vectors of every montage are
+# only written with MTI_WRITE_MONTAGE_MESHES=1.
+
+###########################################
+
+# Current of each electrode pair (A), electrode geometry and the head tissues kept in the output meshes
+CURRENT = 0.0025
+ELECTRODE = {"shape": "ellipse", "dimensions": [8, 8], "thickness": [4, 4]}
+TAGS_KEEP = np.hstack((np.arange(1, 100), np.arange(1001, 1100)))
+# Precision of the TI kernels (optimizer/ti_engine.py); TI_FLOAT32=1 halves their work memory
+KERNEL_DTYPE = np.float32 if os.getenv("TI_FLOAT32", "0") == "1" else None
+
+# Simulation settings, set by configure
+sim_type = None
+base_subpath = None
+base_pathfem = None
+tensor_file = None
+eeg_cap = None
+solution_cache = None
+
+# Function to set the simulation settings from the command-line arguments
+def configure(subject_id, anisotropy_type, subject_dir, simulation_dir):
+    global sim_type, base_subpath, base_pathfem, tensor_file, eeg_cap, solution_cache
+    sim_type = anisotropy_type
+    base_subpath = os.path.join(subject_dir, f"m2m_{subject_id}")
+    base_pathfem = os.path.join(simulation_dir, f"sim_{subject_id}", "FEM")
+    conductivity_path = base_subpath
+    tensor_file = os.path.join(conductivity_path, "DTI_coregT1_tensor.nii.gz")
+    eeg_cap = os.path.join(base_subpath, "eeg_positions", "EGI_template.csv")
+    # Electrode pair solutions are reused across montages and runs (see optimizer/fem_cache.py)
+    solution_cache = fem_cache.PairSolutionCache(base_subpath, fem_cache.solution_settings(
+        base_subpath, os.path.join(base_subpath, f"{subject_id}.msh"), sim_type, tensor_file, eeg_cap, ELECTRODE,
+        simnibs.__version__))
+
+def get_TI_vectors(E1_org, E2_org, dtype=None):
     """
     calculates the modulation amplitude vectors for the TI envelope
 
+    Computed in chunks of elements (see ti_engine.get_TI_vectors_chunked), so the
+    inputs are not copied.
+
     Parameters
     ----------
     E1_org : np.ndarray
@@ -47,6 +64,8 @@ def get_TI_vectors(E1_org, E2_org):
            positions at which the field was calculated
     E2_org : np.ndarray
         field of electrode pair 2 (N x 3)
+    dtype : np.dtype, optional
+        arithmetic precision, e.g. np.float32 (default: that of the fields)
 
     Returns
     -------
@@ -55,40 +74,17 @@ def get_TI_vectors(E1_org, E2_org):
     """
     assert E1_org.shape == E2_org.shape
     assert E1_org.shape[1] == 3
-    E1 = E1_org.copy()
-    E2 = E2_org.copy()
-
-    # ensure E1>E2
-    idx = np.linalg.norm(E2, axis=1) > np.linalg.norm(E1, axis=1)
-    E1[idx] = E2[idx]
-    E2[idx] = E1_org[idx]
-
-    # ensure alpha < pi/2
-    idx = np.sum(E1 * E2, axis=1) < 0
-    E2[idx] = -E2[idx]
-
-    # get maximal amplitude of envelope
-    normE1 = np.linalg.norm(E1, axis=1)
-    normE2 = np.linalg.norm(E2, axis=1)
-    cosalpha = np.sum(E1 * E2, axis=1) / (normE1 * normE2)
+    return ti_engine.get_TI_vectors_chunked(E1_org, E2_org, dtype=dtype)
 
-    idx = normE2 <= normE1 * cosalpha
-    
-    TI_vectors = np.zeros_like(E1)
-    TI_vectors[idx] = 2 * E2[idx]
-    TI_vectors[~idx] = 2 * np.cross(E2[~idx], E1[~idx] - E2[~idx]) / np.linalg.norm(E1[~idx] - E2[~idx], axis=1)[:, None]
 
-    return TI_vectors
 
-
-
-# Function to run simulations
-def run_simulation(montage_name, montage):
+# Function to run the FEM solves of electrode pairs; returns the cropped head mesh and the E field of each pair
+def solve_pairs(pathfem, pairs):
     S = sim_struct.SESSION()
     S.subpath = base_subpath
     S.anisotropy_type = sim_type
-    S.pathfem = os.path.join(base_pathfem, f"TI_{montage_name}")
-    S.eeg_cap = os.path.join(base_subpath, "eeg_positions", "EGI_template.csv")
+    S.pathfem = pathfem
+    S.eeg_cap = eeg_cap
     S.map_to_surf = False
     S.map_to_fsavg = False
     S.map_to_vol = False
@@ -99,93 +95,112 @@ def run_simulation(montage_name, montage):
     # Load the conductivity tensors
     S.dti_nii = tensor_file
 
-    # First electrode pair
-    tdcs = S.add_tdcslist()
-    tdcs.anisotropy_type = sim_type  # Set anisotropy_type to the input sim_type
-    tdcs.currents = [0.0025, -0.0025]
-    electrode = tdcs.add_electrode()
-    electrode.channelnr = 1
-    electrode.centre = montage[0][0]
-    electrode.shape = "ellipse"
-    electrode.dimensions = [8, 8]
-    electrode.thickness = [4, 4]
-
-    electrode = tdcs.add_electrode()
-    electrode.channelnr = 2
-    electrode.centre = montage[0][1]
-    electrode.shape = "ellipse"
-    electrode.dimensions = [8, 8]
-    electrode.thickness = [4, 4]
-
-    # Second electrode pair
-    tdcs_2 = S.add_tdcslist(deepcopy(tdcs))
-    tdcs_2.currents = [0.0025, -0.0025]
-    tdcs_2.electrode[0].centre = montage[1][0]
-    tdcs_2.electrode[1].centre = montage[1][1]
+    # One tDCS simulation per electrode pair
+    for pair in pairs:
+        tdcs = S.add_tdcslist()
+        tdcs.anisotropy_type = sim_type  # Set anisotropy_type to the input sim_type
+        tdcs.currents = [CURRENT, -CURRENT]
+        for channel, centre in enumerate(pair, start=1):
+            electrode = tdcs.add_electrode()
+            electrode.channelnr = channel
+            electrode.centre = centre
+            electrode.shape = ELECTRODE["shape"]
+            electrode.dimensions = list(ELECTRODE["dimensions"])
+            electrode.thickness = list(ELECTRODE["thickness"])
 
     run_simnibs(S)
 
     subject_identifier = base_subpath.split('_')[-1]
     anisotropy_type = S.anisotropy_type
 
-    m1_file = os.path.join(S.pathfem, f"{subject_identifier}_TDCS_1_{anisotropy_type}.msh")
-    m2_file = os.path.join(S.pathfem, f"{subject_identifier}_TDCS_2_{anisotropy_type}.msh")
-
-    m1 = mesh_io.read_msh(m1_file)
-    m2 = mesh_io.read_msh(m2_file)
-
-    tags_keep = np.hstack((np.arange(1, 100), np.arange(1001, 1100)))
-    m1 = m1.crop_mesh(tags=tags_keep)
-    m2 = m2.crop_mesh(tags=tags_keep)
-
-    ef1 = m1.field["E"]
-    ef2 = m2.field["E"]
-    TImax_vectors = get_TI_vectors(ef1.value, ef2.value)
-
-    mout = deepcopy(m1)
-    mout.elmdata = []
-    mout.add_element_field(TImax_vectors, "TI_vectors")
-    output_mesh_path = os.path.join(S.pathfem, f"TI_{montage_name}.msh")
-    mesh_io.write_msh(mout, output_mesh_path)
-
-    v = mout.view(visible_tags=[1002, 1006], visible_fields=["TI_vectors"])
-    v.write_opt(output_mesh_path)
-    
-    return output_mesh_path
-
-# Run the simulations and collect the output paths
-output_paths = {name: run_simulation(name, montage) for name, montage in montages.items()}
-
-# Create pairs of montage names for mTI calculations
-montage_pairs = [(montage_names[i], montage_names[i+1]) for i in range(0, len(montage_names) - 1, 2)]
-
-# Iterate through the montage pairs for mTI calculation
-for pair in montage_pairs:
-    m1_name, m2_name = pair
-    if m1_name in output_paths and m2_name in output_paths:
-        m1_path = output_paths[m1_name]
-        m2_path = output_paths[m2_name]
+    # The head geometry is reused from the cache or read and cropped once; only the E field is read from the others
+    mesh_files = [os.path.join(S.pathfem, f"{subject_identifier}_TDCS_{i + 1}_{anisotropy_type}.msh")
+                  for i in range(len(pairs))]
+    head, fields = fem_cache.load_pair_solutions(mesh_files, TAGS_KEEP, solution_cache)
+    return head, fields
+
+# Function to compute the TI vectors of a montage; returns the head mesh and the TI vectors (N x 3)
+def run_simulation(montage_name, montage, write_mesh=False):
+    pathfem = os.path.join(base_pathfem, f"TI_{montage_name}")
+    # Only the electrode pairs not in the solution cache are solved
+    head, (ef1, ef2), n_solved = fem_cache.pair_fields(
+        solution_cache, [montage[0], montage[1]], CURRENT, lambda pairs: solve_pairs(pathfem, pairs))
+    if n_solved < 2:
+        print(f"Montage {montage_name}: {2 - n_solved} of 2 electrode pairs reused from the solution cache.")
+
+    TImax_vectors = get_TI_vectors(ef1, ef2, KERNEL_DTYPE)
+
+    if write_mesh:
+        os.makedirs(pathfem, exist_ok=True)
+        mout = copy(head)
+        mout.elmdata = []
+        mout.nodedata = []
+        mout.add_element_field(TImax_vectors, "TI_vectors")
+        output_mesh_path = os.path.join(pathfem, f"TI_{montage_name}.msh")
+        mesh_io.write_msh(mout, output_mesh_path)
 
-        m1 = mesh_io.read_msh(m1_path)
-        m2 = mesh_io.read_msh(m2_path)
+        v = mout.view(visible_tags=[1002, 1006], visible_fields=["TI_vectors"])
+        v.write_opt(output_mesh_path)
+
+    return head, TImax_vectors
+
+
+def main():
+    # Get subject ID, simulation type, and montages from command-line arguments
+    subject_id = sys.argv[1]
+    subject_dir = sys.argv[3]
+    simulation_dir = sys.argv[4]
+    montage_names = sys.argv[5:]  # The list of montages
+    configure(subject_id, sys.argv[2], subject_dir, simulation_dir)
+    write_montage_meshes = os.getenv("MTI_WRITE_MONTAGE_MESHES", "0") == "1"
+
+    # Define the correct path for the JSON file
+    utils_dir = os.path.join(subject_dir, '..', 'utils')
+    montage_file = os.path.join(utils_dir, 'montage_list.json')
+
+    # Load montages from JSON file
+    with open(montage_file) as f:
+        all_montages = json.load(f)
+
+    # Create the montages dictionary based on the selected montages
+    montages = {name: all_montages['uni_polar_montages'].get(name, all_montages['multi_polar_montages'].get(name))
+                for name in montage_names}
+
+    # Ensure the base_pathfem directory exists
+    if not os.path.exists(base_pathfem):
+        os.makedirs(base_pathfem)
+
+    # Create pairs of montage names for mTI calculations
+    montage_pairs = [(montage_names[i], montage_names[i+1]) for i in range(0, len(montage_names) - 1, 2)]
+    if len(montage_names) % 2 and write_montage_meshes and montages[montage_names[-1]]:
+        run_simulation(montage_names[-1], montages[montage_names[-1]], True)
+    elif len(montage_names) % 2:
+        print(f"Montage {montage_names[-1]} has no partner for an mTI calculation. Skipping.")
+
+    # Only the TI vectors of the montage pair being combined are kept in memory
+    for pair in montage_pairs:
+        m1_name, m2_name = pair
+        if not montages[m1_name] or not montages[m2_name]:
+            print(f"Montage names {m1_name} and {m2_name} are not in the montage list.")
+            continue
+        head, ef1 = run_simulation(m1_name, montages[m1_name], write_montage_meshes)
+        _, ef2 = run_simulation(m2_name, montages[m2_name], write_montage_meshes)
 
         # Calculate the maximal amplitude of the TI envelope
-        ef1 = m1.field["TI_vectors"]
-        ef2 = m2.field["TI_vectors"]
-
-        # Use the get_maxTI function
-        TI_MultiPolar = TI.get_maxTI(ef1.value, ef2.value)
+        TI_MultiPolar = ti_engine.get_maxTI_chunked(ef1, ef2, dtype=KERNEL_DTYPE)
 
         # Make a new mesh for visualization of the field strengths
         # and the amplitude of the TI envelope
-        mout = deepcopy(m1)
+        mout = copy(head)
         mout.elmdata = []
+        mout.nodedata = []
 
         mout.add_element_field(TI_MultiPolar, "TI_Max")
 
         mp_pathfem = base_pathfem
         output_mesh_path = os.path.join(mp_pathfem, f"mTI_{m1_name}_{m2_name}.msh")
         mesh_io.write_msh(mout, output_mesh_path)
-    else:
-        print(f"Montage names {m1_name} and {m2_name} are not in the output paths.")
 
+
+if __name__ == "__main__":
+    main()
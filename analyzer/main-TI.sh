@@ -72,6 +72,11 @@ echo "Debug: selected_montages: ${selected_montages[@]}"
 echo "Debug: selected_roi_names: ${selected_roi_names[@]}"
 
 # Main script: Run TI.py with the selected parameters
+# (TI_MAX_WORKERS, TI_SOLVER_THREADS and TI_SOLVE_MEMORY_GB set how many montages are solved at once;
+#  TI_LEADFIELD=auto builds the montages on the leadfield cap from the subject's leadfield instead of solving them,
+#  if it was solved with the same settings, and writes them as FEM/TI_<montage>/TI.msh on the head mesh of the solves)
+echo "Debug: TI_MAX_WORKERS: ${TI_MAX_WORKERS:-1}"
+echo "Debug: TI_LEADFIELD: ${TI_LEADFIELD:-off}"
 simnibs_python TI.py "$subject_id" "$conductivity" "$subject_dir" "$simulation_dir" "${selected_montages[@]}"
 
 # Function to visualize montages
@@ -79,6 +79,8 @@ run_mti_simulation() {
     local selected_montages=("${@:6}")
     local mti_script_path="${script_dir}/mTI.py"
     echo "Running mTI simulation..."
+    # MTI_WRITE_MONTAGE_MESHES=1 also writes the TI_vectors mesh of every montage (FEM/TI_<montage>/)
+    echo "Debug: MTI_WRITE_MONTAGE_MESHES: ${MTI_WRITE_MONTAGE_MESHES:-0}"
     simnibs_python "$mti_script_path" "$subject_id" "$conductivity" "$subject_dir" "$simulation_dir" "${selected_montages[@]}"
     if [ $? -ne 0 ]; then
         echo "mTI simulation failed"
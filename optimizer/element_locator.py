@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+'''
+Optimized for optimizer pipeline
+
+This module locates points in a tetrahedral mesh in-process, replacing the
+get_fields_at_coordinates subprocess that roi-analyzer.py used to launch for every
+mesh and ROI. A KD-tree over the tetrahedron barycenters is built once per mesh
+geometry; each point is then tested against its nearest tetrahedra (by barycenter)
+with barycentric coordinates, widening the search if none of them contains it.
+'''
+
+DEFAULT_NEIGHBORS = 8
+MAX_NEIGHBORS = 512
+TOLERANCE = 1e-9
+# Largest barycenter distance (mm) of the same tetrahedron in two meshes (see ElementLocator.match)
+MATCH_TOLERANCE = 1e-6
+
+
+def barycentric_coordinates(points, vertices):
+    """
+    barycentric coordinates of points in tetrahedra
+
+    Parameters
+    ----------
+    points : np.ndarray (... x 3)
+    vertices : np.ndarray (... x 4 x 3)
+        vertices of the tetrahedron of each point
+
+    Returns
+    -------
+    bar : np.ndarray (... x 4)
+        NaN for degenerate tetrahedra
+    """
+    e1 = vertices[..., 1, :] - vertices[..., 0, :]
+    e2 = vertices[..., 2, :] - vertices[..., 0, :]
+    e3 = vertices[..., 3, :] - vertices[..., 0, :]
+    d = points - vertices[..., 0, :]
+    det = np.einsum('...i,...i->...', e1, np.cross(e2, e3))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b1 = np.einsum('...i,...i->...', d, np.cross(e2, e3)) / det
+        b2 = np.einsum('...i,...i->...', e1, np.cross(d, e3)) / det
+        b3 = np.einsum('...i,...i->...', e1, np.cross(e2, d)) / det
+    return np.stack([1 - b1 - b2 - b3, b1, b2, b3], axis=-1)
+
+
+class ElementLocator:
+    """
+    point location in a tetrahedral mesh
+
+    Parameters
+    ----------
+    node_coord : np.ndarray (N_nodes x 3)
+    tetrahedra : np.ndarray (M x 4)
+        node indices (0-based) of the tetrahedra
+    elements : np.ndarray (M,), optional
+        index of each tetrahedron in the mesh, returned by locate (default: 0..M-1)
+    centroids : np.ndarray (M x 3), optional
+        tetrahedron barycenters, computed from the nodes if not given
+    """
+
+    def __init__(self, node_coord, tetrahedra, elements=None, centroids=None):
+        self.node_coord = np.asarray(node_coord, dtype=float)
+        self.tetrahedra = np.asarray(tetrahedra)
+        self.elements = np.arange(len(self.tetrahedra)) if elements is None else np.asarray(elements)
+        if centroids is None:
+            centroids = self.node_coord[self.tetrahedra].mean(axis=1)
+        self.tree = cKDTree(centroids)
+
+    @classmethod
+    def from_mesh(cls, mesh, centroids=None):
+        """Locator of the tetrahedra of a mesh_io.Msh; centroids (N_elm x 3) may come from a geometry store."""
+        elements = np.flatnonzero(mesh.elm.elm_type == 4)
+        return cls(mesh.nodes.node_coord, mesh.elm.node_number_list[elements] - 1, elements,
+                   None if centroids is None else np.asarray(centroids)[elements])
+
+    def locate(self, points, neighbors=DEFAULT_NEIGHBORS):
+        """
+        tetrahedra containing points
+
+        Returns
+        -------
+        th_indices : np.ndarray (P,)
+            index of the element containing each point, -1 if outside the mesh
+        bar : np.ndarray (P x 4)
+            barycentric coordinates of each point in its element (zero if outside)
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        th_indices = np.full(len(points), -1)
+        bar = np.zeros((len(points), 4))
+        pending = np.arange(len(points))
+        k = min(neighbors, len(self.tetrahedra))
+        while len(pending):
+            _, candidates = self.tree.query(points[pending], k=k)
+            candidates = candidates.reshape(len(pending), k)
+            b = barycentric_coordinates(points[pending, None, :], self.node_coord[self.tetrahedra[candidates]])
+            contains = np.all(b >= -TOLERANCE, axis=2)
+            found = contains.any(axis=1)
+            first = np.argmax(contains, axis=1)
+            rows = np.flatnonzero(found)
+            th_indices[pending[rows]] = self.elements[candidates[rows, first[rows]]]
+            bar[pending[rows]] = b[rows, first[rows]]
+            pending = pending[~found]
+            # Points far from every barycenter are outside the mesh once the search is wide enough
+            if k >= min(MAX_NEIGHBORS, len(self.tetrahedra)):
+                break
+            k = min(4 * k, MAX_NEIGHBORS, len(self.tetrahedra))
+        return th_indices, bar
+
+    def match(self, centroids, tolerance=MATCH_TOLERANCE):
+        """
+        tetrahedra with the given barycenters, e.g. the same tetrahedra in another mesh
+
+        Returns
+        -------
+        th_indices : np.ndarray (len(centroids),)
+            index of the tetrahedron with each barycenter, -1 if there is none
+        """
+        distance, candidates = self.tree.query(np.asarray(centroids, dtype=float), distance_upper_bound=tolerance)
+        found = np.isfinite(distance)
+        th_indices = np.full(len(distance), -1)
+        th_indices[found] = self.elements[candidates[found]]
+        return th_indices
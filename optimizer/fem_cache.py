@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import msh_reader
+
+'''
+Per-subject cache of electrode pair FEM solutions
+
+TI.py and mTI.py solve both electrode pairs of every montage with run_simnibs, even
+when a pair (e.g. E010-E020) was already solved for another montage or in an earlier
+run. This module stores the E field of every solved pair, at the head elements (tags
+1-99 and 1001-1099), under
+
+    m2m_<subject>/fem_cache/<settings key>/<pair key>.npy
+
+The settings key is a hash of everything the solution depends on besides the
+electrode positions: the subject mesh, the anisotropy type and conductivity tensors,
+the EEG cap, the electrode geometry (shape, dimensions, thickness) and the SimNIBS
+version. The pair key is a hash of the two electrode positions. The field is linear
+in the current, so it is stored per ampere of current entering the first electrode of
+the pair in sorted order: a pair is shared between TI.py (5 mA) and mTI.py (2.5 mA)
+and between E010-E020 and E020-E010 (field negated).
+
+The cropped head mesh of the first solve is stored with the settings (head.msh), so
+a montage whose pairs are all cached needs no FEM solve at all. It is read once per
+run and the same mesh object is returned for every montage. The indices of its elements
+in the meshes written by run_simnibs are stored with it (head_elements.npz), and so
+is the leadfield element that carries the field of each of its elements
+(leadfield_elements.npz, see analyzer/TI.py), so montages superposed from the leadfield
+are written on the same head mesh as the solved ones.
+
+load_pair_solutions reads the meshes of one run_simnibs session (one per pair, with the
+same head geometry): with a stored head mesh only the E field at its elements is read
+(msh_reader.py); otherwise the geometry is parsed and cropped once, from the first mesh,
+and only the E field is read from the others.
+
+File digests (subject mesh, tensors, cap) are memoized in digests.json by file size
+and modification time, so large meshes are hashed once.
+'''
+
+CACHE_DIRNAME = 'fem_cache'
+HEAD_FILENAME = 'head.msh'
+HEAD_ELEMENTS_FILENAME = 'head_elements.npz'
+LEADFIELD_ELEMENTS_FILENAME = 'leadfield_elements.npz'
+DIGESTS_FILENAME = 'digests.json'
+HASH_BLOCK = 1 << 24
+
+
+def cache_dir(subject_m2m_dir):
+    """Directory of the FEM solution cache of a subject (m2m_<subject>/fem_cache)."""
+    return os.path.join(subject_m2m_dir, CACHE_DIRNAME)
+
+
+def _hash(value):
+    return hashlib.blake2b(json.dumps(value, sort_keys=True).encode(), digest_size=12).hexdigest()
+
+
+def file_digest(path, memo_path=None):
+    """
+    hash of the contents of a file, None if it does not exist
+
+    Digests are memoized in memo_path (JSON) by path, size and modification time.
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    memo = {}
+    if memo_path is not None and os.path.exists(memo_path):
+        try:
+            with open(memo_path) as file:
+                memo = json.load(file)
+        except (OSError, ValueError):
+            memo = {}
+    entry = memo.get(path)
+    if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return entry[2]
+    h = hashlib.blake2b(digest_size=12)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK), b''):
+            h.update(block)
+    digest = h.hexdigest()
+    if memo_path is not None:
+        memo[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        _write_atomic(memo_path, lambda file: file.write(json.dumps(memo).encode()))
+    return digest
+
+
+def _write_atomic(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def solution_settings(subject_m2m_dir, subject_mesh, anisotropy_type, tensor_file, eeg_cap, electrode,
+                      version=None):
+    """
+    settings a pair solution depends on, besides the electrode positions
+
+    Parameters
+    ----------
+    subject_m2m_dir : str
+        m2m_<subject> directory (holds the cache)
+    subject_mesh, tensor_file, eeg_cap : str
+        files hashed by contents (the tensors only matter for anisotropic conductivities)
+    anisotropy_type : str
+    electrode : dict
+        shape, dimensions and thickness of the electrodes
+    version : str, optional
+        SimNIBS version
+    """
+    memo_path = os.path.join(cache_dir(subject_m2m_dir), DIGESTS_FILENAME)
+    return {
+        'mesh': file_digest(subject_mesh, memo_path),
+        'anisotropy_type': anisotropy_type,
+        'tensors': None if anisotropy_type == 'scalar' else file_digest(tensor_file, memo_path),
+        'eeg_cap': file_digest(eeg_cap, memo_path),
+        'electrode': electrode,
+        'version': version,
+    }
+
+
+class PairSolutionCache:
+    """
+    E fields of electrode pairs solved with the same settings (see solution_settings)
+
+    Parameters
+    ----------
+    subject_m2m_dir : str
+    settings : dict
+    """
+
+    def __init__(self, subject_m2m_dir, settings):
+        self.settings = settings
+        self.directory = os.path.join(cache_dir(subject_m2m_dir), _hash(settings))
+        self._head = None
+
+    @staticmethod
+    def pair_key(pair):
+        """(key, sign) of an electrode pair; sign is -1 if the electrodes are not in sorted order."""
+        a, b = (json.dumps(centre) for centre in pair)
+        return _hash(sorted((a, b))), 1.0 if a <= b else -1.0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def load(self, pair, current, n_elements=None):
+        """E field of a pair for a current (A), None if not cached (or cached for another mesh size)."""
+        key, sign = self.pair_key(pair)
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        field = np.load(path)
+        if n_elements is not None and len(field) != n_elements:
+            return None
+        return field * (sign * current)
+
+    def store(self, pair, current, field):
+        """Stores the E field of a pair solved for a current (A)."""
+        key, sign = self.pair_key(pair)
+        unit_field = np.asarray(field) / (sign * current)
+        _write_atomic(self._path(key), lambda file: np.save(file, unit_field))
+
+    @property
+    def head_path(self):
+        return os.path.join(self.directory, HEAD_FILENAME)
+
+    def load_head(self):
+        """Cropped head mesh of the cached solutions (read once per cache object), None if not stored yet."""
+        if self._head is None and os.path.exists(self.head_path):
+            from simnibs import mesh_io
+            self._head = mesh_io.read_msh(self.head_path)
+        return self._head
+
+    @property
+    def head_elements_path(self):
+        return os.path.join(self.directory, HEAD_ELEMENTS_FILENAME)
+
+    def load_head_elements(self):
+        """(element indices, number of elements) of the head in the solved meshes, None if not stored."""
+        if not os.path.exists(self.head_elements_path) or self.load_head() is None:
+            return None
+        with np.load(self.head_elements_path) as data:
+            return data['elements'], int(data['n_elements'])
+
+    def store_head(self, mesh, elements=None, n_elements=None):
+        """
+        Stores the cropped head mesh, with the 0-based indices of its elements in the
+        solved meshes of n_elements elements if given.
+        """
+        from simnibs import mesh_io
+        if mesh is self._head:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # The element indices of a previous head do not describe this one
+        for path in (self.head_elements_path, self.leadfield_elements_path):
+            if os.path.exists(path):
+                os.remove(path)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp_', suffix='.msh')
+        os.close(fd)
+        mesh_io.write_msh(mesh, tmp)
+        os.replace(tmp, self.head_path)
+        self._head = mesh
+        if elements is not None:
+            _write_atomic(self.head_elements_path,
+                          lambda file: np.savez(file, elements=elements, n_elements=n_elements))
+
+    @property
+    def leadfield_elements_path(self):
+        return os.path.join(self.directory, LEADFIELD_ELEMENTS_FILENAME)
+
+    def load_leadfield_elements(self, n_elements):
+        """
+        Index of the leadfield element of each head element (-1 if it has none) in a
+        leadfield mesh of n_elements elements, None if not stored for the current head.
+        """
+        head = self.load_head()
+        if not os.path.exists(self.leadfield_elements_path) or head is None:
+            return None
+        with np.load(self.leadfield_elements_path) as data:
+            if int(data['n_elements']) != n_elements or len(data['elements']) != head.elm.nr:
+                return None
+            return data['elements']
+
+    def store_leadfield_elements(self, elements, n_elements):
+        """Stores the leadfield element of each head element, in a leadfield mesh of n_elements elements."""
+        _write_atomic(self.leadfield_elements_path,
+                      lambda file: np.savez(file, elements=elements, n_elements=n_elements))
+
+
+def _read_fields(mesh_files, keep, n_elements):
+    fields = []
+    for mesh_file in mesh_files:
+        with msh_reader.MshFile(mesh_file) as msh:
+            if msh.n_elements != n_elements:
+                raise ValueError(f"{mesh_file} does not have the geometry of {mesh_files[0]}")
+            fields.append(np.array(msh.element_data("E", keep)))
+    return fields
+
+
+def load_pair_solutions(mesh_files, tags, cache=None):
+    """
+    cropped head mesh and E fields of the meshes of one session
+
+    Parameters
+    ----------
+    mesh_files : list of str
+        TDCS_<i> meshes written by run_simnibs, with the same geometry
+    tags : np.ndarray
+        tags of the elements to keep
+    cache : PairSolutionCache, optional
+        cache whose stored head mesh is reused (and stored, if missing)
+
+    Returns
+    -------
+    head : simnibs.mesh_io.Msh
+        first mesh cropped to the tags, without fields
+    fields : list of np.ndarray (N_elm x 3)
+        E field of each mesh at the kept elements
+    """
+    head_elements = cache.load_head_elements() if cache is not None else None
+    if head_elements is not None:
+        keep, n_elements = head_elements
+        with msh_reader.MshFile(mesh_files[0]) as msh:
+            same_geometry = msh.n_elements == n_elements
+        if same_geometry:
+            return cache.load_head(), _read_fields(mesh_files, keep, n_elements)
+    from simnibs import mesh_io
+    mesh = mesh_io.read_msh(mesh_files[0])
+    keep = np.flatnonzero(np.isin(mesh.elm.tag1, tags))
+    fields = [mesh.field["E"].value[keep]] + _read_fields(mesh_files[1:], keep, mesh.elm.nr)
+    mesh.elmdata = []
+    mesh.nodedata = []
+    head = mesh.crop_mesh(elements=keep + 1)
+    if cache is not None:
+        cache.store_head(head, keep, mesh.elm.nr)
+    return head, fields
+
+
+def pair_fields(cache, pairs, current, solve):
+    """
+    E fields of electrode pairs at the head elements, solving only the pairs not cached
+
+    Parameters
+    ----------
+    cache : PairSolutionCache
+    pairs : list of (centre, centre)
+    current : float
+        current of the pairs (A)
+    solve : callable
+        solve(pairs) -> (cropped head mesh, [E field of each pair]) runs the FEM solves
+
+    Returns
+    -------
+    head : simnibs.mesh_io.Msh
+    fields : list of np.ndarray (N_elm x 3)
+    n_solved : int
+        number of pairs solved
+    """
+    head = cache.load_head()
+    n_elements = None if head is None else head.elm.nr
+    fields = [cache.load(pair, current, n_elements) for pair in pairs]
+    missing = [i for i, field in enumerate(fields) if field is None]
+    if head is None or missing:
+        # Without a cached head mesh one pair is solved again to get it
+        solve_indices = missing or [0]
+        solved_head, solved = solve([pairs[i] for i in solve_indices])
+        for i, field in zip(solve_indices, solved):
+            cache.store(pairs[i], current, field)
+            fields[i] = field
+        if head is None or solved_head.elm.nr != head.elm.nr:
+            cache.store_head(solved_head)
+            head = solved_head
+        return head, fields, len(solve_indices)
+    return head, fields, 0
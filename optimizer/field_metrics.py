@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+import csv
+import numpy as np
+import results_store
+
+'''
+Optimized for optimizer pipeline
+
+This module computes the peak and focality metrics of field-analysis/
+mesh_get_fieldpeaks_and_focality.m with NumPy, on arrays of element values, volumes
+and barycenters (e.g. TImax on the gray matter elements of gm_leadfield.py). Many
+fields defined on the same elements are processed at once (one row per field):
+
+- MaxValue and XYZ_Max: peak value and the barycenter(s) of the peak element(s).
+- PercentileValue_<p>: value of the first element (in increasing order) at which
+  the cumulative volume exceeds p % of the total volume.
+- XYZ_Percentiles_<p>, XYZ_Std_Percentiles_<p>: weighted mean and standard deviation
+  of the barycenters of the elements above the percentile.
+- FocalityValue_<c>: volume (cm^3) of the elements with a value of at least c % of
+  the 99.9 percentile.
+
+summary.csv is written with the columns of process_mesh_files_new.m; the metrics are
+also upserted into the results store of the optimization (results_store.py), from
+which update_output_csv.py exports output.csv.
+
+The exact percentiles need a full sort of every field. get_metrics_sketch_batch instead
+streams the elements into a QuantileSketch (a mergeable, volume-weighted histogram
+with logarithmic buckets) in one O(M) pass; see QuantileSketch for the error bound.
+Callers recompute the exact metrics of the combinations they finally select.
+'''
+
+PERCENTILES = (95, 99, 99.9)
+FOCALITY_CUTOFFS = (50, 75, 90, 95)
+FIELD_NAME = 'TImax'
+REGION_IDX = 2
+# Relative accuracy of the sketch percentiles and the range of values it resolves
+DEFAULT_SKETCH_ACCURACY = 0.005
+SKETCH_MIN_VALUE = 1e-9
+SKETCH_MAX_VALUE = 1e6
+# Elements added to a sketch at once
+SKETCH_CHUNK_ELEMENTS = 1 << 18
+
+
+def get_metrics_batch(values, volumes, centroids, percentiles=PERCENTILES, focality_cutoffs=FOCALITY_CUTOFFS):
+    """
+    peak, percentile and focality metrics of several fields on the same elements
+
+    Parameters
+    ----------
+    values : np.ndarray (B x M)
+        field value of each element, one row per field (NaNs are ignored)
+    volumes : np.ndarray (M,)
+        element volumes (mm^3)
+    centroids : np.ndarray (M x 3)
+        element barycenters
+
+    Returns
+    -------
+    metrics : list of dict
+        per field: 'max', 'XYZ_max', 'perc_values', 'XYZ_perc', 'XYZstd_perc'
+        and 'focality_values' (cm^3)
+    """
+    values = np.atleast_2d(values)
+    nan_rows = np.isnan(values).any(axis=1)
+    if nan_rows.any():
+        # Rows with NaNs have their own element set
+        metrics = [None] * len(values)
+        for b in np.flatnonzero(nan_rows):
+            valid = ~np.isnan(values[b])
+            metrics[b] = get_metrics_batch(values[b, valid], volumes[valid], centroids[valid],
+                                           percentiles, focality_cutoffs)[0]
+        for b, m in zip(np.flatnonzero(~nan_rows), get_metrics_batch(values[~nan_rows], volumes, centroids,
+                                                                      percentiles, focality_cutoffs)):
+            metrics[b] = m
+        return metrics
+
+    n_fields, n_elements = values.shape
+    order = np.argsort(values, axis=1, kind='stable')
+    data = np.take_along_axis(values, order, axis=1)
+    cumulative = np.cumsum(volumes[order], axis=1)
+    total = cumulative[:, -1]
+    normed = cumulative / total[:, None]
+    rows = np.arange(n_fields)
+
+    # First element whose cumulative volume exceeds the percentile (the last one if none does)
+    def percentile_index(p):
+        return np.minimum((normed <= p / 100).sum(axis=1), n_elements - 1)
+
+    perc_idx = np.stack([percentile_index(p) for p in percentiles], axis=1)
+    perc_values = data[rows[:, None], perc_idx]
+
+    # As in mesh_get_fieldpeaks_and_focality.m, the barycenters above a percentile are
+    # weighted with the cumulative element volumes
+    XYZ_perc = np.empty((n_fields, len(percentiles), 3))
+    XYZstd_perc = np.empty((n_fields, len(percentiles), 3))
+    for b in range(n_fields):
+        positions = centroids[order[b]]
+        for i, start in enumerate(perc_idx[b]):
+            w = cumulative[b, start:]
+            x = positions[start:]
+            mean = w @ x / w.sum()
+            n_nonzero = np.count_nonzero(w)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scale = (n_nonzero - 1) / n_nonzero * w.sum()
+                XYZstd_perc[b, i] = np.sqrt(w @ (x - mean) ** 2 / scale)
+            XYZ_perc[b, i] = mean
+
+    peak = data[rows, percentile_index(99.9)]
+    focality_values = np.empty((n_fields, len(focality_cutoffs)))
+    for i, cutoff in enumerate(focality_cutoffs):
+        idx = (data < cutoff / 100 * peak[:, None]).sum(axis=1)
+        below = np.where(idx > 0, cumulative[rows, np.maximum(idx - 1, 0)], 0)
+        focality_values[:, i] = total - below
+
+    maxima = data[:, -1]
+    return [dict(max=maxima[b], XYZ_max=centroids[values[b] == maxima[b]], perc_values=perc_values[b],
+                 XYZ_perc=XYZ_perc[b], XYZstd_perc=XYZstd_perc[b], focality_values=focality_values[b] / 1000)
+            for b in range(n_fields)]
+
+
+def get_metrics(values, volumes, centroids, percentiles=PERCENTILES, focality_cutoffs=FOCALITY_CUTOFFS):
+    """peak, percentile and focality metrics of one field (see get_metrics_batch)"""
+    return get_metrics_batch(np.asarray(values)[None], volumes, centroids, percentiles, focality_cutoffs)[0]
+
+
+class QuantileSketch:
+    """
+    mergeable, volume-weighted quantile sketch of several fields
+
+    Values are counted (with their element volume as weight) in logarithmic buckets
+    (gamma^(i-1), gamma^i] with gamma = (1 + accuracy) / (1 - accuracy); values
+    below min_value share a bucket that represents 0. Sketches with the same
+    parameters are merged by adding their bucket weights, so a field can be
+    sketched chunk by chunk, in any order and in parallel.
+
+    Error bound: a bucket is represented by 2 gamma^i / (gamma + 1), which is
+    within a relative error of `accuracy` of every value in the bucket. The
+    bucket that holds the exact percentile value is found exactly (the weight
+    below each bucket is exact), so every percentile is within a relative error
+    of `accuracy` of the exact value (for values in [min_value, max_value]).
+    The volume above a threshold is exact up to the weight of the one bucket
+    that contains the threshold. Focality thresholds are fractions of the sketched
+    99.9 percentile, so their relative error is also `accuracy`; the focality
+    volumes are those of a threshold within that error (a few % of volume for
+    accuracy = 0.005 on typical TImax distributions).
+
+    Parameters
+    ----------
+    n_fields : int
+        number of fields sketched side by side
+    accuracy : float
+        relative accuracy of the quantiles
+    """
+
+    def __init__(self, n_fields=1, accuracy=DEFAULT_SKETCH_ACCURACY, min_value=SKETCH_MIN_VALUE,
+                 max_value=SKETCH_MAX_VALUE):
+        self.accuracy = accuracy
+        self.min_value = min_value
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = np.log(self.gamma)
+        self._offset = int(np.ceil(np.log(min_value) / self._log_gamma)) - 1
+        self.n_buckets = int(np.ceil(np.log(max_value) / self._log_gamma)) - self._offset + 1
+        self.weights = np.zeros((n_fields, self.n_buckets))
+
+    def _bucket(self, values):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            idx = np.ceil(np.log(values) / self._log_gamma) - self._offset
+        idx[~(values >= self.min_value)] = 0
+        return np.clip(idx, 0, self.n_buckets - 1).astype(np.int64)
+
+    def add(self, values, volumes):
+        """Adds elements (n_fields x m values, m volumes) to the sketch; NaNs are ignored."""
+        values = np.atleast_2d(values)
+        volumes = np.broadcast_to(volumes, values.shape)
+        valid = ~np.isnan(values)
+        idx = self._bucket(values) + np.arange(len(values))[:, None] * self.n_buckets
+        self.weights += np.bincount(idx[valid], weights=volumes[valid],
+                                    minlength=self.weights.size).reshape(self.weights.shape)
+
+    def merge(self, other):
+        """Adds the weights of another sketch with the same parameters."""
+        if other.weights.shape != self.weights.shape or other.gamma != self.gamma:
+            raise ValueError("Only sketches with the same parameters can be merged")
+        self.weights += other.weights
+        return self
+
+    def bucket_values(self):
+        """Representative value of every bucket."""
+        upper = self.gamma ** (np.arange(self.n_buckets) + self._offset)
+        values = 2 * upper / (self.gamma + 1)
+        values[0] = 0
+        return values
+
+    def quantile(self, p):
+        """
+        value of the first element at which the cumulative volume exceeds p % of the total
+        (as in mesh_get_fieldpeaks_and_focality.m), for every field
+        """
+        cumulative = np.cumsum(self.weights, axis=1)
+        total = cumulative[:, -1:]
+        idx = np.minimum((cumulative <= p / 100 * total).sum(axis=1), self.n_buckets - 1)
+        return self.bucket_values()[idx]
+
+    def volume_above(self, thresholds):
+        """Volume of the elements with a value of at least the threshold of every field."""
+        above = self.bucket_values()[None, :] >= np.asarray(thresholds)[:, None]
+        return (self.weights * above).sum(axis=1)
+
+
+def get_metrics_sketch_batch(values, volumes, centroids, percentiles=PERCENTILES,
+                             focality_cutoffs=FOCALITY_CUTOFFS, accuracy=DEFAULT_SKETCH_ACCURACY):
+    """
+    approximate metrics of several fields, without sorting (see QuantileSketch)
+
+    The maximum and XYZ_max are exact; percentiles and focality come from the
+    sketch. The XYZ percentile statistics are not computed ('XYZ_perc' and
+    'XYZstd_perc' are None).
+    """
+    values = np.atleast_2d(values)
+    sketch = QuantileSketch(len(values), accuracy)
+    for start in range(0, values.shape[1], SKETCH_CHUNK_ELEMENTS):
+        stop = start + SKETCH_CHUNK_ELEMENTS
+        sketch.add(values[:, start:stop], volumes[start:stop])
+
+    perc_values = np.stack([sketch.quantile(p) for p in percentiles], axis=1)
+    peak = sketch.quantile(99.9)
+    focality_values = np.stack([sketch.volume_above(c / 100 * peak) for c in focality_cutoffs], axis=1)
+    maxima = np.nanmax(values, axis=1)
+    return [dict(max=maxima[b], XYZ_max=centroids[values[b] == maxima[b]], perc_values=perc_values[b],
+                 XYZ_perc=None, XYZstd_perc=None, focality_values=focality_values[b] / 1000)
+            for b in range(len(values))]
+
+
+def format_matrix(values):
+    """Formats a vector or matrix the way MATLAB's mat2str does ("[x y z]", "[a b c;d e f]")."""
+    values = np.asarray(values)
+    if values.ndim == 2 and len(values) == 1:
+        values = values[0]
+    if values.ndim < 2:
+        return '[' + ' '.join(f'{v:.15g}' for v in np.atleast_1d(values)) + ']'
+    return '[' + ';'.join(' '.join(f'{v:.15g}' for v in row) for row in values) + ']'
+
+
+def summary_header(percentiles=PERCENTILES, focality_cutoffs=FOCALITY_CUTOFFS):
+    return (['FileName', 'FieldName', 'RegionIndices', 'MaxValue']
+            + [f'PercentileValue_{p:g}' for p in percentiles]
+            + [f'FocalityValue_{c:g}' for c in focality_cutoffs] + ['XYZ_Max']
+            + [f'XYZ_Percentiles_{p:g}' for p in percentiles]
+            + [f'XYZ_Std_Percentiles_{p:g}' for p in percentiles])
+
+
+def summary_row(filename, metrics, field_name=FIELD_NAME, region_idx=REGION_IDX):
+    # Sketch metrics have no XYZ percentile statistics; their columns are left empty
+    n_percentiles = len(metrics['perc_values'])
+    XYZ_perc = [''] * n_percentiles if metrics['XYZ_perc'] is None else \
+        [format_matrix(xyz) for xyz in metrics['XYZ_perc']]
+    XYZstd_perc = [''] * n_percentiles if metrics['XYZstd_perc'] is None else \
+        [format_matrix(xyz) for xyz in metrics['XYZstd_perc']]
+    return ([filename, field_name, ' '.join(str(r) for r in np.atleast_1d(region_idx)), float(metrics['max'])]
+            + [float(v) for v in metrics['perc_values']]
+            + [float(v) for v in metrics['focality_values']] + [format_matrix(metrics['XYZ_max'])]
+            + XYZ_perc + XYZstd_perc)
+
+
+# Function to write summary.csv from (file name, metrics) tuples
+# With a results_store.ResultsStore, the metrics of montage meshes are also upserted into the store, replacing
+# the values of these metrics written by an earlier run
+def write_summary_csv(csv_path, results, percentiles=PERCENTILES, focality_cutoffs=FOCALITY_CUTOFFS,
+                      region_idx=REGION_IDX, store=None):
+    header = summary_header(percentiles, focality_cutoffs)
+    n_rows = 0
+    montages = []
+    if store is not None:
+        store.clear(header[3:])
+    with open(csv_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for filename, metrics in results:
+            row = summary_row(filename, metrics, region_idx=region_idx)
+            writer.writerow(row)
+            n_rows += 1
+            quadruple = results_store.parse_mesh_name(filename) if store is not None else None
+            if quadruple is not None:
+                # FieldName and RegionIndices are the same for every row and are not stored
+                montages.append((quadruple, dict(zip(header[3:], row[3:]))))
+            if len(montages) >= results_store.BATCH_SIZE:
+                store.upsert(montages)
+                montages = []
+    if montages:
+        store.upsert(montages)
+    return n_rows
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import h5py
+import numpy as np
+import leadfield_access
+import mesh_geometry
+
+'''
+Optimized for optimizer pipeline
+
+This module maintains a per-subject cache of the volumetric leadfield restricted to the
+gray matter elements (tag 2, or any set of tags). Whole-brain metrics such as the
+percentiles and focality in summary.csv only use gray matter, so computing them on the
+reduced array instead of on every tissue of the leadfield cuts the work per combination
+several times.
+
+The cache is written once next to the source leadfield (<leadfield>_gm.hdf5 in
+leadfield_vol_<subject>) and rebuilt when the source file changes (modification time or
+size) or a different tag set is requested. It holds:
+- leadfield    (N_elec-1 x M x 3) rows of the selected elements, with the electrode names
+               of the source, so it can be opened with leadfield_access.LazyLeadfield
+- elements     (M,) indices (0-based) of the selected elements in the leadfield mesh
+- volumes      (M,) element volumes (mm^3)
+- centroids    (M x 3) element barycenters (mm)
+
+Build it ahead of time with:
+
+    simnibs_python gm_leadfield.py <leadfield.hdf5> [--tags 2]
+'''
+
+DEFAULT_TAGS = (2,)
+LEADFIELD_PATH = 'leadfield'
+
+# Define color variables
+RESET = '\033[0m'
+RED = '\033[0;31m'     # Red for errors
+GREEN = '\033[0;32m'   # Green for success messages and prompts
+CYAN = '\033[0;36m'    # Cyan for actions being performed
+
+
+def cache_filename(leadfield_hdf, tags=DEFAULT_TAGS):
+    """Path of the cache of a leadfield file for a tag set."""
+    base, _ = os.path.splitext(leadfield_hdf)
+    suffix = '_gm' if tuple(sorted(tags)) == DEFAULT_TAGS else '_tags_' + '_'.join(str(t) for t in sorted(tags))
+    return base + suffix + '.hdf5'
+
+
+def _source_signature(leadfield_hdf):
+    stat = os.stat(leadfield_hdf)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def is_valid(cache_hdf, leadfield_hdf, tags=DEFAULT_TAGS):
+    """True if the cache exists and was built from the current source file with the same tags."""
+    if not os.path.exists(cache_hdf):
+        return False
+    mtime_ns, size = _source_signature(leadfield_hdf)
+    try:
+        with h5py.File(cache_hdf, 'r') as f:
+            return (int(f.attrs['source_mtime_ns']) == mtime_ns and int(f.attrs['source_size']) == size
+                    and sorted(int(t) for t in f.attrs['tags']) == sorted(tags))
+    except (OSError, KeyError):
+        return False
+
+
+def select_elements(mesh, tags=DEFAULT_TAGS, geometry_store=None):
+    """
+    tetrahedra of the given tags with their volumes and barycenters
+
+    Parameters
+    ----------
+    mesh : simnibs.mesh_io.Msh
+    tags : tuple of int
+    geometry_store : str, optional
+        geometry store of the subject (mesh_geometry.geometry_dir); the geometry is
+        read from it instead of being recomputed
+
+    Returns
+    -------
+    elements : np.ndarray (M,)
+        indices (0-based) of the selected elements
+    volumes : np.ndarray (M,)
+    centroids : np.ndarray (M x 3)
+    """
+    geometry = mesh_geometry.get_geometry(mesh, geometry_store)
+    elements = geometry.elements_with_tags(tags, elm_type=4)
+    return elements, np.asarray(geometry.volumes[elements]), np.asarray(geometry.centroids[elements])
+
+
+def build(leadfield_hdf, cache_hdf, elements, volumes, centroids, tags=DEFAULT_TAGS):
+    """
+    writes the cache of the selected elements of a leadfield file
+
+    The leadfield is read one electrode row at a time, so building the cache needs
+    about one row of the full leadfield in memory.
+    """
+    mtime_ns, size = _source_signature(leadfield_hdf)
+    tmp = cache_hdf + '.tmp'
+    with leadfield_access.LazyLeadfield(leadfield_hdf, cache_rows=1) as leadfield, h5py.File(tmp, 'w') as f:
+        dset = f.create_dataset(LEADFIELD_PATH, shape=(len(leadfield), len(elements), 3), dtype=leadfield.dtype)
+        source = leadfield._dset
+        for name in ('electrode_names', 'reference_electrode'):
+            if name in source.attrs:
+                dset.attrs[name] = source.attrs[name]
+        for i in range(len(leadfield)):
+            dset[i] = leadfield.row(i)[elements]
+        f.create_dataset('elements', data=elements)
+        f.create_dataset('volumes', data=volumes)
+        f.create_dataset('centroids', data=centroids)
+        f.attrs['source'] = os.path.abspath(leadfield_hdf)
+        f.attrs['source_mtime_ns'] = mtime_ns
+        f.attrs['source_size'] = size
+        f.attrs['tags'] = np.array(sorted(tags))
+    os.replace(tmp, cache_hdf)
+
+
+class GMLeadfield:
+    """
+    leadfield restricted to a set of tissues, read from a cache file
+
+    Attributes
+    ----------
+    leadfield : leadfield_access.LazyLeadfield
+        (N_elec-1 x M x 3), memory-mapped from the cache
+    idx_lf : dict
+        mapping from electrode name to row in the leadfield
+    elements, volumes, centroids : np.ndarray
+        see the module description
+    """
+
+    def __init__(self, cache_hdf):
+        self.filename = cache_hdf
+        self.leadfield = leadfield_access.LazyLeadfield(cache_hdf, LEADFIELD_PATH)
+        self.idx_lf = self.leadfield.idx_lf
+        with h5py.File(cache_hdf, 'r') as f:
+            self.elements = f['elements'][:]
+            self.volumes = f['volumes'][:]
+            self.centroids = f['centroids'][:]
+            self.tags = tuple(int(t) for t in f.attrs['tags'])
+
+    def close(self):
+        self.leadfield.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_gm_leadfield(leadfield_hdf, tags=DEFAULT_TAGS, mesh=None, rebuild=False, geometry_store=None):
+    """
+    opens the tissue-restricted cache of a leadfield file, building it if needed
+
+    Parameters
+    ----------
+    leadfield_hdf : str
+        source leadfield file
+    tags : tuple of int
+        tissue tags of the cached elements
+    mesh : simnibs.mesh_io.Msh, optional
+        leadfield mesh, read from the source file if the cache has to be built
+    rebuild : bool
+        rebuild the cache even if it is up to date
+    geometry_store : str, optional
+        geometry store of the subject, see select_elements
+    """
+    cache_hdf = cache_filename(leadfield_hdf, tags)
+    if rebuild or not is_valid(cache_hdf, leadfield_hdf, tags):
+        print(f"{CYAN}Building leadfield cache of tags {list(tags)} in {cache_hdf}...{RESET}")
+        if mesh is None:
+            from simnibs import mesh_io
+            mesh = mesh_io.Msh().read_hdf5(leadfield_hdf, leadfield_access.MESH_PATH)
+        elements, volumes, centroids = select_elements(mesh, tags, geometry_store)
+        build(leadfield_hdf, cache_hdf, elements, volumes, centroids, tags)
+        print(f"{GREEN}Leadfield cache built ({len(elements)} elements).{RESET}")
+    return GMLeadfield(cache_hdf)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the gray matter leadfield cache of a subject.')
+    parser.add_argument('leadfield_hdf', help='Path to the volumetric leadfield HDF5 file')
+    parser.add_argument('--tags', type=int, nargs='+', default=list(DEFAULT_TAGS),
+                        help='Tissue tags of the cached elements (default: %(default)s)')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the cache even if it is up to date')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.leadfield_hdf):
+        print(f"{RED}Error: {args.leadfield_hdf} does not exist.{RESET}")
+        sys.exit(1)
+    with load_gm_leadfield(args.leadfield_hdf, tuple(args.tags), rebuild=args.rebuild) as gm:
+        print(f"{GREEN}{gm.filename}: {len(gm.elements)} elements, "
+              f"{gm.volumes.sum() / 1000:.1f} cm^3.{RESET}")
@@ -1,7 +1,10 @@
 
 import os
+import simnibs
 from simnibs import run_simnibs, sim_struct
 import sys
+import fem_cache
+import leadfield_access
 
 
 '''
@@ -17,6 +20,8 @@ which are based on two different leadfield configurations:
    - Creates a volumetric leadfield matrix that includes all tissues.
 
 The script exports all configurations based on the provided input EEG cap and subject directory.
+The settings of the leadfield (subject mesh, conductivities, EEG cap, electrode geometry) are
+recorded in the HDF5 file, so analyzer/TI.py only superposes it for simulations with the same settings.
 '''
 
 
@@ -30,6 +35,9 @@ if len(sys.argv) != 3:
 subject_ID = sys.argv[1]
 eeg_cap = sys.argv[2]
 
+# Electrode geometry of the leadfield (the same as in analyzer/TI.py)
+ELECTRODE = {"shape": "ellipse", "dimensions": [8, 8], "thickness": [4, 4]}
+
 # Function to create the leadfield matrix
 def create_leadfield(subject_ID, eeg_cap, interpolation=None, tissues=None, suffix=''):
     tdcs_lf = sim_struct.TDCSLEADFIELD()
@@ -50,9 +58,9 @@ def create_leadfield(subject_ID, eeg_cap, interpolation=None, tissues=None, suff
 
     # Electrode configuration
     electrode = tdcs_lf.electrode
-    electrode.dimensions = [8, 8]  # in mm
-    electrode.shape = "ellipse"  # shape
-    electrode.thickness = [4, 4]  # arg1=gel_thickness , arg2=electrode_thickness
+    electrode.dimensions = list(ELECTRODE["dimensions"])  # in mm
+    electrode.shape = ELECTRODE["shape"]  # shape
+    electrode.thickness = list(ELECTRODE["thickness"])  # arg1=gel_thickness , arg2=electrode_thickness
 
     # Set interpolation and tissues
     tdcs_lf.interpolation = interpolation
@@ -64,6 +72,23 @@ def create_leadfield(subject_ID, eeg_cap, interpolation=None, tissues=None, suff
 
     # Run the simulation
     run_simnibs(tdcs_lf)
+    record_settings(tdcs_lf, subject_number, output_dir)
+
+# Function to record the settings of the leadfield in its HDF5 file
+def record_settings(tdcs_lf, subject_number, output_dir):
+    eeg_cap_path = tdcs_lf.eeg_cap
+    if not os.path.isfile(eeg_cap_path):
+        eeg_cap_path = os.path.join(tdcs_lf.subpath, "eeg_positions", tdcs_lf.eeg_cap)
+    settings = fem_cache.solution_settings(
+        tdcs_lf.subpath, os.path.join(tdcs_lf.subpath, f"{subject_number}.msh"), tdcs_lf.anisotropy_type,
+        os.path.join(tdcs_lf.subpath, "DTI_coregT1_tensor.nii.gz"), eeg_cap_path, ELECTRODE, simnibs.__version__)
+    settings["conductivities"] = [c.value for c in tdcs_lf.cond]
+    # File name given by SimNIBS to the leadfield of the subject and EEG cap
+    leadfield_hdf = os.path.join(output_dir, f"{subject_number}_leadfield_"
+                                             f"{os.path.splitext(os.path.basename(tdcs_lf.eeg_cap))[0]}.hdf5")
+    if not os.path.isfile(leadfield_hdf):
+        raise FileNotFoundError(f"Leadfield {leadfield_hdf} was not written; its settings cannot be recorded.")
+    leadfield_access.write_settings(leadfield_hdf, settings)
 
 # Full path to the m2m_subjectID directory
 subject_path = subject_ID
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import json
+import os
+import h5py
+import numpy as np
+
+'''
+Optimized for optimizer pipeline
+
+This module provides lazy access to the volumetric leadfield created by leadfield.py.
+TI_utils.load_leadfield reads the whole (N_elec-1 x N_elements x 3) matrix into memory,
+which is several GB per subject. LazyLeadfield keeps the HDF5 file open instead and only
+reads the electrode rows that are actually used:
+
+- Contiguous, uncompressed datasets are memory-mapped; chunked or compressed datasets
+  are read row by row through h5py.
+- Loaded rows are kept in a bounded LRU cache, so peak memory follows the candidate
+  electrode set rather than the whole EEG cap.
+
+LazyLeadfield can be indexed like the leadfield array (leadfield[i] for one electrode
+row, leadfield[:, elements, :] for a subset of elements of every row), so it can be
+passed to the functions in ti_engine.py in place of the full array.
+
+leadfield.py records the settings of the leadfield (see fem_cache.solution_settings
+and the conductivities) as JSON in the attributes of the leadfield group, so that
+analyzer/TI.py only uses a leadfield solved with its own settings (read_settings).
+'''
+
+LEADFIELD_PATH = '/mesh_leadfield/values'
+MESH_PATH = '/mesh_leadfield/'
+SETTINGS_ATTR = 'ti_csc_settings'
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def get_electrode_index(dset):
+    """
+    mapping from electrode name to row of the leadfield dataset
+
+    The reference electrode has no row in the leadfield and maps to None,
+    as in TI_utils.load_leadfield.
+    """
+    names = [_decode(name) for name in dset.attrs['electrode_names']]
+    reference = dset.attrs.get('reference_electrode')
+    reference = _decode(reference) if reference is not None else None
+    rows = [name for name in names if name != reference]
+    if len(rows) != dset.shape[0]:
+        raise ValueError(f"Leadfield has {dset.shape[0]} electrode rows but {len(rows)} electrode names")
+    idx_lf = {name: i for i, name in enumerate(rows)}
+    if reference is not None:
+        idx_lf[reference] = None
+    return idx_lf
+
+
+class LazyLeadfield:
+    """
+    read-only, lazily loaded leadfield matrix
+
+    Parameters
+    ----------
+    leadfield_hdf : str
+        path to the leadfield HDF5 file
+    leadfield_path : str
+        path of the leadfield dataset inside the file
+    cache_rows : int, optional
+        maximal number of electrode rows kept in memory (LRU). Defaults to all rows.
+    """
+
+    def __init__(self, leadfield_hdf, leadfield_path=LEADFIELD_PATH, cache_rows=None):
+        self.filename = leadfield_hdf
+        # Identifies the leadfield across reopenings of the file (see ti_engine.get_pair_cache)
+        self.source = (os.path.abspath(leadfield_hdf), os.stat(leadfield_hdf).st_mtime_ns, leadfield_path)
+        self._file = h5py.File(leadfield_hdf, 'r')
+        self._dset = self._file[leadfield_path]
+        self.shape = self._dset.shape
+        self.dtype = self._dset.dtype
+        self.ndim = len(self.shape)
+        self.idx_lf = get_electrode_index(self._dset)
+        self.cache_rows = self.shape[0] if cache_rows is None else max(1, int(cache_rows))
+        self._cache = OrderedDict()
+        self._memmap = self._open_memmap()
+
+    def _open_memmap(self):
+        # Only contiguous, uncompressed data has a fixed byte offset in the file
+        if self._dset.chunks is not None or self._dset.compression is not None:
+            return None
+        offset = self._dset.id.get_offset()
+        if offset is None:
+            return None
+        return np.memmap(self.filename, mode='r', dtype=self.dtype, shape=self.shape, offset=offset)
+
+    @property
+    def memory_mapped(self):
+        return self._memmap is not None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_row(self, i):
+        if self._memmap is not None:
+            return np.array(self._memmap[i])
+        return self._dset[i]
+
+    def row(self, i):
+        """Returns electrode row i (N_elements x 3), loading it if it is not cached."""
+        i = int(i)
+        if i < 0:
+            i += self.shape[0]
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        values = self._read_row(i)
+        values.flags.writeable = False
+        self._cache[i] = values
+        while len(self._cache) > self.cache_rows:
+            self._cache.popitem(last=False)
+        return values
+
+    def elements(self, element_idx):
+        """Returns the given elements of every electrode row (N_elec-1 x len(element_idx) x 3)."""
+        element_idx = np.asarray(element_idx)
+        if self._memmap is not None:
+            return np.array(self._memmap[:, element_idx, :])
+        # h5py needs increasing indices for fancy selection
+        unique, inverse = np.unique(element_idx, return_inverse=True)
+        return self._dset[:, unique, :][:, inverse, :]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.row(key)
+        if (isinstance(key, tuple) and len(key) >= 2 and key[0] == slice(None)
+                and all(k == slice(None) for k in key[2:])):
+            return self.elements(key[1])
+        raise IndexError("LazyLeadfield supports leadfield[i] and leadfield[:, elements, :] indexing")
+
+    def compact(self, electrodes):
+        """
+        loads only the rows of the given electrodes into a dense array
+
+        Returns
+        -------
+        leadfield : np.ndarray (n_rows x N_elements x 3)
+            rows of the electrodes (the reference electrode has no row)
+        idx_lf : dict
+            mapping from electrode name to row in the returned array
+        """
+        idx_lf = {}
+        rows = []
+        for name in dict.fromkeys(electrodes):
+            if self.idx_lf[name] is None:
+                idx_lf[name] = None
+            else:
+                idx_lf[name] = len(rows)
+                rows.append(self.idx_lf[name])
+        leadfield = np.empty((len(rows),) + tuple(self.shape[1:]), dtype=self.dtype)
+        for k, i in enumerate(rows):
+            leadfield[k] = self._read_row(i)
+        return leadfield, idx_lf
+
+    def close(self):
+        self._cache.clear()
+        self._memmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_leadfield(leadfield_hdf, leadfield_path=LEADFIELD_PATH, mesh_path=MESH_PATH, cache_rows=None):
+    """
+    lazy counterpart of TI_utils.load_leadfield
+
+    Returns
+    -------
+    leadfield : LazyLeadfield
+    mesh : simnibs.mesh_io.Msh
+        mesh on which the leadfield was calculated
+    idx_lf : dict
+        mapping from electrode name to row in the leadfield (None for the reference)
+    """
+    from simnibs import mesh_io
+    leadfield = LazyLeadfield(leadfield_hdf, leadfield_path, cache_rows)
+    mesh = mesh_io.Msh().read_hdf5(leadfield_hdf, mesh_path)
+    return leadfield, mesh, leadfield.idx_lf
+
+
+def write_settings(leadfield_hdf, settings, mesh_path=MESH_PATH):
+    """Records the settings (JSON serializable dict) the leadfield was solved with."""
+    with h5py.File(leadfield_hdf, 'a') as f:
+        f[mesh_path].attrs[SETTINGS_ATTR] = json.dumps(settings, sort_keys=True)
+
+
+def read_settings(leadfield_hdf, mesh_path=MESH_PATH):
+    """Settings recorded by write_settings, None for leadfields without them."""
+    with h5py.File(leadfield_hdf, 'r') as f:
+        group = f.get(mesh_path)
+        value = group.attrs.get(SETTINGS_ATTR) if group is not None else None
+    return json.loads(_decode(value)) if value is not None else None
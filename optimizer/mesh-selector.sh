@@ -11,6 +11,12 @@
 #
 # It prompts the user to select specific .msh files for simulation, 
 # and optionally deletes the remaining .msh files and all .opt files.
+#
+# The meshes listed in a mesh list file (selected_meshes.txt, written by
+# montage_ranking.py) are preselected; listed meshes that were not written
+# as .msh files are exported from TI_results.hdf5 first.
+#
+# Usage: bash mesh-selector.sh [mesh_list_file]
 ##############################################
 
 
@@ -19,16 +25,45 @@ subject_name=$SUBJECT_NAME
 
 # Define the opt directory
 opt_directory="$project_dir/Simulations/opt_$subject_name"
+mesh_list_file=${1:-"$opt_directory/selected_meshes.txt"}
+results_file="$opt_directory/TI_results.hdf5"
+
+# Read the ranked meshes, exporting the ones missing from the opt directory
+ranked_meshes=()
+if [ -f "$mesh_list_file" ]; then
+    while read -r mesh_name; do
+        [ -z "$mesh_name" ] && continue
+        if [ ! -f "$opt_directory/$mesh_name" ] && [ -f "$results_file" ]; then
+            electrodes=$(echo "${mesh_name%.msh}" | sed -e 's/^TI_field_//' -e 's/_and_/ /' -e 's/_/ /g')
+            echo "Exporting $mesh_name from $results_file..."
+            simnibs_python "$(dirname "$0")/ti_results.py" "$results_file" $electrodes -o "$opt_directory/$mesh_name"
+        fi
+        ranked_meshes+=("$opt_directory/$mesh_name")
+    done < "$mesh_list_file"
+fi
 
 # List all .msh files with numbers next to them
 echo "Here are the .msh files in the opt directory:"
 msh_files=($(ls "$opt_directory"/*.msh))
+preselected=()
 for i in "${!msh_files[@]}"; do
-    echo "$i: ${msh_files[$i]}"
+    if [[ " ${ranked_meshes[@]} " =~ " ${msh_files[$i]} " ]]; then
+        echo "$i: ${msh_files[$i]} (ranked)"
+        preselected+=("$i")
+    else
+        echo "$i: ${msh_files[$i]}"
+    fi
 done
 
-# Prompt the user to select .msh files to simulate
-read -p "Enter the numbers of the .msh files you want to simulate (separated by spaces): " -a selected_files
+# Prompt the user to select .msh files to simulate (the ranked meshes by default)
+if [ ${#preselected[@]} -gt 0 ]; then
+    read -p "Enter the numbers of the .msh files you want to simulate (separated by spaces) [${preselected[*]}]: " -a selected_files
+    if [ ${#selected_files[@]} -eq 0 ]; then
+        selected_files=("${preselected[@]}")
+    fi
+else
+    read -p "Enter the numbers of the .msh files you want to simulate (separated by spaces): " -a selected_files
+fi
 
 # Validate the selection
 for num in "${selected_files[@]}"; do
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+
+'''
+Per-subject store of mesh geometry
+
+Element volumes, barycenters, node areas and the tag -> element index map of a head
+mesh never change within a subject, but the optimizer stages that need them (the
+ti_sim.py metrics through gm_leadfield.py, mesh_metrics.py and roi-analyzer.py) used to
+recompute them for every run. This module computes them once and stores them as .npy
+arrays under
+
+    m2m_<subject>/geometry/<mesh key>/
+
+where the key is a hash of the node coordinates, element connectivity and tags of the
+mesh, so meshes with the same geometry (e.g. all simulation outputs of one head model)
+share one entry. The arrays are opened memory-mapped.
+
+Stored arrays (element indices are 0-based):
+- volumes       (N_elm,)    tetrahedron volumes / triangle areas
+- centroids     (N_elm x 3) element barycenters
+- node_areas    (N_nodes,)  surface area associated with each node
+- tags          (N_elm,)    tag1 of each element
+- elm_type      (N_elm,)    element type (2 triangle, 4 tetrahedron)
+- tag_values, tag_offsets, tag_elements: CSR layout of the tag -> element index map
+'''
+
+GEOMETRY_DIRNAME = 'geometry'
+ARRAYS = ('volumes', 'centroids', 'node_areas', 'tags', 'elm_type', 'tag_values', 'tag_offsets', 'tag_elements')
+
+
+def geometry_dir(subject_m2m_dir):
+    """Directory of the geometry store of a subject (m2m_<subject>/geometry)."""
+    return os.path.join(subject_m2m_dir, GEOMETRY_DIRNAME)
+
+
+def mesh_key(mesh):
+    """Hash of the geometry of a mesh (nodes, connectivity and tags)."""
+    h = hashlib.blake2b(digest_size=12)
+    for array in (mesh.nodes.node_coord, mesh.elm.node_number_list, mesh.elm.tag1, mesh.elm.elm_type):
+        array = np.ascontiguousarray(array)
+        h.update(str(array.shape).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+class MeshGeometry:
+    """
+    geometry arrays of one mesh, memory-mapped from the store
+
+    Attributes are the arrays listed in the module description.
+    """
+
+    def __init__(self, arrays, key=None, directory=None):
+        self.key = key
+        self.directory = directory
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def load(cls, directory):
+        """Opens a store entry, memory-mapping its arrays."""
+        arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in ARRAYS}
+        return cls(arrays, os.path.basename(directory), directory)
+
+    def elements_with_tags(self, tags, elm_type=None):
+        """Sorted indices (0-based) of the elements with any of the tags, optionally of one element type."""
+        positions = np.searchsorted(self.tag_values, tags)
+        found = positions < len(self.tag_values)
+        positions = positions[found][self.tag_values[positions[found]] == np.asarray(tags)[found]]
+        if len(positions) == 0:
+            return np.array([], dtype=np.int64)
+        elements = np.sort(np.concatenate([self.tag_elements[self.tag_offsets[p]:self.tag_offsets[p + 1]]
+                                           for p in positions]))
+        if elm_type is not None:
+            elements = elements[self.elm_type[elements] == elm_type]
+        return elements
+
+
+def compute_geometry(mesh):
+    """Computes the geometry arrays of a mesh (dict of name -> array)."""
+    tags = np.asarray(mesh.elm.tag1)
+    order = np.argsort(tags, kind='stable')
+    tag_values, counts = np.unique(tags, return_counts=True)
+    return dict(volumes=mesh.elements_volumes_and_areas().value,
+                centroids=mesh.elements_baricenters().value,
+                node_areas=mesh.nodes_areas().value,
+                tags=tags,
+                elm_type=np.asarray(mesh.elm.elm_type),
+                tag_values=tag_values,
+                tag_offsets=np.concatenate([[0], np.cumsum(counts)]),
+                tag_elements=order.astype(np.int64))
+
+
+def save_geometry(arrays, directory):
+    """Writes geometry arrays to a store entry (atomically: readers never see a partial entry)."""
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+    try:
+        for name in ARRAYS:
+            np.save(os.path.join(tmp, name + '.npy'), arrays[name])
+        os.rename(tmp, directory)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(directory):
+            raise
+
+
+def get_geometry(mesh, store_dir):
+    """
+    geometry of a mesh from the store, computed and stored on first use
+
+    Parameters
+    ----------
+    mesh : simnibs.mesh_io.Msh
+    store_dir : str or None
+        geometry store of the subject (see geometry_dir); None computes the
+        geometry in memory without storing it
+    """
+    key = mesh_key(mesh)
+    if store_dir is None:
+        return MeshGeometry(compute_geometry(mesh), key)
+    directory = os.path.join(store_dir, key)
+    if not all(os.path.exists(os.path.join(directory, name + '.npy')) for name in ARRAYS):
+        save_geometry(compute_geometry(mesh), directory)
+    return MeshGeometry.load(directory)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import os
+import sys
+import numpy as np
+import field_metrics
+import gm_leadfield
+import msh_reader
+import results_store
+import ti_results
+
+'''
+Optimized for optimizer pipeline
+
+This script writes results/summary.csv for a directory of TI meshes written by ti_sim.py,
+replacing the compiled MATLAB step (field-analysis/run_process_mesh_files.sh) of
+start-opt.sh. The metrics are those of process_mesh_files_new.m (see field_metrics.py)
+and need neither the MATLAB runtime nor a second pass of MATLAB mesh reading:
+
+- The gray matter geometry (element volumes and barycenters) is looked up once, since all
+  meshes of an optimization share the leadfield mesh; it is looked up again only if the
+  node and element sections of a mesh differ (msh_reader.MshFile.geometry_key). With --geometry-dir it is read from the
+  subject's geometry store (mesh_geometry.py) instead of being recomputed.
+- Only the first mesh is parsed in full; of the others, only the TImax values of the
+  analyzed elements are read (see msh_reader.py).
+- TImax vectors are processed in batches of --batch-size meshes.
+- The metrics are also upserted into the results store of the directory (results_store.py).
+- If the directory holds a TI_results.hdf5 file (ti_sim.py --output hdf5), the TImax rows
+  are read from it instead of from meshes.
+
+Usage:
+    simnibs_python mesh_metrics.py <mesh_dir> [--tags 2] [--batch-size 16] [--geometry-dir <m2m>/geometry]
+'''
+
+DEFAULT_BATCH_SIZE = 16
+
+# Define color variables
+RESET = '\033[0m'
+RED = '\033[0;31m'     # Red for errors
+GREEN = '\033[0;32m'   # Green for success messages and prompts
+CYAN = '\033[0;36m'    # Cyan for actions being performed
+
+
+# Function to yield (file name, metrics) of the meshes in a directory, in batches
+def iter_mesh_metrics(mesh_files, tags, batch_size, geometry_store=None):
+    from simnibs import mesh_io
+    geometry_key = None
+    names, batch = [], []
+
+    def flush():
+        for name, metrics in zip(names, field_metrics.get_metrics_batch(np.stack(batch), volumes, centroids)):
+            yield name, metrics
+        names.clear()
+        batch.clear()
+
+    for mesh_file in mesh_files:
+        print(f"{CYAN}Processing {os.path.basename(mesh_file)}{RESET}")
+        with msh_reader.MshFile(mesh_file) as msh:
+            # All meshes of an optimization share the geometry of the leadfield mesh
+            mesh_key = msh.geometry_key()
+            if mesh_key != geometry_key:
+                if batch:
+                    yield from flush()
+                geometry_key = mesh_key
+                mesh = mesh_io.read_msh(mesh_file)
+                elements, volumes, centroids = gm_leadfield.select_elements(mesh, tags, geometry_store)
+            names.append(os.path.basename(mesh_file))
+            batch.append(np.array(msh.element_data('TImax', elements)))
+        if len(batch) >= batch_size:
+            yield from flush()
+    if batch:
+        yield from flush()
+
+
+# Function to yield (mesh file name, metrics) of every combination of a TI_results.hdf5 file
+def iter_results_metrics(results_file, tags, batch_size, geometry_store=None):
+    with ti_results.TIResults(results_file) as results:
+        elements, volumes, centroids = gm_leadfield.select_elements(results.read_mesh(), tags,
+                                                                       geometry_store)
+        for start in range(0, len(results), batch_size):
+            combinations = results.combinations[start:start + batch_size]
+            values = results.TImax_rows(start, start + len(combinations))[:, elements].astype(float)
+            for combination, metrics in zip(combinations,
+                                            field_metrics.get_metrics_batch(values, volumes, centroids)):
+                yield ti_results.mesh_filename(combination), metrics
+
+
+# Function to compute the metrics of all meshes (or the results file) in a directory and write summary.csv
+def process_mesh_dir(mesh_dir, tags=gm_leadfield.DEFAULT_TAGS, batch_size=DEFAULT_BATCH_SIZE, geometry_store=None):
+    results_file = os.path.join(mesh_dir, ti_results.RESULTS_FILENAME)
+    if os.path.exists(results_file):
+        print(f"{CYAN}Reading TImax from {results_file}...{RESET}")
+        results = iter_results_metrics(results_file, tags, batch_size, geometry_store)
+    else:
+        mesh_files = sorted(glob.glob(os.path.join(mesh_dir, '*.msh')))
+        print(f"{CYAN}Found {len(mesh_files)} meshes in {mesh_dir}.{RESET}")
+        results = iter_mesh_metrics(mesh_files, tags, batch_size, geometry_store)
+
+    results_dir = os.path.join(mesh_dir, 'results')
+    os.makedirs(results_dir, exist_ok=True)
+    csv_path = os.path.join(results_dir, 'summary.csv')
+    with results_store.open_store(mesh_dir) as store:
+        n_rows = field_metrics.write_summary_csv(csv_path, results, region_idx=tags, store=store)
+    print(f"{GREEN}Metrics of {n_rows} meshes written to {csv_path}.{RESET}")
+    return csv_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute peak and focality metrics of TI meshes (summary.csv).')
+    parser.add_argument('mesh_dir', help='Directory with the TI_field_*.msh meshes or TI_results.hdf5')
+    parser.add_argument('--tags', type=int, nargs='+', default=list(gm_leadfield.DEFAULT_TAGS),
+                        help='Tissue tags of the analyzed elements (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Number of TImax vectors processed at once (default: %(default)s)')
+    parser.add_argument('--geometry-dir', default=None,
+                        help='Geometry store of the subject (m2m_<subject>/geometry) to read the element geometry from')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.mesh_dir):
+        print(f"{RED}Error: the specified mesh directory does not exist.{RESET}")
+        sys.exit(1)
+    process_mesh_dir(args.mesh_dir, tuple(args.tags), args.batch_size, args.geometry_dir)
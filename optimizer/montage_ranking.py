@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import os
+import sys
+import numpy as np
+import results_store
+
+'''
+Optimized for optimizer pipeline
+
+This script ranks the montages of an optimization by several objectives at once,
+replacing the manual sorting of output.csv in a spreadsheet. The objectives are
+metrics of the results store (results_store.py), each maximized or minimized, e.g.
+ROI TImax (max) against FocalityValue_50 and PercentileValue_99.9 (min).
+
+- Pareto front: the montages that no other montage matches or beats in every
+  objective while beating it in one. Computed with a sort-based skyline: after
+  sorting by the sum of the normalized objectives no montage can be dominated by a
+  later one, so each montage is only compared against the front found so far
+  (vectorized over chunks of montages), which scales to millions of rows.
+- Weighted score: the weighted mean of the objectives normalized to [0, 1] (1 best),
+  and the top-K montages by score (of the Pareto front by default).
+
+ranking.csv lists the Pareto front and the top-K montages. selected_meshes.txt lists
+the mesh files of the top-K montages, for mesh-selector.sh to keep (or export from
+TI_results.hdf5):
+
+    python3 montage_ranking.py <opt_dir> [--objective TImax:max FocalityValue_50:min ...]
+                               [--weights 2 1 1] [--top-k 10] [--all]
+'''
+
+DEFAULT_OBJECTIVES = ('TImax:max', 'FocalityValue_50:min', 'PercentileValue_99.9:min')
+DEFAULT_TOP_K = 10
+RANKING_FILENAME = 'ranking.csv'
+MESH_LIST_FILENAME = 'selected_meshes.txt'
+# Montages compared against the front at once, and front rows they are compared with at once
+CHUNK_SIZE = 4096
+FRONT_BLOCK = 8
+
+# Define color variables
+RESET = '\033[0m'
+RED = '\033[0;31m'     # Red for errors
+GREEN = '\033[0;32m'   # Green for success messages and prompts
+CYAN = '\033[0;36m'    # Cyan for actions being performed
+
+
+def parse_objective(objective):
+    """Splits 'metric:max' or 'metric:min' into (metric, sign), sign +1 for max and -1 for min."""
+    name, _, direction = objective.rpartition(':')
+    if direction not in ('max', 'min') or not name:
+        raise ValueError(f"Objective {objective!r} must be <metric>:max or <metric>:min")
+    return name, 1.0 if direction == 'max' else -1.0
+
+
+def normalize(values, signs):
+    """Objectives (N x D) scaled to [0, 1] per column, with 1 the best value of each objective."""
+    oriented = values * signs
+    low, high = oriented.min(axis=0), oriented.max(axis=0)
+    span = np.where(high > low, high - low, 1.0)
+    return (oriented - low) / span
+
+
+def pareto_front(values, signs, chunk_size=CHUNK_SIZE):
+    """
+    indices of the non-dominated rows
+
+    Parameters
+    ----------
+    values : np.ndarray (N x D)
+        objective values, without NaN
+    signs : np.ndarray (D,)
+        +1 for objectives to maximize, -1 to minimize
+
+    Returns
+    -------
+    front : np.ndarray
+        indices of the rows on the Pareto front, sorted
+    """
+    if len(values) == 0:
+        return np.array([], dtype=int)
+    # Minimization form; a row that dominates another comes first when sorting by the normalized sum
+    # (higher is better), with ties broken lexicographically
+    costs = -values * signs
+    keys = tuple(costs[:, d] for d in reversed(range(costs.shape[1]))) + (-normalize(values, signs).sum(axis=1),)
+    order = np.lexsort(keys)
+    front = np.empty((0, costs.shape[1]))
+    front_idx = []
+    for start in range(0, len(order), chunk_size):
+        idx = order[start:start + chunk_size]
+        chunk = costs[idx]
+        # Rows dominated by the front found so far; the first front rows (best sums) dominate most
+        # rows, so the front is compared in blocks and dominated rows are dropped after each block
+        for f in range(0, len(front), FRONT_BLOCK):
+            if not len(idx):
+                break
+            block = front[f:f + FRONT_BLOCK]
+            dominated = np.any(np.all(block[None, :, :] <= chunk[:, None, :], axis=2)
+                               & np.any(block[None, :, :] < chunk[:, None, :], axis=2), axis=1)
+            idx, chunk = idx[~dominated], chunk[~dominated]
+        # The remaining rows can only be dominated by earlier rows of the same chunk
+        accepted = []
+        for j in range(len(idx)):
+            if accepted:
+                earlier = chunk[accepted]
+                if np.any(np.all(earlier <= chunk[j], axis=1) & np.any(earlier < chunk[j], axis=1)):
+                    continue
+            accepted.append(j)
+        front = np.vstack([front, chunk[accepted]])
+        front_idx.extend(idx[accepted])
+    return np.sort(np.array(front_idx, dtype=int))
+
+
+def weighted_scores(values, signs, weights=None):
+    """Weighted mean of the normalized objectives (N,), higher is better."""
+    weights = np.ones(values.shape[1]) if weights is None else np.asarray(weights, dtype=float)
+    return normalize(values, signs) @ (weights / weights.sum())
+
+
+def top_k(scores, k, candidates=None):
+    """Indices of the k highest scores (among candidates), best first."""
+    candidates = np.arange(len(scores)) if candidates is None else np.asarray(candidates)
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+# Function to read the objective values of all montages from the results store
+def load_objectives(opt_dir, names):
+    with results_store.open_store(opt_dir) as store:
+        missing = [name for name in names if name not in store.metric_names()]
+        if missing:
+            raise KeyError(f"Metrics not in the results store: {', '.join(missing)}")
+        quadruples, rows = [], []
+        for quadruple, values in store.iter_rows(names):
+            quadruples.append(quadruple)
+            rows.append([np.nan if v is None else float(v) for v in values])
+    return quadruples, np.array(rows, dtype=float).reshape(-1, len(names))
+
+
+# Function to rank the montages of an optimization and write ranking.csv and selected_meshes.txt
+def rank_montages(opt_dir, objectives=DEFAULT_OBJECTIVES, weights=None, k=DEFAULT_TOP_K, pareto_only=True):
+    names, signs = zip(*(parse_objective(o) for o in objectives))
+    signs = np.array(signs)
+    quadruples, values = load_objectives(opt_dir, list(names))
+    complete = np.flatnonzero(~np.isnan(values).any(axis=1))
+    print(f"{CYAN}Ranking {len(complete)} montages with values for {', '.join(objectives)} "
+          f"({len(quadruples) - len(complete)} incomplete montages skipped)...{RESET}")
+    values = values[complete]
+
+    front = pareto_front(values, signs)
+    scores = weighted_scores(values, signs, weights)
+    best = top_k(scores, k, front if pareto_only else None)
+    print(f"{GREEN}{len(front)} montages on the Pareto front; top {len(best)} by weighted score selected.{RESET}")
+
+    rank = np.zeros(len(values), dtype=int)
+    rank[best] = np.arange(1, len(best) + 1)
+    on_front = np.zeros(len(values), dtype=bool)
+    on_front[front] = True
+    listed = np.union1d(front, best)
+    # Selected montages by rank, then the rest of the front by score
+    listed = listed[np.lexsort((-scores[listed], rank[listed], rank[listed] == 0))]
+
+    ranking_path = os.path.join(opt_dir, RANKING_FILENAME)
+    with open(ranking_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Mesh'] + list(names) + ['Score', 'ParetoFront', 'Rank'])
+        for i in listed:
+            writer.writerow([results_store.format_mesh_name(quadruples[complete[i]])] + list(values[i])
+                            + [round(float(scores[i]), 6), int(on_front[i]), rank[i] or ''])
+    mesh_list_path = os.path.join(opt_dir, MESH_LIST_FILENAME)
+    with open(mesh_list_path, 'w') as file:
+        for i in best:
+            e1p, e1m, e2p, e2m = quadruples[complete[i]]
+            file.write(f"TI_field_{e1p}_{e1m}_and_{e2p}_{e2m}.msh\n")
+    print(f"{GREEN}Ranking written to {ranking_path}; selected meshes listed in {mesh_list_path}.{RESET}")
+    return [quadruples[complete[i]] for i in best]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pareto front and weighted top-K ranking of the optimizer montages.')
+    parser.add_argument('opt_dir', help='Optimization directory (Simulations/opt_<subject>)')
+    parser.add_argument('--objective', nargs='+', default=list(DEFAULT_OBJECTIVES),
+                        help='Objectives as <metric>:max or <metric>:min (default: %(default)s)')
+    parser.add_argument('--weights', type=float, nargs='+', help='Weights of the objectives (default: equal)')
+    parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K,
+                        help='Number of montages selected by weighted score (default: %(default)s)')
+    parser.add_argument('--all', action='store_true',
+                        help='Select the top-K among all montages instead of the Pareto front')
+    args = parser.parse_args()
+
+    if args.weights is not None and len(args.weights) != len(args.objective):
+        print(f"{RED}Error: give one weight per objective.{RESET}")
+        sys.exit(1)
+    try:
+        rank_montages(args.opt_dir, args.objective, args.weights, args.top_k, not args.all)
+    except (KeyError, ValueError) as e:
+        print(f"{RED}Error: {e}{RESET}")
+        sys.exit(1)
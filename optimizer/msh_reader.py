@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import hashlib
+import mmap
+import os
+import numpy as np
+
+'''
+Lazy reader of Gmsh 2.2 .msh files
+
+mesh_io.read_msh parses the whole file (nodes, elements and every data block) even
+when only one field such as TImax is needed. MshFile instead scans the section
+headers once, recording where every section starts, and reads a named $ElementData or
+$NodeData block on request. For binary files the block is returned as a read-only
+NumPy view into a memory map of the file (no copy, no parsing); ASCII blocks are
+parsed on request. The node and element sections are skipped during the scan, so the
+geometry can be parsed once per subject (e.g. with mesh_io) and reused for every mesh;
+geometry_key hashes the raw node and element sections to tell when it changes.
+
+Usage:
+    with MshFile('TI_field_E001_E002_and_E003_E004.msh') as msh:
+        print(msh.fields)              # {'TImax': ('ElementData', 1, N_elm), ...}
+        TImax = msh.element_data('TImax')
+'''
+
+# Number of nodes of the Gmsh element types
+NODES_PER_ELEMENT = {1: 2, 2: 3, 3: 4, 4: 4, 5: 8, 6: 6, 7: 5, 8: 3, 9: 6, 10: 9, 11: 10, 15: 1}
+DATA_SECTIONS = ('ElementData', 'NodeData')
+
+
+class MshFile:
+    """
+    section index of a Gmsh 2.2 .msh file
+
+    Attributes
+    ----------
+    binary : bool
+    n_nodes, n_elements : int
+        counts from the $Nodes and $Elements headers
+    fields : dict
+        field name -> (section name, number of components, number of entries)
+    sections : list of (name, header, offset)
+        every section in file order; offset is where its data starts
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._mmap = None
+        self.n_nodes = 0
+        self.n_elements = 0
+        self.fields = {}
+        self.sections = []
+        self._blocks = {}
+        self._scan()
+
+    def _scan(self):
+        f = self._file
+        size = os.fstat(f.fileno()).st_size
+        self.binary = False
+        self.data_size = 8
+        while f.tell() < size:
+            line = f.readline().strip()
+            if not line.startswith(b'$') or line.startswith(b'$End'):
+                continue
+            name = line[1:].decode()
+            if name == 'MeshFormat':
+                version, file_type, data_size = f.readline().split()
+                if not version.startswith(b'2'):
+                    raise ValueError(f"{self.filename}: only Gmsh 2.x files are supported")
+                self.binary = file_type == b'1'
+                self.data_size = int(data_size)
+                if self.binary:
+                    one = np.frombuffer(f.read(4), dtype='<i4')[0]
+                    if one != 1:
+                        raise ValueError(f"{self.filename}: big-endian files are not supported")
+                self._skip_to_end(name)
+            elif name == 'Nodes':
+                self.n_nodes = int(f.readline())
+                self.sections.append((name, {'count': self.n_nodes}, f.tell()))
+                self._skip_records(name, self.n_nodes, 4 + 3 * self.data_size)
+            elif name == 'Elements':
+                self.n_elements = int(f.readline())
+                self.sections.append((name, {'count': self.n_elements}, f.tell()))
+                self._skip_elements()
+            elif name in DATA_SECTIONS:
+                header = self._read_data_header()
+                self.sections.append((name, header, f.tell()))
+                self.fields[header['name']] = (name, header['components'], header['count'])
+                self._blocks[header['name']] = (name, header, f.tell())
+                self._skip_records(name, header['count'], 4 + header['components'] * self.data_size)
+            else:
+                self.sections.append((name, {}, f.tell()))
+                self._skip_to_end(name)
+
+    def _read_data_header(self):
+        f = self._file
+        string_tags = [f.readline().strip().strip(b'"').decode() for _ in range(int(f.readline()))]
+        real_tags = [float(f.readline()) for _ in range(int(f.readline()))]
+        int_tags = [int(f.readline()) for _ in range(int(f.readline()))]
+        return {'name': string_tags[0] if string_tags else '', 'time': real_tags[0] if real_tags else 0.0,
+                'components': int_tags[1], 'count': int_tags[2]}
+
+    def _skip_records(self, name, count, record_size):
+        if self.binary:
+            self._file.seek(count * record_size, os.SEEK_CUR)
+        self._skip_to_end(name)
+
+    def _skip_elements(self):
+        f = self._file
+        if self.binary:
+            remaining = self.n_elements
+            while remaining > 0:
+                elm_type, n_follow, n_tags = np.frombuffer(f.read(12), dtype='<i4')
+                f.seek(int(n_follow) * 4 * (1 + int(n_tags) + NODES_PER_ELEMENT[int(elm_type)]), os.SEEK_CUR)
+                remaining -= int(n_follow)
+        self._skip_to_end('Elements')
+
+    def _skip_to_end(self, name):
+        end = ('$End' + name).encode()
+        for line in self._file:
+            if line.strip() == end:
+                return
+        raise ValueError(f"{self.filename}: section ${name} is not terminated")
+
+    def _map(self):
+        if self._mmap is None:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _records(self, name):
+        if name not in self._blocks:
+            raise KeyError(f"{self.filename} has no field {name}; available: {list(self.fields)}")
+        section, header, offset = self._blocks[name]
+        n, components = header['count'], header['components']
+        if self.binary:
+            dtype = np.dtype([('id', '<i4'), ('value', f'<f{self.data_size}', (components,))])
+            records = np.frombuffer(self._map(), dtype=dtype, count=n, offset=offset)
+            return records['id'], records['value']
+        self._file.seek(offset)
+        table = np.loadtxt(self._file, max_rows=n, ndmin=2)
+        return table[:, 0].astype(np.int64), table[:, 1:]
+
+    def field_data(self, name, elements=None):
+        """
+        values of a field, (N,) for scalars or (N x components)
+
+        Parameters
+        ----------
+        name : str
+        elements : np.ndarray, optional
+            0-based element (or node) indices to return instead of every entry
+        """
+        ids, values = self._records(name)
+        if values.shape[1] == 1:
+            values = values[:, 0]
+        if elements is None:
+            return values
+        elements = np.asarray(elements)
+        # Entries are normally stored in element order (id = index + 1); otherwise look the ids up
+        if len(ids) > (elements.max(initial=-1)) and np.array_equal(ids[elements], elements + 1):
+            return values[elements]
+        order = np.argsort(ids)
+        positions = order[np.searchsorted(ids, elements + 1, sorter=order)]
+        return values[positions]
+
+    def element_data(self, name, elements=None):
+        """Values of an $ElementData field (see field_data)."""
+        if self.fields.get(name, (None,))[0] != 'ElementData':
+            raise KeyError(f"{self.filename} has no element field {name}")
+        return self.field_data(name, elements)
+
+    def node_data(self, name, nodes=None):
+        """Values of a $NodeData field (see field_data)."""
+        if self.fields.get(name, (None,))[0] != 'NodeData':
+            raise KeyError(f"{self.filename} has no node field {name}")
+        return self.field_data(name, nodes)
+
+    def geometry_key(self):
+        """Hash of the raw $Nodes and $Elements sections, equal for meshes with the same geometry."""
+        data = self._map()
+        h = hashlib.blake2b(digest_size=12)
+        for name, _, offset in self.sections:
+            if name in ('Nodes', 'Elements'):
+                end = data.find(('$End' + name).encode(), offset)
+                with memoryview(data) as view:
+                    h.update(view[offset:end])
+        return h.hexdigest()
+
+    def close(self):
+        # Views returned by field_data keep the memory map alive until they are released
+        self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def list_fields(filename):
+    """Field names of a .msh file by section, read from the section headers only."""
+    with MshFile(filename) as msh:
+        return {section: [name for name, (s, _, _) in msh.fields.items() if s == section]
+                for section in DATA_SECTIONS}
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import os
+import re
+import sqlite3
+import sys
+import time
+
+'''
+Optimized for optimizer pipeline
+
+This module implements the results store of an optimization (results.sqlite in
+Simulations/opt_<subject>). Every stage writes its values into it, keyed by the
+electrode quadruple, instead of update_output_csv.py merging output.csv and
+summary.csv on rebuilt mesh names:
+
+- ti_sim.py (ROI, top-K and evolve modes and the summary metrics) and roi-analyzer.py
+  upsert the ROI values (TImax, TImax_<roi>, CurrentRatio)
+- ti_sim.py --metrics and mesh_metrics.py upsert the summary.csv metrics
+
+Values are stored in a narrow table (one row per montage and metric), so a new metric
+adds rows instead of rewriting a wide table, and an upsert only touches the rows of
+its montages. A stage that rewrites its CSV file clears the metrics it writes first, so
+montages of an earlier run do not keep stale values, while the metrics of the other
+stages are kept. The time of the last write of every metric is recorded, so a CSV file
+written without the store (e.g. summary.csv by MATLAB) is imported again once it is newer
+than the stored values. CSV files are exported from the store:
+
+    python3 results_store.py <opt_dir> --csv output.csv TImax PercentileValue_95 ...
+    python3 results_store.py <opt_dir> --list
+'''
+
+STORE_FILENAME = 'results.sqlite'
+MESH_NAME_PATTERN = re.compile(r'(?:TI_field_)?([^_\s]+)_([^_\s]+)(?:_and_| <> )([^_\s]+)_([^_\s]+?)(?:\.msh)?')
+# Rows per transaction of the bulk upserts
+BATCH_SIZE = 10000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS montages (
+    id INTEGER PRIMARY KEY,
+    e1_plus TEXT NOT NULL, e1_minus TEXT NOT NULL, e2_plus TEXT NOT NULL, e2_minus TEXT NOT NULL,
+    UNIQUE (e1_plus, e1_minus, e2_plus, e2_minus)
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    montage_id INTEGER NOT NULL REFERENCES montages (id),
+    name TEXT NOT NULL,
+    value,
+    PRIMARY KEY (montage_id, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS metrics_by_name ON metrics (name, value);
+CREATE TABLE IF NOT EXISTS metric_writes (
+    name TEXT PRIMARY KEY,
+    written REAL NOT NULL
+);
+'''
+
+
+def parse_mesh_name(name):
+    """
+    electrode quadruple of a mesh name, None if it does not name a montage
+
+    Accepts mesh file names (TI_field_E001_E002_and_E003_E004.msh) and output.csv
+    mesh names (E001_E002 <> E003_E004).
+    """
+    match = MESH_NAME_PATTERN.fullmatch(os.path.basename(name))
+    return match.groups() if match else None
+
+
+def format_mesh_name(quadruple):
+    """output.csv mesh name of an electrode quadruple ("E001_E002 <> E003_E004")."""
+    e1p, e1m, e2p, e2m = quadruple
+    return f"{e1p}_{e1m} <> {e2p}_{e2m}"
+
+
+def store_path(opt_dir):
+    return os.path.join(opt_dir, STORE_FILENAME)
+
+
+class ResultsStore:
+    """
+    montage results of an optimization, in an SQLite file
+
+    Use as a context manager; changes are committed on exit and after every batch
+    of BATCH_SIZE rows.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = sqlite3.connect(filename)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+
+    def upsert(self, rows):
+        """
+        inserts or updates montage values
+
+        Parameters
+        ----------
+        rows : iterable of (quadruple, dict)
+            electrode quadruple (E1+, E1-, E2+, E2-) and metric name -> value; None
+            and '' (e.g. a ROI outside the mesh) are stored as NULL
+
+        Returns
+        -------
+        number of montages written
+        """
+        n_rows = 0
+        montages, values = [], []
+        for quadruple, metrics in rows:
+            quadruple = tuple(str(e) for e in quadruple)
+            montages.append(quadruple)
+            values.extend(quadruple + (name, None if value == '' else value) for name, value in metrics.items())
+            n_rows += 1
+            if len(montages) >= BATCH_SIZE:
+                self._write(montages, values)
+                montages, values = [], []
+        self._write(montages, values)
+        return n_rows
+
+    def _write(self, montages, values):
+        with self._db:
+            self._db.executemany('INSERT OR IGNORE INTO montages (e1_plus, e1_minus, e2_plus, e2_minus) '
+                                 'VALUES (?, ?, ?, ?)', montages)
+            self._db.executemany(
+                'INSERT INTO metrics (montage_id, name, value) VALUES ((SELECT id FROM montages WHERE '
+                'e1_plus = ? AND e1_minus = ? AND e2_plus = ? AND e2_minus = ?), ?, ?) '
+                'ON CONFLICT (montage_id, name) DO UPDATE SET value = excluded.value', values)
+            written = time.time()
+            self._db.executemany('INSERT INTO metric_writes (name, written) VALUES (?, ?) '
+                                 'ON CONFLICT (name) DO UPDATE SET written = excluded.written',
+                                 [(name, written) for name in {value[4] for value in values}])
+
+    def clear(self, names=None):
+        """Deletes the values of the given metrics (all metrics and montages by default)."""
+        with self._db:
+            if names is None:
+                self._db.execute('DELETE FROM metrics')
+                self._db.execute('DELETE FROM montages')
+                self._db.execute('DELETE FROM metric_writes')
+            else:
+                self._db.executemany('DELETE FROM metrics WHERE name = ?', [(name,) for name in names])
+                self._db.executemany('DELETE FROM metric_writes WHERE name = ?', [(name,) for name in names])
+
+    def metric_names(self):
+        """Names of the stored metrics."""
+        return [name for name, in self._db.execute('SELECT DISTINCT name FROM metrics ORDER BY name')]
+
+    def written(self, names):
+        """Time (seconds since the epoch) of the last write of each of the given metrics that is stored."""
+        query = f'SELECT name, written FROM metric_writes WHERE name IN ({", ".join("?" * len(names))})'
+        return dict(self._db.execute(query, list(names)))
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM montages').fetchone()[0]
+
+    def iter_rows(self, metrics, require=None):
+        """
+        yields (quadruple, [value of each metric]) in insertion order
+
+        Parameters
+        ----------
+        metrics : list of str
+        require : str, optional
+            only montages with an entry (possibly NULL) for this metric
+        """
+        columns = ', '.join('MAX(CASE WHEN x.name = ? THEN x.value END)' for _ in metrics)
+        query = (f'SELECT m.e1_plus, m.e1_minus, m.e2_plus, m.e2_minus, {columns} FROM montages m '
+                 f'JOIN metrics x ON x.montage_id = m.id GROUP BY m.id')
+        params = list(metrics)
+        if require is not None:
+            query += ' HAVING SUM(x.name = ?) > 0'
+            params.append(require)
+        for row in self._db.execute(query + ' ORDER BY m.id', params):
+            yield row[:4], list(row[4:])
+
+    def export_csv(self, csv_path, metrics, require=None):
+        """Writes a Mesh column and one column per metric to a CSV file; returns the number of rows."""
+        n_rows = 0
+        with open(csv_path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['Mesh'] + list(metrics))
+            for quadruple, values in self.iter_rows(metrics, require):
+                writer.writerow([format_mesh_name(quadruple)] + ['' if v is None else v for v in values])
+                n_rows += 1
+        return n_rows
+
+    def import_csv(self, csv_path, name_column, exclude=()):
+        """Upserts the rows of a CSV file (e.g. a summary.csv written by MATLAB); returns the number of rows."""
+        skip = {name_column, *exclude}
+        with open(csv_path, 'r', newline='') as file:
+            reader = csv.DictReader(file)
+            rows = ((parse_mesh_name(row[name_column]), {k: _number(v) for k, v in row.items() if k not in skip})
+                    for row in reader)
+            return self.upsert((quadruple, metrics) for quadruple, metrics in rows if quadruple is not None)
+
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def open_store(opt_dir):
+    """Opens (creating it if needed) the results store of an optimization directory."""
+    return ResultsStore(store_path(opt_dir))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the montage results of an optimization.')
+    parser.add_argument('opt_dir', help='Optimization directory (Simulations/opt_<subject>)')
+    parser.add_argument('metrics', nargs='*', help='Metrics to export (default: all)')
+    parser.add_argument('--csv', help='CSV file to write')
+    parser.add_argument('--require', help='Only export montages with an entry for this metric')
+    parser.add_argument('--list', action='store_true', help='List the stored metrics')
+    args = parser.parse_args()
+
+    if not os.path.exists(store_path(args.opt_dir)):
+        print(f"Error: {store_path(args.opt_dir)} does not exist.")
+        sys.exit(1)
+    with open_store(args.opt_dir) as store:
+        if args.list or not args.csv:
+            print(f"{len(store)} montages; metrics: {', '.join(store.metric_names())}")
+        if args.csv:
+            n_rows = store.export_csv(args.csv, args.metrics or store.metric_names(), args.require)
+            print(f"{n_rows} montages written to {args.csv}")
@@ -1,12 +1,18 @@
-
 #!/usr/bin/env python3
 
+import argparse
 import os
 import re
-import pandas as pd
-import subprocess
 import json
 import csv
+import multiprocessing as mp
+from simnibs import mesh_io
+import element_locator
+import mesh_geometry
+import msh_reader
+import results_store
+import roi_scoring
+import ti_parallel
 
 
 '''
@@ -14,119 +20,235 @@ Ido Haber - ihaber@wisc.edu
 October 3, 2024
 Optimized for optimizer pipeline
 
-This script analyzes mesh files in the simulation directory by extracting 
+This script analyzes mesh files in the simulation directory by extracting
 fields at specific ROI coordinates and compiling the results into a structured format.
 
 Key Features:
-- Reads ROI files and extracts TImax and TInorm values from mesh files.
-- Stores the results in a JSON file for easy access and further analysis.
-- Formats the extracted data and writes it to a CSV file for reporting.
-- Performs cleanup by removing intermediate CSV files after processing.
+- Reads ROI files and extracts TImax values from mesh files.
+- Interpolates in-process: the ROI coordinates are located once per mesh geometry
+  (KD-tree over the tetrahedron barycenters, see element_locator.py) and the 'linear'
+  interpolation of get_fields_at_coordinates is applied to every mesh as a weighted sum
+  of a few element values (see roi_scoring.py). No subprocesses or temporary CSVs.
+- Only the geometry of the first mesh is parsed; of every mesh, only the TImax values
+  of the elements used by the interpolation are read (see msh_reader.py).
+- With --workers N, the mesh files are spread over N worker processes.
+- Streams the results: each mesh is appended to output.csv and to the progress file
+  (roi_progress.jsonl) as soon as it is analyzed, so memory does not grow with the
+  number of meshes. An interrupted run resumes after the meshes listed in the progress
+  file, unless they were rewritten since (use --restart to analyze all meshes again).
+- Writes mesh_data.json from the progress file at the end of the run.
+- Upserts the ROI values into the results store of the directory (results_store.py) in
+  batches of STORE_BATCH meshes.
+
+Usage:
+    simnibs_python roi-analyzer.py [roi_dir] [--workers N] [--restart]
+    (roi_dir defaults to $PROJECT_DIR/Subjects/m2m_$SUBJECT_NAME/ROIs)
 '''
 
-# Get the project directory and subject name from environment variables
-project_dir = os.getenv('PROJECT_DIR')
-subject_name = os.getenv('SUBJECT_NAME')
-
-# Set the directories based on project directory and subject name
-opt_directory = os.path.join(project_dir, f'Simulations/opt_{subject_name}')
-roi_directory = os.path.join(project_dir, f'Subjects/m2m_{subject_name}/ROIs')
-
-# Read the list of ROI files from the correct ROI directory
-roi_list_path = os.path.join(roi_directory, 'roi_list.txt')
-with open(roi_list_path, 'r') as file:
-    position_files = [line.strip() for line in file]
-
-# Create a dictionary to hold the data
-mesh_data = {}
-
-# Get the list of .msh files in the opt directory and count the total number
-msh_files = [f for f in os.listdir(opt_directory) if f.endswith('.msh')]
-total_files = len(msh_files)  # Total number of files to process
-
-# Iterate over all .msh files in the opt directory with progress indicator
-for i, msh_file in enumerate(msh_files):
-    msh_file_path = os.path.join(opt_directory, msh_file)
-
-    # Progress indicator (formatted as 001/100)
-    progress_str = f"{i+1:03}/{total_files}"
-    print(f"{progress_str} Processing {msh_file_path}")
-    
-    # Use only the file name part for mesh_key
-    mesh_key = os.path.basename(msh_file_path)
-    mesh_data[mesh_key] = {}
-
-    # Iterate over all position files
-    for pos_file in position_files:
-        pos_base = os.path.splitext(os.path.basename(pos_file))[0]  # Extract the base name of the position file without extension
-        print(f"  Using position file {pos_file}")
-
-        # Run the command to generate CSV files in the ROI directory
-        try:
-            print(f"Running command: get_fields_at_coordinates -s {pos_file} -m {msh_file_path} --method linear")
-            subprocess.run(["get_fields_at_coordinates", "-s", pos_file, "-m", msh_file_path, "--method", "linear"], check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Error running get_fields_at_coordinates: {e}")
-            continue
-        
-        # The generated CSV files will be in the ROI directory with names based on the position file and field names
-        ti_max_csv = os.path.join(roi_directory, f"{pos_base}_TImax.csv")
-        from_volume_csv = os.path.join(roi_directory, f"{pos_base}_from_volume.csv")
-        
-        # Process the TImax CSV file
-        if os.path.exists(ti_max_csv):
-            print(f"Found TImax CSV file: {ti_max_csv}")
-            try:
-                # Read the CSV file into a dataframe without headers
-                df_ti_max = pd.read_csv(ti_max_csv, header=None)
-                
-                # Ensure all data can be converted to float
-                df_ti_max = df_ti_max.apply(pd.to_numeric, errors='coerce')
-                df_ti_max = df_ti_max.dropna()  # Drop rows with non-numeric data
-                
-                # Extract values from the dataframe
-                ti_max_values = df_ti_max[0].tolist()  # Assuming the TImax CSV has values in the first column
-                
-                # Store the values in the dictionary
-                if 'TImax' not in mesh_data[mesh_key]:
-                    mesh_data[mesh_key]['TImax'] = ti_max_values[0] if ti_max_values else None
-            except Exception as e:
-                print(f"Error processing TImax file {ti_max_csv}: {e}")
-            finally:
-                os.remove(ti_max_csv)
-        else:
-            print(f"    TImax CSV file {ti_max_csv} not found. Skipping this file.")
-
-
-# Save the dictionary to a file for later use
-json_output_path = os.path.join(opt_directory, 'mesh_data.json')
-with open(json_output_path, 'w') as json_file:
-    json.dump(mesh_data, json_file, indent=4)
-
-print(f"Dictionary saved to {json_output_path}")
-
-# Prepare the CSV data
-header = ['Mesh', 'TImax']
-csv_data = [header]
-
-for mesh_name, data in mesh_data.items():
-    # Format the mesh name as "E076_E172 <> E097_E162"
+PROGRESS_FILENAME = 'roi_progress.jsonl'
+# Meshes per upsert into the results store
+STORE_BATCH = 100
+
+# State of the process analyzing meshes (a worker, or the main process in a serial run)
+_analyzer = {}
+
+
+# Function to set up the analysis state of a process
+def init_analyzer(roi_names, roi_coordinates, geometry_store):
+    _analyzer.update(roi_names=roi_names, roi_coordinates=roi_coordinates, geometry_store=geometry_store,
+                     geometry_key=None)
+
+
+# Function to interpolate TImax at the ROI coordinates of one mesh; returns (mesh file name, mtime, values)
+def analyze_mesh(msh_file_path):
+    mtime_ns = os.stat(msh_file_path).st_mtime_ns
+    with msh_reader.MshFile(msh_file_path) as msh:
+        return os.path.basename(msh_file_path), mtime_ns, interpolate_rois(msh_file_path, msh)
+
+
+# Function to interpolate TImax at the ROI coordinates of a mesh file opened with msh_reader
+def interpolate_rois(msh_file_path, msh):
+    state = _analyzer
+    roi_names = state['roi_names']
+
+    # Interpolation weights of the ROI coordinates, recomputed only when the mesh geometry changes
+    # (all meshes of an optimization share the leadfield mesh)
+    geometry_key = msh.geometry_key()
+    if geometry_key != state['geometry_key']:
+        state['geometry_key'] = geometry_key
+        mesh = mesh_io.read_msh(msh_file_path)
+        geometry = mesh_geometry.get_geometry(mesh, state['geometry_store'])
+        locator = element_locator.ElementLocator.from_mesh(mesh, geometry.centroids)
+        state['support'], state['weights'], state['inside'] = roi_scoring.get_interpolation_weights(
+            mesh, state['roi_coordinates'], locator, geometry.volumes)
+        for name, is_inside in zip(roi_names, state['inside']):
+            if not is_inside:
+                print(f"  ROI {name} lies outside the mesh; its TImax is left empty.")
+
+    data = {}
+    if 'TImax' not in msh.fields:
+        print(f"  No TImax field in {os.path.basename(msh_file_path)}. Skipping this file.")
+        return data
+    values = state['weights'] @ msh.element_data('TImax', state['support'])
+
+    # TImax holds the first ROI; further ROIs get their own entries
+    for j, name in enumerate(roi_names):
+        value = float(values[j]) if state['inside'][j] else None
+        if j == 0:
+            data['TImax'] = value
+        if len(roi_names) > 1:
+            data[f'TImax_{name}'] = value
+    return data
+
+
+# Function to format the mesh name as "E076_E172 <> E097_E162"
+def format_mesh_name(mesh_name):
     parts = re.findall(r'E\d{3}_E\d{3}', mesh_name)
     if len(parts) == 2:
-        formatted_mesh_name = f"{parts[0]} <> {parts[1]}"
-    else:
-        formatted_mesh_name = mesh_name  # Fallback to the original name if the pattern doesn't match
-    
-    ti_max_value = data.get('TImax', '')
-    
-    row = [formatted_mesh_name, ti_max_value]
-    csv_data.append(row)
-
-# Write to CSV file
-csv_output_path = os.path.join(opt_directory, 'output.csv')
-with open(csv_output_path, 'w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerows(csv_data)
-
-print(f'CSV file created successfully at {csv_output_path}.')
+        return f"{parts[0]} <> {parts[1]}"
+    return mesh_name  # Fallback to the original name if the pattern doesn't match
+
 
+def csv_row(header, mesh_name, data):
+    return [format_mesh_name(mesh_name)] + ['' if data.get(column) is None else data[column]
+                                            for column in header[1:]]
+
+
+# Function to yield the (mesh file name, mtime, values) entries of a progress file
+# A last line cut off by an interruption is ignored
+def read_progress(progress_path):
+    if not os.path.exists(progress_path):
+        return
+    with open(progress_path, 'r') as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            yield entry['mesh'], entry['mtime_ns'], entry['data']
+
+
+def progress_line(mesh_name, mtime_ns, data):
+    return json.dumps({'mesh': mesh_name, 'mtime_ns': mtime_ns, 'data': data}) + '\n'
+
+
+# Function to start output.csv and the progress file, keeping the meshes already analyzed
+# Entries of meshes that were removed or rewritten since (different mtime) are dropped
+# Returns the set of analyzed mesh file names
+def resume_progress(progress_path, csv_output_path, header, mtimes, restart):
+    done = set()
+    tmp = progress_path + '.tmp'
+    with open(tmp, 'w') as progress, open(csv_output_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(header)
+        if not restart:
+            for mesh_name, mtime_ns, data in read_progress(progress_path):
+                if mesh_name in done or mtimes.get(mesh_name) != mtime_ns:
+                    continue
+                done.add(mesh_name)
+                progress.write(progress_line(mesh_name, mtime_ns, data))
+                writer.writerow(csv_row(header, mesh_name, data))
+    os.replace(tmp, progress_path)
+    return done
+
+
+# Function to yield the (quadruple, values) of the montage meshes among (mesh file name, values) pairs
+def store_rows(entries):
+    for mesh_name, data in entries:
+        quadruple = results_store.parse_mesh_name(mesh_name)
+        if quadruple is not None:
+            yield quadruple, data
+
+
+# Function to write mesh_data.json from the progress file, one entry at a time
+def write_mesh_data(progress_path, json_output_path):
+    tmp = json_output_path + '.tmp'
+    with open(tmp, 'w') as json_file:
+        json_file.write('{')
+        for n, (mesh_name, _, data) in enumerate(read_progress(progress_path)):
+            json_file.write((',' if n else '') + f'\n    {json.dumps(mesh_name)}: {json.dumps(data)}')
+        json_file.write('\n}\n')
+    os.replace(tmp, json_output_path)
+
+
+# Function to yield the results of all mesh files, in a pool of worker processes if workers > 1
+def iter_analyzed_meshes(msh_file_paths, workers, roi_names, roi_coordinates, geometry_store):
+    if workers <= 1:
+        init_analyzer(roi_names, roi_coordinates, geometry_store)
+        yield from map(analyze_mesh, msh_file_paths)
+        return
+    # One BLAS thread per worker; the results come back in the order of the mesh files
+    ctx = mp.get_context('spawn')
+    chunksize = max(1, len(msh_file_paths) // (4 * workers))
+    with ti_parallel.thread_limit(1), ctx.Pool(workers, initializer=init_analyzer,
+                                               initargs=(roi_names, roi_coordinates, geometry_store)) as pool:
+        yield from pool.imap(analyze_mesh, msh_file_paths, chunksize)
+
+
+def main(roi_directory=None, workers=1, restart=False):
+    # Get the project directory and subject name from environment variables
+    project_dir = os.getenv('PROJECT_DIR')
+    subject_name = os.getenv('SUBJECT_NAME')
+
+    # Set the directories based on project directory and subject name
+    opt_directory = os.path.join(project_dir, f'Simulations/opt_{subject_name}')
+    roi_directory = roi_directory or os.path.join(project_dir, f'Subjects/m2m_{subject_name}/ROIs')
+    geometry_store = mesh_geometry.geometry_dir(os.path.join(project_dir, f'Subjects/m2m_{subject_name}'))
+
+    # Read the ROI names and coordinates listed in roi_list.txt
+    roi_names, roi_coordinates = roi_scoring.read_roi_coordinates(roi_directory)
+
+    header = ['Mesh', 'TImax']
+    if len(roi_names) > 1:
+        header += [f'TImax_{name}' for name in roi_names]
+    # Get the list of .msh files in the opt directory and count the total number
+    msh_files = sorted(f for f in os.listdir(opt_directory) if f.endswith('.msh'))
+    total_files = len(msh_files)  # Total number of files to process
+    mtimes = {f: os.stat(os.path.join(opt_directory, f)).st_mtime_ns for f in msh_files}
+
+    csv_output_path = os.path.join(opt_directory, 'output.csv')
+    progress_path = os.path.join(opt_directory, PROGRESS_FILENAME)
+    done = resume_progress(progress_path, csv_output_path, header, mtimes, restart)
+    pending = [os.path.join(opt_directory, f) for f in msh_files if f not in done]
+    if done:
+        print(f"Resuming: {total_files - len(pending)} of {total_files} meshes already analyzed.")
+
+    # The store holds the ROI values of the meshes in the progress file, then of every mesh analyzed
+    store = results_store.open_store(opt_directory)
+    store.clear(header[1:])
+    store.upsert(store_rows((mesh_name, data) for mesh_name, _, data in read_progress(progress_path)))
+    batch = []
+
+    with store, open(csv_output_path, 'a', newline='') as csv_file, open(progress_path, 'a') as progress:
+        writer = csv.writer(csv_file)
+        results = iter_analyzed_meshes(pending, workers, roi_names, roi_coordinates, geometry_store)
+        for i, (mesh_name, mtime_ns, data) in enumerate(results, start=total_files - len(pending)):
+            # Progress indicator (formatted as 001/100)
+            print(f"{i+1:03}/{total_files} Processed {mesh_name}")
+            writer.writerow(csv_row(header, mesh_name, data))
+            csv_file.flush()
+            progress.write(progress_line(mesh_name, mtime_ns, data))
+            progress.flush()
+            batch.append((mesh_name, data))
+            if len(batch) >= STORE_BATCH:
+                store.upsert(store_rows(batch))
+                batch = []
+        store.upsert(store_rows(batch))
+
+    print(f'CSV file created successfully at {csv_output_path}.')
+
+    # Save the dictionary to a file for later use
+    json_output_path = os.path.join(opt_directory, 'mesh_data.json')
+    write_mesh_data(progress_path, json_output_path)
+    print(f"Dictionary saved to {json_output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Interpolate TImax at the ROI coordinates of all optimizer meshes.')
+    parser.add_argument('roi_dir', nargs='?', default=None,
+                        help='ROI directory with roi_list.txt (default: the ROIs of the subject in PROJECT_DIR)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (default: %(default)s)')
+    parser.add_argument('--restart', action='store_true',
+                        help='Analyze all meshes again instead of resuming from the progress file')
+    args = parser.parse_args()
+    main(args.roi_dir, args.workers, args.restart)
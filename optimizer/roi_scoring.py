@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import csv
+import os
+import warnings
+import numpy as np
+import ti_engine
+import ti_parallel
+
+'''
+Optimized for optimizer pipeline
+
+This module implements the in-memory ROI scoring mode of ti_sim.py (--mode roi).
+Instead of writing one mesh per electrode combination and interpolating TImax at
+the ROI coordinates afterwards (roi-analyzer.py + get_fields_at_coordinates), the
+linear interpolation at every ROI coordinate is expressed once as a weighted sum
+over a handful of leadfield elements. TImax is then evaluated on those elements
+only, for every combination, and written directly to output.csv.
+
+The interpolation reproduces the 'linear' method of get_fields_at_coordinates for
+element data: element values are averaged to the nodes (weighted by element volume,
+using only elements of the same tissue as the element containing the point) and
+then interpolated with the barycentric coordinates of the point.
+
+Optionally, every combination is scored for a grid of current ratios between the two
+pairs (same total current) from the same pair fields, and the best ratio is recorded.
+'''
+
+
+# Function to read the ROI names and coordinates listed in roi_list.txt
+def read_roi_coordinates(roi_directory):
+    roi_list_path = os.path.join(roi_directory, 'roi_list.txt')
+    with open(roi_list_path, 'r') as file:
+        position_files = [line.strip() for line in file if line.strip()]
+
+    roi_names = []
+    coordinates = []
+    for pos_file in position_files:
+        if not os.path.isabs(pos_file):
+            pos_file = os.path.join(roi_directory, pos_file)
+        with open(pos_file, 'r') as file:
+            row = next(csv.reader(file))
+        roi_names.append(os.path.splitext(os.path.basename(pos_file))[0])
+        coordinates.append([float(c) for c in row[:3]])
+    return roi_names, np.array(coordinates, dtype=float).reshape(-1, 3)
+
+
+def compute_interpolation_weights(tetrahedra, tags, volumes, th_indices, bar):
+    """
+    expresses the linear interpolation of element data at points as weights
+
+    Parameters
+    ----------
+    tetrahedra : np.ndarray (M x 4)
+        node indices (0-based) of each element; rows of non-tetrahedral elements
+        are never used as containing elements
+    tags : np.ndarray (M,)
+        tissue tag of each element
+    volumes : np.ndarray (M,)
+        volume of each element
+    th_indices : np.ndarray (P,)
+        index (0-based) of the tetrahedron containing each point, -1 if outside
+    bar : np.ndarray (P x 4)
+        barycentric coordinates of each point in its tetrahedron
+
+    Returns
+    -------
+    support : np.ndarray (K,)
+        indices of the elements that contribute to any of the points
+    weights : np.ndarray (P x K)
+        value at point p = weights[p] @ element_values[support];
+        rows of points outside the mesh are all zero
+    inside : np.ndarray (P,) of bool
+        points that lie inside the mesh
+    """
+    th_indices = np.asarray(th_indices)
+    inside = th_indices >= 0
+    n_points = len(th_indices)
+
+    nodes = np.unique(tetrahedra[th_indices[inside]])
+    candidates = np.flatnonzero(np.isin(tetrahedra, nodes).any(axis=1))
+
+    rows, cols, vals = [], [], []
+    for p in np.flatnonzero(inside):
+        th = th_indices[p]
+        same_tissue = candidates[tags[candidates] == tags[th]]
+        for node, b in zip(tetrahedra[th], bar[p]):
+            around = same_tissue[(tetrahedra[same_tissue] == node).any(axis=1)]
+            w = volumes[around] / volumes[around].sum()
+            rows.extend([p] * len(around))
+            cols.extend(around)
+            vals.extend(b * w)
+
+    support, cols = np.unique(np.asarray(cols, dtype=int), return_inverse=True)
+    weights = np.zeros((n_points, len(support)))
+    np.add.at(weights, (np.asarray(rows, dtype=int), cols), vals)
+    return support, weights, inside
+
+
+# Function to compute the interpolation weights of the ROI coordinates on a mesh
+# The points are located with an element_locator.ElementLocator if one is given (e.g. shared by all
+# meshes of a subject) and the element volumes may come from the subject's geometry store
+def get_interpolation_weights(mesh, points, locator=None, volumes=None):
+    if locator is None:
+        th_indices, bar = mesh.find_tetrahedron_with_points(points, compute_baricentric=True)
+        th_indices = np.where(th_indices > 0, th_indices - 1, -1)
+    else:
+        th_indices, bar = locator.locate(points)
+    tetrahedra = mesh.elm.node_number_list - 1
+    if volumes is None:
+        volumes = mesh.elements_volumes_and_areas().value
+    return compute_interpolation_weights(tetrahedra, mesh.elm.tag1, volumes, th_indices, bar)
+
+
+def score_combinations(combinations, leadfield, idx_lf, intensity, support, weights, inside,
+                       block_size=ti_engine.DEFAULT_ROI_BLOCK_SIZE, workers=1, ratios=None):
+    """
+    Yields (index, combination, TImax at each ROI) for every combination.
+
+    TI_max is only evaluated on the support elements of the interpolation, so
+    large blocks of combinations fit in memory. With workers > 1 the combinations
+    are scored in chunks by worker processes (see ti_parallel.py), in the same order.
+
+    With a grid of current ratios (fraction of the total current carried by pair 1),
+    yields (index, combination, TImax at each ROI, ratio) instead, for the ratio
+    with the highest mean TImax over the ROIs inside the mesh.
+    """
+    if not np.any(inside):
+        warnings.warn("No ROI lies inside the mesh; the ROI values of every combination are NaN")
+    leadfield_roi = np.ascontiguousarray(leadfield[:, support, :])
+    if workers > 1:
+        state = dict(idx_lf=idx_lf, intensity=intensity, weights=weights, inside=inside, block_size=block_size,
+                     ratios=ratios)
+        chunks = ti_parallel.index_chunks(combinations, workers * 4)
+        results = ti_parallel.imap_chunks(_score_chunk, chunks, leadfield_roi, workers, state)
+        for (start, chunk), scores in zip(chunks, results):
+            for j, combination in enumerate(chunk):
+                yield (start + j, combination) + tuple(s[j] for s in scores)
+        return
+
+    # The pair fields on the support elements are small, so all of them stay cached
+    cache = ti_engine.PairFieldCache(leadfield_roi, idx_lf)
+    for start, block in ti_engine.iter_blocks(combinations, block_size):
+        scores = _score_block(block, leadfield_roi, idx_lf, intensity, weights, inside, cache, ratios)
+        for j, combination in enumerate(block):
+            yield (start + j, combination) + tuple(s[j] for s in scores)
+
+
+# Returns (values,) or, with current ratios, (values at the best ratio, best ratio) of a block
+def _score_block(block, leadfield_roi, idx_lf, intensity, weights, inside, cache=None, ratios=None):
+    # Without ROIs inside the mesh there is nothing to evaluate (and no best ratio)
+    if not inside.any():
+        values = np.full((len(block), len(inside)), np.nan)
+        return (values,) if ratios is None else (values, np.full(len(block), np.nan))
+    if ratios is None:
+        TImax_block = ti_engine.get_TImax_block(block, leadfield_roi, idx_lf, intensity, cache)
+        values = TImax_block @ weights.T
+        values[:, ~inside] = np.nan
+        return (values,)
+
+    fields, idx1, idx2 = ti_engine.get_block_fields(block, leadfield_roi, idx_lf, intensity, cache)
+    values = ti_engine.get_maxTI_ratios(fields[idx1], fields[idx2], ratios) @ weights.T  # ratios x block x ROIs
+    best = np.argmax(values[:, :, inside].mean(axis=2), axis=0)
+    values = values[best, np.arange(len(block))]
+    values[:, ~inside] = np.nan
+    return values, np.asarray(ratios)[best]
+
+
+# Worker task of the parallel ROI mode: scores one chunk of combinations
+def _score_chunk(chunk):
+    _, combinations = chunk
+    state = ti_parallel.worker_state()
+    cache = ti_engine.get_pair_cache(ti_parallel.worker_leadfield(), state['idx_lf'])
+    scores = [_score_block(block, ti_parallel.worker_leadfield(), state['idx_lf'], state['intensity'],
+                           state['weights'], state['inside'], cache, state['ratios'])
+              for _, block in ti_engine.iter_blocks(combinations, state['block_size'])]
+    return tuple(np.concatenate(s) for s in zip(*scores))
+
+
+# Function to format a combination the way output.csv names meshes ("E076_E172 <> E097_E162")
+def format_mesh_name(combination):
+    (e1p, e1m), (e2p, e2m) = combination
+    return f"{e1p}_{e1m} <> {e2p}_{e2m}"
+
+
+# Function to write the ROI values of all combinations to output.csv
+# With current_ratio, the results also hold the best current ratio of every combination
+# With a results_store.ResultsStore, the values are also upserted into the store, replacing the values of
+# these columns written by an earlier run
+def write_output_csv(csv_output_path, roi_names, results, current_ratio=False, store=None):
+    # TImax holds the first ROI, as written by roi-analyzer.py; further ROIs get their own columns
+    header = ['Mesh', 'TImax']
+    if len(roi_names) > 1:
+        header += [f'TImax_{name}' for name in roi_names]
+    if current_ratio:
+        header += ['CurrentRatio']
+
+    def write_rows(writer):
+        for _, combination, values, *ratio in results:
+            row = [format_mesh_name(combination)] + [_format_value(v) for v in values[:1]]
+            if len(roi_names) > 1:
+                row += [_format_value(v) for v in values]
+            if current_ratio:
+                row += ['' if np.isnan(ratio[0]) else round(float(ratio[0]), 6)]
+            writer.writerow(row)
+            yield tuple(e for pair in combination for e in pair), dict(zip(header[1:], row[1:]))
+
+    if store is not None:
+        store.clear(header[1:])
+    with open(csv_output_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        rows = write_rows(writer)
+        n_rows = store.upsert(rows) if store is not None else sum(1 for _ in rows)
+    return n_rows
+
+
+def _format_value(value):
+    return '' if np.isnan(value) else float(value)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import multiprocessing as mp
+import os
+import ti_parallel
+
+'''
+Process pool for the FEM solves of the analyzer
+
+TI.py runs one run_simnibs session (two FEM solves) per montage. With a pool, the
+montages are solved concurrently, each in its own spawned process, while the number
+of processes is capped by:
+
+- the number of CPUs divided by the solver threads of each process, so that the
+  BLAS/OpenMP/MKL threads of the solvers do not oversubscribe the node
+- the available memory divided by the memory of one solve, so that concurrent solves
+  do not exhaust the node memory
+
+Each process is replaced after every montage (maxtasksperchild=1), so the memory of a
+solve is returned to the system before the next one starts.
+
+Environment variables read by the analyzer scripts:
+    TI_MAX_WORKERS       maximum number of concurrent montages (default 1, 0 for one per CPU)
+    TI_SOLVER_THREADS    solver threads per montage (default: CPUs / workers)
+    TI_SOLVE_MEMORY_GB   memory of one montage solve in GB (default 8)
+'''
+
+SOLVER_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                           'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+DEFAULT_SOLVE_MEMORY_GB = 8.0
+
+
+def available_memory_gb():
+    """Memory available for new processes in GB (MemAvailable, or the free pages if unknown)."""
+    try:
+        with open('/proc/meminfo') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024 ** 2
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024 ** 3
+    except (ValueError, OSError, AttributeError):
+        return float('inf')
+
+
+def plan_workers(n_jobs, max_workers=1, solver_threads=None, solve_memory_gb=DEFAULT_SOLVE_MEMORY_GB,
+                 cpus=None, memory_gb=None):
+    """
+    number of concurrent solves and solver threads per solve
+
+    Parameters
+    ----------
+    n_jobs : int
+        number of montages to solve
+    max_workers : int
+        upper bound on the concurrent solves, 0 for one per CPU
+    solver_threads : int, optional
+        threads per solve (default: the CPUs shared among the workers)
+    solve_memory_gb : float
+        memory of one solve
+    cpus, memory_gb : optional
+        CPUs and available memory of the node (detected by default)
+
+    Returns
+    -------
+    workers, threads : int
+    """
+    cpus = cpus or os.cpu_count() or 1
+    memory_gb = available_memory_gb() if memory_gb is None else memory_gb
+    workers = max_workers if max_workers and max_workers > 0 else cpus
+    if solver_threads:
+        workers = min(workers, cpus // solver_threads)
+    if solve_memory_gb and solve_memory_gb > 0:
+        workers = min(workers, int(memory_gb // solve_memory_gb))
+    workers = max(1, min(workers, n_jobs))
+    threads = solver_threads or max(1, cpus // workers)
+    return workers, threads
+
+
+def plan_from_environment(n_jobs):
+    """plan_workers with the TI_MAX_WORKERS, TI_SOLVER_THREADS and TI_SOLVE_MEMORY_GB settings."""
+    return plan_workers(n_jobs,
+                        max_workers=int(os.getenv('TI_MAX_WORKERS', '1')),
+                        solver_threads=int(os.getenv('TI_SOLVER_THREADS', '0')) or None,
+                        solve_memory_gb=float(os.getenv('TI_SOLVE_MEMORY_GB', DEFAULT_SOLVE_MEMORY_GB)))
+
+
+def _init_worker(threads, initializer, initargs):
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def imap_jobs(task, jobs, workers, threads, initializer=None, initargs=()):
+    """
+    runs task(*job) for every job, on a pool of spawned processes if workers > 1
+
+    Parameters
+    ----------
+    task : callable
+        top-level (picklable) function
+    jobs : list of tuples
+        arguments of each call
+    workers, threads : int
+        from plan_workers
+    initializer : callable, optional
+        top-level function run with initargs in every pool process before its job; a
+        serial run calls task in the calling process, which has set up its own state
+
+    Yields
+    ------
+    task(*job) for every job, in completion order
+    """
+    if workers <= 1:
+        for job in jobs:
+            yield task(*job)
+        return
+    # Spawned processes inherit the environment, read by the solvers when they are loaded
+    ctx = mp.get_context('spawn')
+    with ti_parallel.thread_limit(threads, SOLVER_THREAD_VARIABLES), \
+            ctx.Pool(workers, initializer=_init_worker, initargs=(threads, initializer, initargs),
+                     maxtasksperchild=1) as pool:
+        yield from pool.imap_unordered(_call, [(task, job) for job in jobs])
+
+
+def _call(task_job):
+    task, job = task_job
+    return task(*job)
@@ -26,6 +26,23 @@ YELLOW='\033[0;33m' #Yellow for warnings or important notices
 project_dir="/mnt/$PROJECT_DIR_NAME"
 subject_dir="$project_dir/Subjects"
 
+# Optimizer mode: 'mesh' writes one mesh per combination and analyzes them afterwards,
+# 'roi' scores the ROIs in memory and writes output.csv directly, 'topk' writes only the best
+# combinations found by the branch-and-bound search and 'evolve' the best montages found by the
+# genetic algorithm to output.csv (override with TI_SIM_MODE)
+ti_sim_mode="${TI_SIM_MODE:-mesh}"
+
+# TI_DEDUPLICATE=1 skips montages with the TI_max of another montage (pair polarity or pair order
+# swapped) and pairs of the same electrode, which also shortens output.csv (ti_sim.py --deduplicate)
+ti_sim_options=()
+if [ "${TI_DEDUPLICATE:-0}" == "1" ]; then
+    ti_sim_options+=(--deduplicate)
+fi
+
+# Engine of the summary.csv metrics: 'python' (mesh_metrics.py) or the compiled 'matlab' step
+# (override with TI_METRICS_ENGINE)
+metrics_engine="${TI_METRICS_ENGINE:-python}"
+
 # Function to list available subjects
 list_subjects() {
     subjects=()
@@ -119,7 +136,7 @@ for subject_index in "${selected_subjects[@]}"; do
 
     # Call the TI optimizer script
     echo -e "${CYAN}Running TImax_optimizer.py for subject $subject_name...${RESET}"
-    simnibs_python ti_sim.py
+    simnibs_python ti_sim.py --mode "$ti_sim_mode" "${ti_sim_options[@]}"
 
     # Check if the TI optimization was successful
     if [ $? -eq 0 ]; then
@@ -129,9 +146,15 @@ for subject_index in "${selected_subjects[@]}"; do
         exit 1
     fi
 
+    # In ROI, top-K and evolve mode output.csv has already been written by ti_sim.py and there are no meshes to analyze
+    if [ "$ti_sim_mode" == "roi" ] || [ "$ti_sim_mode" == "topk" ] || [ "$ti_sim_mode" == "evolve" ]; then
+        echo -e "${GREEN}ROI scores written to $project_dir/Simulations/opt_$subject_name/output.csv.${RESET}"
+        continue
+    fi
+
     # Call the ROI analyzer script
     echo -e "${CYAN}Running roi-analyzer.py for subject $subject_name...${RESET}"
-    python3 roi-analyzer.py "$roi_dir"
+    simnibs_python roi-analyzer.py "$roi_dir" --workers "${TI_ROI_WORKERS:-1}"
 
     # Check if the ROI analysis was successful
     if [ $? -eq 0 ]; then
@@ -144,9 +167,14 @@ for subject_index in "${selected_subjects[@]}"; do
     # Define the mesh directory
     mesh_dir="$project_dir/Simulations/opt_$subject_name"
 
-    # Run the process_mesh_files_new.sh script
-    echo -e "${CYAN}Running process_mesh_files_new.sh for subject $subject_name...${RESET}"
-    ./field-analysis/run_process_mesh_files.sh "$mesh_dir"
+    # Compute the peak and focality metrics of all meshes (summary.csv)
+    if [ "$metrics_engine" == "matlab" ]; then
+        echo -e "${CYAN}Running process_mesh_files_new.sh for subject $subject_name...${RESET}"
+        ./field-analysis/run_process_mesh_files.sh "$mesh_dir"
+    else
+        echo -e "${CYAN}Running mesh_metrics.py for subject $subject_name...${RESET}"
+        simnibs_python mesh_metrics.py "$mesh_dir" --geometry-dir "$subject_dir/m2m_$subject_name/geometry"
+    fi
 
     # Check if the mesh processing was successful
     if [ $? -eq 0 ]; then
@@ -168,9 +196,21 @@ for subject_index in "${selected_subjects[@]}"; do
         exit 1
     fi
 
+    # Rank the montages (Pareto front and weighted top-K) and list the selected meshes
+    echo -e "${CYAN}Running montage_ranking.py for subject $subject_name...${RESET}"
+    python3 montage_ranking.py "$mesh_dir"
+
+    # Check if the ranking was successful
+    if [ $? -eq 0 ]; then
+        echo -e "${GREEN}Montages ranked successfully for subject $subject_name.${RESET}"
+    else
+        echo -e "${RED}Montage ranking failed for subject $subject_name. Exiting.${RESET}"
+        exit 1
+    fi
+
     # Run the mesh selector script
     echo -e "${CYAN}Running mesh-selector.sh for subject $subject_name...${RESET}"
-    #bash mesh-selector.sh
+    #bash mesh-selector.sh "$mesh_dir/selected_meshes.txt"
 
 done
 
@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import weakref
+import numpy as np
+
+'''
+Optimized for optimizer pipeline
+
+This module contains the batched TI engine used by ti_sim.py. Instead of calling
+TI.get_field and TI.get_maxTI once per electrode combination, it builds the fields
+of a whole block of combinations by superposing leadfield rows and evaluates
+TI_max for the block in a single NumPy array operation.
+
+Key Features:
+- Superposes leadfield rows for every distinct electrode pair of a block only once.
+- Evaluates TI_max for (..., N, 3) field arrays of any leading shape.
+- Splits the combination list into blocks of configurable size so that memory use
+  stays at roughly block_size x N x 3 doubles per pair field array.
+- Optionally memoizes pair fields across blocks (and across runs on the same leadfield
+  file in one session) in a PairFieldCache with a memory budget and LRU eviction.
+- Chunked kernels (get_maxTI_chunked, get_TI_vectors_chunked) for single pairs of large
+  fields, also used by analyzer/TI.py and analyzer/mTI.py: elements are processed in
+  chunks with work buffers allocated once, so the peak memory beyond the output is a
+  few chunks, optionally in float32 arithmetic.
+'''
+
+DEFAULT_BLOCK_SIZE = 8
+# Block size when TI_max is only evaluated at a few elements (ROI scoring)
+DEFAULT_ROI_BLOCK_SIZE = 4096
+# Memory budget of the pair field cache
+DEFAULT_CACHE_BYTES = 2 * 1024 ** 3
+# Elements per chunk of the chunked kernels, and number of elements from which blocks use them
+DEFAULT_CHUNK_SIZE = 1 << 16
+MIN_CHUNKED_ELEMENTS = 1 << 14
+
+
+def get_maxTI_batch(E1, E2):
+    """
+    calculates the maximal amplitude of the TI envelope for stacked fields
+
+    Equivalent to TI_utils.get_maxTI, but written in terms of the squared norms
+    and the absolute dot product of the two fields so that it needs neither the
+    E1/E2 swap nor the polarity flip, and works on any number of leading
+    dimensions (e.g. combinations x positions x 3).
+
+    Parameters
+    ----------
+    E1 : np.ndarray
+        field of electrode pair 1 (... x 3)
+    E2 : np.ndarray
+        field of electrode pair 2 (... x 3)
+
+    Returns
+    -------
+    TImax : np.ndarray (...)
+        maximal amplitude of the TI envelope
+    """
+    assert E1.shape == E2.shape
+    assert E1.shape[-1] == 3
+
+    n1, n2, dot = get_field_products(E1, E2)
+    return get_maxTI_from_products(n1, n2, dot)
+
+
+def get_field_products(E1, E2):
+    """squared norms and absolute dot product of two stacked fields (... x 3)"""
+    n1 = np.einsum('...i,...i->...', E1, E1)
+    n2 = np.einsum('...i,...i->...', E2, E2)
+    dot = np.abs(np.einsum('...i,...i->...', E1, E2))
+    return n1, n2, dot
+
+
+def get_maxTI_from_products(n1, n2, dot):
+    """
+    maximal amplitude of the TI envelope from |E1|^2, |E2|^2 and |E1 . E2|
+
+    Scaling the currents of the pairs by a and b scales the products by a^2, b^2
+    and ab, so TI_max for other current ratios does not need the fields again.
+    """
+    # |E2| <= |E1| cos(alpha) with |E2| the weaker field: TI_max = 2|E2|
+    weak = np.minimum(n1, n2)
+    idx = weak <= dot
+
+    # otherwise: TI_max = 2|E1 x E2| / |E1 - E2| (after flipping E2 so that alpha < pi/2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        TImax = np.maximum(n1 * n2 - dot * dot, 0) / (n1 + n2 - 2 * dot)
+    TImax[idx] = weak[idx]
+    np.sqrt(TImax, out=TImax)
+    TImax *= 2
+    return TImax
+
+
+def get_maxTI_ratios(E1, E2, ratios):
+    """
+    TI_max of two fields for several splits of the total current
+
+    The total current of both pairs is kept: for a ratio r, pair 1 carries
+    2r and pair 2 carries 2(1 - r) times the current of E1 and E2, so that
+    r = 0.5 gives get_maxTI_batch(E1, E2). Fields are linear in the current,
+    so the products of E1 and E2 are computed only once for all ratios.
+
+    Parameters
+    ----------
+    E1, E2 : np.ndarray (... x 3)
+        fields of the two pairs at equal currents
+    ratios : np.ndarray (R,)
+        fraction of the total current carried by pair 1
+
+    Returns
+    -------
+    TImax : np.ndarray (R x ...)
+    """
+    n1, n2, dot = get_field_products(E1, E2)
+    a = 2 * np.asarray(ratios, dtype=float).reshape((-1,) + (1,) * n1.ndim)
+    b = 2 - a
+    return get_maxTI_from_products(a * a * n1, b * b * n2, a * b * dot)
+
+
+class KernelBuffers:
+    """
+    work buffers of the chunked kernels for one chunk size and dtype
+
+    Parameters
+    ----------
+    chunk_size : int
+    dtype : np.dtype
+    """
+
+    def __init__(self, chunk_size, dtype):
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype)
+        self.vectors = np.empty((4, chunk_size, 3), dtype=self.dtype)
+        self.scalars = np.empty((5, chunk_size), dtype=self.dtype)
+        self.mask = np.empty(chunk_size, dtype=bool)
+        self.other = np.empty(chunk_size, dtype=bool)
+
+
+# Buffers of this process, one set per (chunk size, dtype)
+_kernel_buffers = {}
+
+
+def get_kernel_buffers(chunk_size=DEFAULT_CHUNK_SIZE, dtype=np.float64):
+    """returns the work buffers of the chunked kernels, allocating them on first use"""
+    key = (chunk_size, np.dtype(dtype).str)
+    buffers = _kernel_buffers.get(key)
+    if buffers is None:
+        buffers = _kernel_buffers[key] = KernelBuffers(chunk_size, dtype)
+    return buffers
+
+
+def _kernel_setup(E1, E2, out, shape, dtype, chunk_size):
+    assert E1.shape == E2.shape
+    assert E1.ndim == 2 and E1.shape[1] == 3
+    dtype = np.dtype(dtype) if dtype is not None else np.result_type(E1.dtype, E2.dtype, np.float32)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    return out, get_kernel_buffers(chunk_size, dtype)
+
+
+def get_maxTI_chunked(E1, E2, out=None, dtype=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    maximal amplitude of the TI envelope of two fields, computed in chunks of elements
+
+    Same formula as get_maxTI_batch, evaluated chunk by chunk in preallocated buffers
+    (the inputs are cast chunk by chunk, so float64 fields can be processed in float32
+    arithmetic without a float32 copy of the whole fields).
+
+    Parameters
+    ----------
+    E1, E2 : np.ndarray (N x 3)
+        fields of electrode pairs 1 and 2
+    out : np.ndarray (N,), optional
+        output array
+    dtype : np.dtype, optional
+        arithmetic precision (default: that of the inputs, at least float32)
+    chunk_size : int
+        elements per chunk
+
+    Returns
+    -------
+    TImax : np.ndarray (N,)
+    """
+    out, buf = _kernel_setup(E1, E2, out, E1.shape[:1], dtype, chunk_size)
+    for start in range(0, len(E1), chunk_size):
+        stop = min(start + chunk_size, len(E1))
+        m = stop - start
+        e1, e2 = buf.vectors[0, :m], buf.vectors[1, :m]
+        n1, n2, dot, weak, value = (b[:m] for b in buf.scalars)
+        idx = buf.mask[:m]
+        e1[...] = E1[start:stop]
+        e2[...] = E2[start:stop]
+        np.einsum('ij,ij->i', e1, e1, out=n1)
+        np.einsum('ij,ij->i', e2, e2, out=n2)
+        np.abs(np.einsum('ij,ij->i', e1, e2, out=dot), out=dot)
+        # |E2| <= |E1| cos(alpha) with |E2| the weaker field: TI_max = 2|E2|
+        np.minimum(n1, n2, out=weak)
+        np.less_equal(weak, dot, out=idx)
+        # otherwise: TI_max = 2|E1 x E2| / |E1 - E2| (after flipping E2 so that alpha < pi/2)
+        np.multiply(n1, n2, out=value)
+        value -= np.multiply(dot, dot, out=e1[:, 0])
+        np.maximum(value, 0, out=value)
+        np.add(n1, n2, out=n1)
+        n1 -= np.multiply(dot, 2, out=n2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(value, n1, out=value)
+        np.copyto(value, weak, where=idx)
+        np.sqrt(value, out=value)
+        np.multiply(value, 2, out=out[start:stop])
+    return out
+
+
+def get_TI_vectors_chunked(E1, E2, out=None, dtype=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    modulation amplitude vectors of the TI envelope, computed in chunks of elements
+
+    Same operations as get_TI_vectors in analyzer/mTI.py (identical results in
+    float64), evaluated chunk by chunk in preallocated buffers instead of on full
+    copies and boolean-indexed slices of the fields.
+
+    Parameters
+    ----------
+    E1, E2 : np.ndarray (N x 3)
+        fields of electrode pairs 1 and 2
+    out : np.ndarray (N x 3), optional
+        output array
+    dtype : np.dtype, optional
+        arithmetic precision (default: that of the inputs, at least float32)
+    chunk_size : int
+        elements per chunk
+
+    Returns
+    -------
+    TI_vectors : np.ndarray (N x 3)
+    """
+    out, buf = _kernel_setup(E1, E2, out, E1.shape, dtype, chunk_size)
+    for start in range(0, len(E1), chunk_size):
+        stop = min(start + chunk_size, len(E1))
+        m = stop - start
+        e1, e2, work, diff = (b[:m] for b in buf.vectors)
+        n1, n2, dot, cos, tmp = (b[:m] for b in buf.scalars)
+        idx, swap = buf.mask[:m], buf.other[:m]
+        e1[...] = E1[start:stop]
+        e2[...] = E2[start:stop]
+        np.sqrt(np.add.reduce(np.multiply(e1, e1, out=work), axis=1, out=n1), out=n1)
+        np.sqrt(np.add.reduce(np.multiply(e2, e2, out=work), axis=1, out=n2), out=n2)
+
+        # ensure E1>E2
+        np.greater(n2, n1, out=swap)
+        np.copyto(work, e1)
+        np.copyto(e1, e2, where=swap[:, None])
+        np.copyto(e2, work, where=swap[:, None])
+        np.copyto(tmp, n1)
+        np.copyto(n1, n2, where=swap)
+        np.copyto(n2, tmp, where=swap)
+
+        # ensure alpha < pi/2
+        np.add.reduce(np.multiply(e1, e2, out=work), axis=1, out=dot)
+        np.less(dot, 0, out=swap)
+        np.negative(e2, out=e2, where=swap[:, None])
+        np.negative(dot, out=dot, where=swap)
+
+        # get maximal amplitude of envelope
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(dot, np.multiply(n1, n2, out=cos), out=cos)
+            np.less_equal(n2, np.multiply(n1, cos, out=tmp), out=idx)
+
+            # 2 * (E2 x (E1 - E2)) / |E1 - E2|, with the operations of np.cross
+            np.subtract(e1, e2, out=diff)
+            result = out[start:stop]
+            for k, (i, j) in enumerate(((1, 2), (2, 0), (0, 1))):
+                np.multiply(e2[:, i], diff[:, j], out=result[:, k])
+                result[:, k] -= np.multiply(e2[:, j], diff[:, i], out=tmp)
+            np.sqrt(np.add.reduce(np.multiply(diff, diff, out=work), axis=1, out=tmp), out=tmp)
+            result *= 2
+            result /= tmp[:, None]
+        np.multiply(e2, 2, out=result, where=idx[:, None])
+    return out
+
+
+def get_pair_fields(pairs, leadfield, idx_lf, out=None):
+    """
+    builds the electric fields of several electrode pairs from the leadfield
+
+    Same convention as TI_utils.get_field: the field of the pair (e+, e-, I) is
+    I * (leadfield[e+] - leadfield[e-]), where the reference electrode has no
+    row in the leadfield (index None) and contributes a zero field.
+
+    Parameters
+    ----------
+    pairs : list of (str, str, float)
+        electrode names and current of each pair
+    leadfield : np.ndarray
+        leadfield matrix (N_elec-1 x N x 3)
+    idx_lf : dict
+        mapping from electrode name to row in the leadfield
+    out : np.ndarray, optional
+        preallocated output array (len(pairs) x N x 3)
+
+    Returns
+    -------
+    fields : np.ndarray (len(pairs) x N x 3)
+    """
+    if out is None:
+        out = np.empty((len(pairs),) + tuple(leadfield.shape[1:]), dtype=leadfield.dtype)
+    for k, (e_plus, e_minus, current) in enumerate(pairs):
+        i_plus = idx_lf[e_plus]
+        i_minus = idx_lf[e_minus]
+        if i_plus is None:
+            np.negative(leadfield[i_minus], out=out[k])
+        elif i_minus is None:
+            out[k] = leadfield[i_plus]
+        else:
+            np.subtract(leadfield[i_plus], leadfield[i_minus], out=out[k])
+        out[k] *= current
+    return out
+
+
+class PairFieldCache:
+    """
+    memoized electrode pair fields of one leadfield
+
+    Fields are keyed by (e+, e-, current) and evicted least-recently-used first
+    once their total size exceeds max_bytes.
+
+    The cache only holds a weak reference to the leadfield, so it never keeps
+    a released leadfield (or its shared memory buffer) alive.
+
+    Parameters
+    ----------
+    leadfield : np.ndarray
+        leadfield matrix (N_elec-1 x N x 3)
+    idx_lf : dict
+        mapping from electrode name to row in the leadfield
+    max_bytes : int
+        memory budget of the cached fields
+    """
+
+    def __init__(self, leadfield, idx_lf, max_bytes=DEFAULT_CACHE_BYTES):
+        self.leadfield = leadfield
+        self.idx_lf = idx_lf
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._fields = OrderedDict()
+
+    @property
+    def leadfield(self):
+        leadfield = self._leadfield()
+        if leadfield is None:
+            raise ReferenceError("the leadfield of this pair field cache has been released")
+        return leadfield
+
+    @leadfield.setter
+    def leadfield(self, leadfield):
+        self._leadfield = weakref.ref(leadfield)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def get(self, e_plus, e_minus, current):
+        """Returns the (read-only) field of one pair, computing it on a cache miss."""
+        key = (e_plus, e_minus, float(current))
+        field = self._fields.get(key)
+        if field is not None:
+            self._fields.move_to_end(key)
+            self.hits += 1
+            return field
+        self.misses += 1
+        field = get_pair_fields([key], self.leadfield, self.idx_lf)[0]
+        if field.nbytes <= self.max_bytes:
+            field.flags.writeable = False
+            self._fields[key] = field
+            self.nbytes += field.nbytes
+            self._evict()
+        return field
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._fields.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        """Changes the memory budget, evicting fields if the cache is now too large."""
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def fields(self, pairs, out=None):
+        """Stacks the fields of several (e+, e-, current) pairs (len(pairs) x N x 3)."""
+        if out is None:
+            out = np.empty((len(pairs),) + tuple(self.leadfield.shape[1:]), dtype=self.leadfield.dtype)
+        for k, pair in enumerate(pairs):
+            out[k] = self.get(*pair)
+        return out
+
+    def clear(self):
+        self._fields.clear()
+        self.nbytes = 0
+
+
+# Pair field caches of the current session, keyed by the leadfield source (see get_pair_cache)
+_session_caches = {}
+
+
+def get_pair_cache(leadfield, idx_lf, max_bytes=DEFAULT_CACHE_BYTES):
+    """
+    returns the session's PairFieldCache of a leadfield, creating it on first use
+
+    Leadfields that name their file (leadfield_access.LazyLeadfield.source) are
+    keyed by path, modification time and dataset, so repeated runs on the same
+    leadfield file (e.g. several calls of ti_sim.process_leadfield in one
+    session) reuse the cached pair fields even though the file is reopened.
+    These caches stay until clear_session_caches is called. Caches of plain
+    arrays are keyed by the array object and dropped together with it.
+    """
+    source = getattr(leadfield, 'source', None)
+    if source is not None:
+        key = ('source', source, tuple(idx_lf.items()))
+    else:
+        key = ('id', id(leadfield))
+    cache = _session_caches.get(key)
+    if cache is not None and source is None and (cache._leadfield() is not leadfield or cache.idx_lf != idx_lf):
+        cache = None
+    if cache is None:
+        cache = PairFieldCache(leadfield, idx_lf, max_bytes)
+        _session_caches[key] = cache
+        if source is None:
+            weakref.finalize(leadfield, _session_caches.pop, key, None)
+    else:
+        cache.leadfield = leadfield
+    cache.resize(max_bytes)
+    return cache
+
+
+def clear_session_caches():
+    """releases the pair fields of all session caches"""
+    for cache in _session_caches.values():
+        cache.clear()
+    _session_caches.clear()
+
+
+def iter_blocks(combinations, block_size=DEFAULT_BLOCK_SIZE):
+    """Yields (start index, block) slices of the combination list."""
+    if block_size < 1:
+        raise ValueError("block_size must be at least 1")
+    for start in range(0, len(combinations), block_size):
+        yield start, combinations[start:start + block_size]
+
+
+def get_block_fields(block, leadfield, idx_lf, intensity, cache=None):
+    """
+    builds the pair fields of a block of combinations
+
+    Every distinct electrode pair of the block is superposed only once; with a
+    PairFieldCache, pairs already seen in earlier blocks are not superposed again.
+
+    Returns
+    -------
+    fields : np.ndarray (N_pairs x N x 3)
+        fields of the distinct pairs
+    idx1, idx2 : np.ndarray (len(block),)
+        index of pair 1 and pair 2 of each combination in `fields`
+    """
+    pair_index = {}
+    idx1 = np.empty(len(block), dtype=int)
+    idx2 = np.empty(len(block), dtype=int)
+    for j, (pair1, pair2) in enumerate(block):
+        idx1[j] = pair_index.setdefault(tuple(pair1), len(pair_index))
+        idx2[j] = pair_index.setdefault(tuple(pair2), len(pair_index))
+    pairs = [(e_plus, e_minus, intensity) for e_plus, e_minus in pair_index]
+    if cache is not None:
+        fields = cache.fields(pairs)
+    else:
+        fields = get_pair_fields(pairs, leadfield, idx_lf)
+    return fields, idx1, idx2
+
+
+def get_TImax_block(block, leadfield, idx_lf, intensity, cache=None):
+    """
+    calculates TI_max for a block of combinations
+
+    Parameters
+    ----------
+    block : list of ((e1+, e1-), (e2+, e2-))
+        electrode combinations, as returned by ti_sim.generate_combinations
+    leadfield : np.ndarray
+        leadfield matrix (N_elec-1 x N x 3)
+    idx_lf : dict
+        mapping from electrode name to row in the leadfield
+    intensity : float
+        current of both electrode pairs
+    cache : PairFieldCache, optional
+        cache of pair fields of this leadfield
+
+    Returns
+    -------
+    TImax : np.ndarray (len(block) x N)
+    """
+    fields, idx1, idx2 = get_block_fields(block, leadfield, idx_lf, intensity, cache)
+    if fields.shape[1] < MIN_CHUNKED_ELEMENTS:
+        return get_maxTI_batch(fields[idx1], fields[idx2])
+    # Whole meshes: the whole block, one slice of elements at a time, so that the copies
+    # of the pair fields are limited to about one kernel chunk
+    n_elements = fields.shape[1]
+    step = max(1, DEFAULT_CHUNK_SIZE // len(block))
+    TImax = np.empty((len(block), n_elements), dtype=fields.dtype)
+    out = np.empty(len(block) * min(step, n_elements), dtype=fields.dtype)
+    for start in range(0, n_elements, step):
+        stop = min(start + step, n_elements)
+        m = len(block) * (stop - start)
+        get_maxTI_chunked(fields[idx1, start:stop].reshape(-1, 3), fields[idx2, start:stop].reshape(-1, 3),
+                          out=out[:m])
+        TImax[:, start:stop] = out[:m].reshape(len(block), -1)
+    return TImax
+
+
+def iter_TImax_blocks(combinations, leadfield, idx_lf, intensity, block_size=DEFAULT_BLOCK_SIZE, cache=None):
+    """
+    Yields (start index, block, TImax) for consecutive blocks of combinations,
+    where TImax has shape (len(block) x N).
+    """
+    for start, block in iter_blocks(combinations, block_size):
+        yield start, block, get_TImax_block(block, leadfield, idx_lf, intensity, cache)
+
+
+def iter_TImax(combinations, leadfield, idx_lf, intensity, block_size=DEFAULT_BLOCK_SIZE, cache=None):
+    """
+    Yields (index, combination, TImax) for every combination, computing TI_max
+    block by block with iter_TImax_blocks.
+    """
+    for start, block, TImax_block in iter_TImax_blocks(combinations, leadfield, idx_lf, intensity,
+                                                       block_size, cache):
+        for j, combination in enumerate(block):
+            yield start + j, combination, TImax_block[j]
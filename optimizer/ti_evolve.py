@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+import heapq
+import json
+import os
+import time
+import numpy as np
+import ti_engine
+
+'''
+Optimized for optimizer pipeline
+
+This module implements the evolutionary montage search of ti_sim.py (--mode evolve),
+a genetic algorithm over electrode quadruples (E1+, E1-, E2+, E2-) for searches where
+even the branch-and-bound search of ti_search.py has too many candidates (e.g. with an
+off-target penalty, which the pair bound does not cover).
+
+- Fitness is the ROI TImax minus off_target_weight x the mean TImax at a sample of
+  off-target elements, evaluated for a whole generation at once on the leadfield rows
+  of those elements only.
+- Selection is by tournament; children exchange whole pairs (crossover) and replace
+  single electrodes (mutation). The best montages are kept from one generation to
+  the next (elitism) and every distinct montage is evaluated only once.
+- The search stops after a number of evaluations or a wall-clock time and is
+  reproducible for a fixed seed. The population is checkpointed to an .npz file
+  after every generation and a search can be resumed from it.
+'''
+
+DEFAULT_POPULATION = 200
+DEFAULT_TOURNAMENT = 3
+DEFAULT_MUTATION_RATE = 0.25
+DEFAULT_ELITE_FRACTION = 0.05
+
+
+class MontageFitness:
+    """
+    batched fitness of electrode quadruples
+
+    Parameters
+    ----------
+    leadfield_sel : np.ndarray (N_elec-1 x K x 3)
+        leadfield at the ROI support elements followed by the off-target elements
+    idx_lf : dict
+        mapping from electrode name to row in the leadfield
+    electrodes : list of str
+        electrodes the search may use; montages are arrays of indices into this list
+    intensity : float
+        current of both electrode pairs
+    roi_weight : np.ndarray (K_roi,)
+        weights of the ROI value on the first K_roi elements of leadfield_sel
+    off_target_weight : float
+        weight of the mean off-target TImax in the fitness
+    """
+
+    def __init__(self, leadfield_sel, idx_lf, electrodes, intensity, roi_weight, off_target_weight=0.0):
+        # The reference electrode gets an all-zero row, so that every field is L[e+] - L[e-]
+        zero_row = len(leadfield_sel)
+        self.rows = np.array([zero_row if idx_lf[e] is None else idx_lf[e] for e in electrodes])
+        self.leadfield = np.concatenate([leadfield_sel, np.zeros((1,) + leadfield_sel.shape[1:])]) * intensity
+        self.roi_weight = np.asarray(roi_weight, dtype=float)
+        self.n_roi = len(self.roi_weight)
+        self.off_target_weight = off_target_weight
+
+    def evaluate(self, montages):
+        """
+        fitness, ROI value and off-target value of montages (B x 4 electrode indices)
+        """
+        rows = self.rows[np.asarray(montages)]
+        E1 = self.leadfield[rows[:, 0]] - self.leadfield[rows[:, 1]]
+        E2 = self.leadfield[rows[:, 2]] - self.leadfield[rows[:, 3]]
+        TImax = ti_engine.get_maxTI_batch(E1, E2)
+        roi = TImax[:, :self.n_roi] @ self.roi_weight
+        off_target = TImax[:, self.n_roi:].mean(axis=1) if TImax.shape[1] > self.n_roi else np.zeros(len(roi))
+        return roi - self.off_target_weight * off_target, roi, off_target
+
+
+def canonical_montage(montage):
+    """Canonical form of an index quadruple (pair polarity and pair order do not change TImax)."""
+    a, b, c, d = (int(e) for e in montage)
+    return tuple(sorted((tuple(sorted((a, b))), tuple(sorted((c, d))))))
+
+
+class EvolutionarySearch:
+    """
+    genetic algorithm over electrode quadruples
+
+    Parameters
+    ----------
+    fitness : MontageFitness
+    candidates : list of 4 np.ndarray
+        allowed electrode indices of E1+, E1-, E2+ and E2-
+    population_size : int
+    seed : int, optional
+        seed of the random generator; the search is reproducible for a fixed seed
+    exclude : callable, optional
+        returns True for index quadruples that are not allowed (they get fitness -inf)
+    tournament, mutation_rate, elite_fraction :
+        parameters of the selection, mutation and elitism
+    electrodes : list of str, optional
+        names of the electrode indices, stored in checkpoints to check that a
+        resumed search uses the same electrodes
+    """
+
+    def __init__(self, fitness, candidates, population_size=DEFAULT_POPULATION, seed=None, exclude=None,
+                 tournament=DEFAULT_TOURNAMENT, mutation_rate=DEFAULT_MUTATION_RATE,
+                 elite_fraction=DEFAULT_ELITE_FRACTION, electrodes=None):
+        self.fitness = fitness
+        self.electrodes = list(electrodes) if electrodes is not None else []
+        self.candidates = [np.asarray(c) for c in candidates]
+        self.population_size = population_size
+        self.exclude = exclude
+        self.tournament = tournament
+        self.mutation_rate = mutation_rate
+        self.n_elite = max(1, int(round(elite_fraction * population_size)))
+        self.rng = np.random.default_rng(seed)
+        self.generation = 0
+        self.evaluations = 0
+        self.evaluated = {}  # canonical montage -> (fitness, roi, off-target, montage)
+        self.population = None
+        self.scores = None
+
+    def _random_montages(self, n):
+        montages = np.stack([self.rng.choice(c, size=n) for c in self.candidates], axis=1)
+        return self._repair(montages)
+
+    def _repair(self, montages):
+        # A pair with the same electrode twice carries no current: redraw its minus electrode
+        for plus, minus in ((0, 1), (2, 3)):
+            for _ in range(100):
+                same = montages[:, plus] == montages[:, minus]
+                if not same.any():
+                    break
+                montages[same, minus] = self.rng.choice(self.candidates[minus], size=same.sum())
+        return montages
+
+    def _score(self, montages):
+        """Fitness of montages, evaluating only montages that were never evaluated before."""
+        keys = [canonical_montage(m) for m in montages]
+        new = {}
+        for key, montage in zip(keys, montages):
+            if key not in self.evaluated and key not in new:
+                new[key] = montage
+        if new:
+            batch = np.array(list(new.values()))
+            fitness, roi, off_target = self.fitness.evaluate(batch)
+            if self.exclude is not None:
+                excluded = np.array([self.exclude(m) for m in batch])
+                fitness[excluded] = -np.inf
+            for k, key in enumerate(new):
+                self.evaluated[key] = (float(fitness[k]), float(roi[k]), float(off_target[k]), batch[k].copy())
+            self.evaluations += len(new)
+        return np.array([self.evaluated[key][0] for key in keys])
+
+    def _select(self, n):
+        contenders = self.rng.integers(len(self.population), size=(n, self.tournament))
+        winners = contenders[np.arange(n), np.argmax(self.scores[contenders], axis=1)]
+        return self.population[winners]
+
+    def _offspring(self, n):
+        parents_a = self._select(n)
+        parents_b = self._select(n)
+        # Crossover: the child takes each pair from one of the parents
+        children = parents_a.copy()
+        swap = self.rng.random(n) < 0.5
+        children[swap, 2:] = parents_b[swap, 2:]
+        swap = self.rng.random(n) < 0.5
+        children[swap, :2] = parents_b[swap, :2]
+        # Mutation: replace single electrodes by random candidates
+        mutate = self.rng.random(children.shape) < self.mutation_rate / 4
+        self._mutate(children, mutate)
+        # Children that were already evaluated are mutated further, so that every
+        # generation explores new montages instead of converging on copies
+        for _ in range(10):
+            seen = set()
+            known = np.zeros(n, dtype=bool)
+            for k, child in enumerate(children):
+                key = canonical_montage(child)
+                known[k] = key in self.evaluated or key in seen
+                seen.add(key)
+            if not known.any():
+                break
+            mutate = np.zeros(children.shape, dtype=bool)
+            mutate[np.flatnonzero(known), self.rng.integers(4, size=known.sum())] = True
+            self._mutate(children, mutate)
+        return children
+
+    def _mutate(self, montages, mutate):
+        for j in range(4):
+            montages[mutate[:, j], j] = self.rng.choice(self.candidates[j], size=mutate[:, j].sum())
+        self._repair(montages)
+
+    def initialize(self):
+        self.population = self._random_montages(self.population_size)
+        self.scores = self._score(self.population)
+
+    def step(self):
+        """Evolves the population by one generation."""
+        elite = np.argsort(-self.scores, kind='stable')[:self.n_elite]
+        children = self._offspring(self.population_size - self.n_elite)
+        population = np.concatenate([self.population[elite], children])
+        self.scores = self._score(population)
+        self.population = population
+        self.generation += 1
+
+    def run(self, max_evaluations=None, max_seconds=None, checkpoint=None, callback=None):
+        """
+        evolves the population until the evaluation or time budget is used up
+
+        Parameters
+        ----------
+        max_evaluations : int, optional
+            stop once this many distinct montages were evaluated
+        max_seconds : float, optional
+            stop after this wall-clock time
+        checkpoint : str, optional
+            .npz file the population is saved to after every generation
+        callback : callable, optional
+            called as callback(search) after every generation
+        """
+        if max_evaluations is None and max_seconds is None:
+            raise ValueError("An evaluation or time budget is required")
+        start = time.monotonic()
+        if self.population is None:
+            self.initialize()
+        stalled = 0
+        while True:
+            if max_evaluations is not None and self.evaluations >= max_evaluations:
+                break
+            if max_seconds is not None and time.monotonic() - start >= max_seconds:
+                break
+            evaluations = self.evaluations
+            self.step()
+            if checkpoint:
+                self.save(checkpoint)
+            if callback is not None:
+                callback(self)
+            # Stop when the generations only produce montages that were already evaluated
+            stalled = stalled + 1 if self.evaluations == evaluations else 0
+            if stalled >= 10:
+                break
+        return self.best()
+
+    def best(self, n=1):
+        """Best n evaluated montages as (fitness, roi, off-target, index quadruple), best first."""
+        ranked = heapq.nlargest(n, self.evaluated.values(), key=lambda v: v[0])
+        return [v for v in ranked if np.isfinite(v[0])]
+
+    def save(self, filename):
+        """Writes the population, the evaluated montages and the random generator state to an .npz file."""
+        values = list(self.evaluated.values())
+        tmp = filename + '.tmp.npz'
+        np.savez(tmp, population=self.population, scores=self.scores,
+                 generation=self.generation, evaluations=self.evaluations,
+                 evaluated_montages=np.array([v[3] for v in values], dtype=int).reshape(-1, 4),
+                 evaluated_values=np.array([v[:3] for v in values], dtype=float).reshape(-1, 3),
+                 rng_state=json.dumps(self.rng.bit_generator.state),
+                 electrodes=np.array(self.electrodes, dtype=str))
+        os.replace(tmp, filename)
+
+    def load(self, filename):
+        """Restores a search saved with save(); the search then continues where it stopped."""
+        with np.load(filename) as data:
+            if list(data['electrodes']) != self.electrodes:
+                raise ValueError(f"Checkpoint {filename} was written for different electrodes")
+            self.population = data['population']
+            self.scores = data['scores']
+            self.generation = int(data['generation'])
+            self.evaluations = int(data['evaluations'])
+            self.evaluated = {canonical_montage(m): (float(v[0]), float(v[1]), float(v[2]), m)
+                              for m, v in zip(data['evaluated_montages'], data['evaluated_values'])}
+            self.rng.bit_generator.state = json.loads(str(data['rng_state']))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import contextlib
+import multiprocessing as mp
+import os
+import numpy as np
+from multiprocessing import shared_memory
+
+'''
+Optimized for optimizer pipeline
+
+This module runs the per-combination work of ti_sim.py (--workers N) on a pool of
+worker processes. The leadfield is placed once in a multiprocessing.shared_memory
+block that every worker maps as a read-only NumPy array, so it is never copied or
+pickled. The combinations are split into contiguous chunks and the results are
+returned in chunk order, so the output is identical to (and in the same order as)
+the serial run.
+
+Each worker limits its BLAS/OpenMP thread pools (1 thread by default) so that N
+workers do not oversubscribe the node.
+'''
+
+BLAS_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                         'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+# State of a worker process, set by _init_worker
+_worker = {}
+
+
+class SharedLeadfield:
+    """
+    copy of a leadfield array in a shared memory block
+
+    Use as a context manager in the parent process; the block is released on exit.
+    `spec` is the picklable description workers use to attach to it.
+    """
+
+    def __init__(self, leadfield):
+        leadfield = np.ascontiguousarray(leadfield)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(leadfield.nbytes, 1))
+        self.array = np.ndarray(leadfield.shape, dtype=leadfield.dtype, buffer=self._shm.buf)
+        self.array[...] = leadfield
+        self.spec = (self._shm.name, leadfield.shape, leadfield.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._shm is not None:
+            del self.array
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: spawned workers share the parent's resource tracker, which
+        # already tracks the block, so attaching does not register it a second time
+        return shared_memory.SharedMemory(name=name)
+
+
+def _limit_threads(n_threads):
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(n_threads)
+    except ImportError:
+        pass
+
+
+def _init_worker(spec, state, n_threads):
+    _limit_threads(n_threads)
+    name, shape, dtype = spec
+    shm = _attach(name)
+    leadfield = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    leadfield.flags.writeable = False
+    _worker.update(state)
+    _worker['shm'] = shm
+    _worker['leadfield'] = leadfield
+
+
+def worker_leadfield():
+    """Returns the shared leadfield inside a worker process."""
+    return _worker['leadfield']
+
+
+def worker_state():
+    """Returns the state dictionary passed to imap_chunks inside a worker process."""
+    return _worker
+
+
+def index_chunks(items, n_chunks):
+    """
+    Splits a list into at most n_chunks contiguous chunks of near-equal size,
+    returned as (start index, chunk) tuples.
+    """
+    n_chunks = max(1, min(n_chunks, len(items)))
+    bounds = np.linspace(0, len(items), n_chunks + 1).round().astype(int)
+    return [(a, items[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+@contextlib.contextmanager
+def thread_limit(threads, variables=BLAS_THREAD_VARIABLES):
+    """
+    sets the thread count environment variables to `threads` and restores them on exit
+
+    Spawned workers inherit the environment, so pools started inside the block apply
+    the limit before numpy (or a solver) is loaded.
+    """
+    saved_env = {var: os.environ.get(var) for var in variables}
+    os.environ.update({var: str(threads) for var in variables})
+    try:
+        yield
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def imap_chunks(task, chunks, leadfield, workers, state=None, blas_threads=1):
+    """
+    runs task(chunk) for every chunk on a pool of worker processes
+
+    Parameters
+    ----------
+    task : callable
+        top-level (picklable) function; inside it, use worker_leadfield() and
+        worker_state() to access the shared leadfield and the state
+    chunks : list
+        work items, e.g. from index_chunks
+    leadfield : np.ndarray or SharedLeadfield
+        array shared with the workers; pass a SharedLeadfield to avoid keeping
+        a second copy of the leadfield in the parent process
+    workers : int
+        number of worker processes
+    state : dict, optional
+        small picklable objects sent once to every worker (electrode index, intensity, ...)
+    blas_threads : int
+        BLAS/OpenMP threads per worker
+
+    Yields
+    ------
+    task(chunk) for every chunk, in chunk order
+    """
+    shared = leadfield if isinstance(leadfield, SharedLeadfield) else SharedLeadfield(leadfield)
+    try:
+        ctx = mp.get_context('spawn')
+        with thread_limit(blas_threads), ctx.Pool(workers, initializer=_init_worker,
+                                                  initargs=(shared.spec, state or {}, blas_threads)) as pool:
+            for result in pool.imap(task, chunks):
+                yield result
+    finally:
+        if shared is not leadfield:
+            shared.close()
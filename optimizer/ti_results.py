@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import h5py
+import numpy as np
+
+'''
+Optimized for optimizer pipeline
+
+This module implements the single-geometry results container of ti_sim.py (--output hdf5).
+Instead of deep-copying and writing the full head mesh for every electrode combination,
+the mesh geometry is stored once and the TImax of every combination is stored as one row
+of a chunked, compressed float32 array, indexed by the electrode quadruple.
+
+File layout (TI_results.hdf5):
+- mesh/           mesh geometry, written with Msh.write_hdf5
+- TImax           (N_combinations x N_elements) float32, one chunked row per combination
+- combinations    (N_combinations x 4) electrode names (E1+, E1-, E2+, E2-)
+
+Any combination can be exported to a standalone .msh (with its .opt view) on demand:
+
+    simnibs_python ti_results.py TI_results.hdf5 E076 E172 E097 E162 [-o out.msh]
+    simnibs_python ti_results.py TI_results.hdf5 --list
+'''
+
+RESULTS_FILENAME = 'TI_results.hdf5'
+MESH_PATH = 'mesh/'
+# Elements per chunk along a TImax row (4 MB of float32)
+CHUNK_ELEMENTS = 1 << 20
+
+# Define color variables
+RESET = '\033[0m'
+RED = '\033[0;31m'     # Red for errors
+GREEN = '\033[0;32m'   # Green for success messages and prompts
+CYAN = '\033[0;36m'    # Cyan for actions being performed
+
+
+def combination_key(combination):
+    """Flattens ((e1+, e1-), (e2+, e2-)) or (e1+, e1-, e2+, e2-) to a tuple of four names."""
+    if len(combination) == 2:
+        (e1p, e1m), (e2p, e2m) = combination
+        return (e1p, e1m, e2p, e2m)
+    return tuple(combination)
+
+
+def mesh_filename(combination):
+    """Name of the mesh ti_sim.py writes for a combination in mesh output mode."""
+    e1p, e1m, e2p, e2m = combination_key(combination)
+    return f"TI_field_{e1p}_{e1m}_and_{e2p}_{e2m}.msh"
+
+
+class TIResultsWriter:
+    """
+    writes the geometry once and TImax of every combination as a float32 row
+
+    Parameters
+    ----------
+    filename : str
+        output HDF5 file (overwritten)
+    mesh : simnibs.mesh_io.Msh
+        mesh on which TImax is defined
+    combinations : list
+        all combinations, in the order their rows are written
+    compression : str
+        HDF5 compression filter of the TImax rows
+    """
+
+    def __init__(self, filename, mesh, combinations, compression='gzip'):
+        self.filename = filename
+        if os.path.exists(filename):
+            os.remove(filename)
+        mesh.write_hdf5(filename, MESH_PATH)
+        n_elements = mesh.elm.nr
+        self._file = h5py.File(filename, 'a')
+        keys = np.array([combination_key(c) for c in combinations], dtype='S').reshape(-1, 4)
+        self._file.create_dataset('combinations', data=keys)
+        self._TImax = self._file.create_dataset(
+            'TImax', shape=(len(combinations), n_elements), dtype=np.float32,
+            chunks=(1, min(n_elements, CHUNK_ELEMENTS)), compression=compression, shuffle=True)
+
+    def write_block(self, start, TImax_block):
+        """Stores the TImax rows of the combinations start, start+1, ..."""
+        self._TImax[start:start + len(TImax_block)] = np.asarray(TImax_block, dtype=np.float32)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TIResults:
+    """
+    read access to a results file written by TIResultsWriter
+
+    TImax rows are read (and decompressed) one at a time, so opening a results
+    file with many combinations is cheap.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = h5py.File(filename, 'r')
+        self._TImax = self._file['TImax']
+        self.combinations = [tuple(name.decode() for name in row) for row in self._file['combinations'][:]]
+        self._index = {c: i for i, c in enumerate(self.combinations)}
+
+    def __len__(self):
+        return len(self.combinations)
+
+    def __contains__(self, combination):
+        return combination_key(combination) in self._index
+
+    def index(self, combination):
+        """Row of a combination, given as (e1+, e1-, e2+, e2-) or ((e1+, e1-), (e2+, e2-))."""
+        key = combination_key(combination)
+        if key not in self._index:
+            raise KeyError(f"Combination {key} is not in {self.filename}")
+        return self._index[key]
+
+    def TImax(self, combination):
+        """TImax of one combination (N_elements,)."""
+        return self._TImax[self.index(combination)]
+
+    def TImax_rows(self, start, stop):
+        """TImax of the combinations start, ..., stop - 1 (n x N_elements)."""
+        return self._TImax[start:stop]
+
+    def read_mesh(self):
+        """Mesh geometry (without fields) stored in the file."""
+        from simnibs import mesh_io
+        return mesh_io.Msh().read_hdf5(self.filename, MESH_PATH)
+
+    def export_msh(self, combination, filename, mesh=None):
+        """
+        writes a standalone mesh with the TImax field of one combination
+
+        The output is the same as the mesh (and .opt view) ti_sim.py writes per
+        combination in mesh output mode. Pass `mesh` when exporting several
+        combinations to read the geometry only once.
+        """
+        from simnibs import mesh_io
+        mout = self.read_mesh() if mesh is None else mesh
+        mout.elmdata = []
+        mout.add_element_field(self.TImax(combination).astype(float), "TImax")
+        mesh_io.write_msh(mout, filename)
+        v = mout.view(visible_tags=[1, 2, 1006], visible_fields="TImax")
+        v.write_opt(filename)
+        return filename
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export combinations from a TI results file to .msh files.')
+    parser.add_argument('results_file', help=f'Path to {RESULTS_FILENAME}')
+    parser.add_argument('electrodes', nargs='*', help='E1+ E1- E2+ E2- of the combination to export')
+    parser.add_argument('-o', '--output', help='Output mesh (default: TI_field_<...>.msh next to the results file)')
+    parser.add_argument('--list', action='store_true', help='List the stored combinations')
+    args = parser.parse_args()
+
+    with TIResults(args.results_file) as results:
+        if args.list:
+            for combination in results.combinations:
+                print(' '.join(combination))
+            sys.exit(0)
+
+        if len(args.electrodes) != 4:
+            print(f"{RED}Error: exactly four electrodes (E1+ E1- E2+ E2-) are required.{RESET}")
+            sys.exit(1)
+        combination = tuple(args.electrodes)
+        if combination not in results:
+            print(f"{RED}Error: combination {' '.join(combination)} not found in {args.results_file}.{RESET}")
+            sys.exit(1)
+
+        output = args.output or os.path.join(os.path.dirname(os.path.abspath(args.results_file)),
+                                             mesh_filename(combination))
+        print(f"{CYAN}Exporting {' '.join(combination)} to {output}...{RESET}")
+        results.export_msh(combination, output)
+        print(f"{GREEN}Mesh written to {output}.{RESET}")
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import heapq
+import numpy as np
+import ti_engine
+
+'''
+Optimized for optimizer pipeline
+
+This module implements the exact top-K montage search of ti_sim.py (--mode topk).
+Instead of enumerating every combination of the E1+/E1-/E2+/E2- lists, the search
+uses an upper bound of the ROI TImax of every electrode pair:
+
+    TImax at an element is at most 2 min(|E1|, |E2|), so the ROI value
+    sum_k w_k TImax_k (w_k >= 0: interpolation weights) is at most
+    min(U(pair 1), U(pair 2)) with U(pair) = 2 sum_k w_k |E_pair,k|.
+
+Pairs are visited in decreasing order of U. Once U drops to the K-th best value
+found so far, every remaining combination of that pair (or every remaining pair)
+is pruned without being evaluated. The result is the same top-K as the exhaustive
+search (up to ties), while only a small part of the combinations is evaluated,
+so whole EEG caps can be searched.
+'''
+
+
+def candidate_pairs(plus, minus, collapse_polarity=False):
+    """
+    electrode pairs (e+, e-) of two electrode lists, without pairs of the same electrode
+
+    With collapse_polarity, a pair whose reversed pair is also a candidate is kept
+    once (TImax does not depend on the polarity of a pair).
+    """
+    pairs = []
+    seen = set()
+    for e_plus in plus:
+        for e_minus in minus:
+            if e_plus == e_minus:
+                continue
+            if collapse_polarity:
+                key = frozenset((e_plus, e_minus))
+                if key in seen:
+                    continue
+                seen.add(key)
+            pairs.append((e_plus, e_minus))
+    return pairs
+
+
+def get_pair_bounds(pair_fields, roi_weight):
+    """
+    upper bound of the ROI TImax of any combination containing each pair
+
+    Parameters
+    ----------
+    pair_fields : np.ndarray (n_pairs x K x 3)
+        fields of the pairs at the K support elements of the ROI
+    roi_weight : np.ndarray (K,)
+        non-negative interpolation weights of the ROI value
+
+    Returns
+    -------
+    bounds : np.ndarray (n_pairs,)
+        2 * sum_k w_k |E_pair,k|
+    """
+    return 2 * np.linalg.norm(pair_fields, axis=-1) @ roi_weight
+
+
+def search_topk(pairs1, pairs2, leadfield_roi, idx_lf, intensity, roi_weight, k,
+                block_size=ti_engine.DEFAULT_ROI_BLOCK_SIZE, key=None, exclude=None):
+    """
+    exact top-K combinations by ROI TImax, with branch-and-bound pruning
+
+    Parameters
+    ----------
+    pairs1, pairs2 : list of (str, str)
+        candidate electrode pairs of channel 1 and channel 2
+    leadfield_roi : np.ndarray (N_elec-1 x K x 3)
+        leadfield at the K support elements of the ROI
+    idx_lf : dict
+        mapping from electrode name to row in the leadfield
+    intensity : float
+        current of both electrode pairs
+    roi_weight : np.ndarray (K,)
+        non-negative weights; the ROI value of a combination is roi_weight @ TImax
+    k : int
+        number of combinations to return
+    block_size : int
+        number of channel 2 pairs evaluated at once
+    key : callable, optional
+        canonical form of a combination; combinations with the same key as an
+        already evaluated one are skipped
+    exclude : callable, optional
+        returns True for combinations that must not be part of the result
+
+    Returns
+    -------
+    top : list of (float, combination)
+        best combinations, by decreasing ROI value
+    stats : dict
+        number of 'candidates', and how many were 'evaluated', 'pruned' by the
+        bound and 'skipped' as equivalent or excluded
+    """
+    fields1 = ti_engine.get_pair_fields([(p, m, intensity) for p, m in pairs1], leadfield_roi, idx_lf)
+    fields2 = fields1 if pairs2 == pairs1 else \
+        ti_engine.get_pair_fields([(p, m, intensity) for p, m in pairs2], leadfield_roi, idx_lf)
+    bounds1 = get_pair_bounds(fields1, roi_weight)
+    bounds2 = get_pair_bounds(fields2, roi_weight)
+    order1 = np.argsort(-bounds1, kind='stable')
+    order2 = np.argsort(-bounds2, kind='stable')
+    sorted_bounds2 = bounds2[order2]
+
+    stats = dict(candidates=len(pairs1) * len(pairs2), evaluated=0, pruned=0, skipped=0)
+    heap = []  # min-heap of (value, counter, combination) holding the best k so far
+    seen = set()
+    counter = 0
+
+    def threshold():
+        return heap[0][0] if len(heap) == k else -np.inf
+
+    for rank, i in enumerate(order1):
+        if bounds1[i] <= threshold():
+            # Pairs are sorted by bound: no remaining combination can enter the top-K
+            stats['pruned'] += (len(order1) - rank) * len(pairs2)
+            break
+        n_candidates = len(pairs2)
+        for start in range(0, len(pairs2), block_size):
+            if sorted_bounds2[start] <= threshold():
+                n_candidates = start
+                break
+            js = order2[start:start + block_size]
+            js = js[sorted_bounds2[start:start + len(js)] > threshold()]
+
+            block = []
+            for j in js:
+                combination = (pairs1[i], pairs2[j])
+                if exclude is not None and exclude(combination):
+                    stats['skipped'] += 1
+                    continue
+                if key is not None:
+                    combination_key = key(combination)
+                    if combination_key in seen:
+                        stats['skipped'] += 1
+                        continue
+                    seen.add(combination_key)
+                block.append((j, combination))
+            stats['pruned'] += min(block_size, len(pairs2) - start) - len(js)
+            if not block:
+                continue
+
+            fields = fields2[[j for j, _ in block]]
+            values = ti_engine.get_maxTI_batch(np.broadcast_to(fields1[i], fields.shape), fields) @ roi_weight
+            stats['evaluated'] += len(block)
+            for value, (_, combination) in zip(values, block):
+                entry = (float(value), counter, combination)
+                counter += 1
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry[0] > heap[0][0]:
+                    heapq.heapreplace(heap, entry)
+        stats['pruned'] += len(pairs2) - n_candidates
+
+    top = [(value, combination) for value, _, combination in sorted(heap, key=lambda e: (-e[0], e[1]))]
+    return top, stats
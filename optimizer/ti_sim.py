@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
+import argparse
+import contextlib
 import copy
+import csv
 import os
 import re
 import sys  # Added for better exception handling
@@ -8,6 +11,17 @@ import numpy as np
 from itertools import product
 from simnibs import mesh_io
 from simnibs.utils import TI_utils as TI
+import field_metrics
+import gm_leadfield
+import leadfield_access
+import mesh_geometry
+import results_store
+import roi_scoring
+import ti_engine
+import ti_evolve
+import ti_parallel
+import ti_results
+import ti_search
 
 '''
 Ido Haber - ihaber@wisc.edu
@@ -23,8 +37,42 @@ based on two types of leadfields:
 2. Surface Leadfield:
    - Used for calculating TI_localnorm, the TI amplitude along the local normal orientation in gray matter.
 
-The script generates all possible electrode pair combinations, calculates the corresponding electric fields, 
-and exports the results in mesh format for further visualization.
+The script generates all possible electrode pair combinations (optionally skipping, with --deduplicate,
+pairs of the same electrode and montages that are equivalent because TI_max does not depend on pair
+polarity or pair order, and montages with shared electrodes or electrodes closer than --min-distance), calculates the corresponding electric fields, 
+and exports the results in mesh format for further visualization. The fields and TI_max of the combinations
+are computed in blocks (see ti_engine.py); the block size is set with --block-size. The field of every
+electrode pair is computed once and reused by all combinations containing it, up to the memory budget
+set with --pair-cache-mb.
+
+With --mode roi no meshes are written: TI_max is evaluated in memory at the ROI coordinates
+listed in roi_list.txt and the results are written directly to output.csv (see roi_scoring.py).
+With --current-ratios N every combination is also scored for N splits of the total current between the
+two pairs, from the same pair fields, and the best split is written to output.csv.
+
+With --workers N the combinations are split into chunks that are processed by N worker processes
+sharing the leadfield through shared memory (see ti_parallel.py); the output is the same as the serial run.
+
+The leadfield is opened lazily (see leadfield_access.py): only the rows of the selected electrodes are
+read, so memory use follows the electrode lists rather than the whole cap. --full-leadfield restores
+TI.load_leadfield.
+
+With --output hdf5 the mesh geometry is stored once and TI_max of every combination is stored as a
+compressed float32 row of TI_results.hdf5; single combinations are exported to .msh on demand with
+ti_results.py.
+
+With --metrics the peak and focality metrics of every combination (summary.csv, see field_metrics.py)
+are computed on the gray matter part of the leadfield only, cached once per subject next to the
+leadfield (see gm_leadfield.py). --metrics-backend sketch replaces the sort per combination by a streaming
+quantile sketch and recomputes the exact metrics of the best combinations only.
+
+With --mode topk the exact top-K montages by ROI TI_max are searched with branch-and-bound pruning
+(see ti_search.py) instead of evaluating every combination; with 'all' as electrode list the whole
+EEG cap is searched.
+
+With --mode evolve a genetic algorithm searches the montages (see ti_evolve.py), optionally penalizing
+the field at a sample of off-target gray matter elements, within an evaluation or time budget; its
+population is checkpointed so that the search can be resumed with --resume.
 '''
 
 # Define color variables
@@ -36,14 +84,88 @@ GREEN = '\033[0;32m'   # Green for success messages and prompts
 CYAN = '\033[0;36m'    # Cyan for actions being performed
 BOLD_CYAN = '\033[1;36m'
 
-# Function to generate all combinations
-def generate_combinations(E1_plus, E1_minus, E2_plus, E2_minus):
+# Electrode list entry that selects every electrode of the leadfield
+ALL_ELECTRODES = 'all'
+
+# Options of the evolve mode; callers of process_leadfield override only the ones they set.
+# Without max_evaluations and max_seconds, 100 x population montages are evaluated.
+DEFAULT_EVOLVE_OPTIONS = dict(seed=None, population=ti_evolve.DEFAULT_POPULATION, max_evaluations=None,
+                              max_seconds=None, off_target_weight=0.0, off_target_samples=5000, checkpoint=None,
+                              resume=False)
+
+# Function to read electrode positions (label -> xyz) from an EEG cap CSV file
+def read_electrode_positions(cap_file):
+    positions = {}
+    with open(cap_file, 'r') as file:
+        for row in csv.reader(file):
+            if len(row) < 5:
+                continue
+            try:
+                positions[row[4].strip()] = np.array([float(v) for v in row[1:4]])
+            except ValueError:
+                continue  # header line
+    return positions
+
+# Canonical form of a combination: TImax is invariant to flipping the polarity of a pair
+# and to swapping the two pairs
+def canonical_combination(combination):
+    return tuple(sorted(tuple(sorted(pair)) for pair in combination))
+
+# Function to check a combination against the montage constraints
+# Returns the reason why the combination is excluded, or None
+def excluded_reason(combination, allow_shared=True, min_distance=None, positions=None):
+    electrodes = [e for pair in combination for e in pair]
+    if not allow_shared and len(set(electrodes)) < 4:
+        return 'shared electrode'
+    if min_distance and any(np.linalg.norm(positions[a] - positions[b]) < min_distance
+                            for i, a in enumerate(electrodes) for b in electrodes[i + 1:] if a != b):
+        return 'electrodes too close'
+    return None
+
+# Function to exit with an error if electrodes of the montages have no position in the EEG cap CSV
+def check_electrode_positions(electrodes, positions):
+    missing = [e for e in dict.fromkeys(electrodes) if e not in positions]
+    if missing:
+        print(f"{RED}Error: electrodes not found in the EEG cap positions: {', '.join(missing)}{RESET}")
+        sys.exit(1)
+
+# Function to generate all combinations, optionally pruning degenerate, equivalent and excluded montages
+def generate_combinations(E1_plus, E1_minus, E2_plus, E2_minus, deduplicate=False, allow_shared=True,
+                          min_distance=None, positions=None):
     print(f"{CYAN}Generating all electrode pair combinations...{RESET}")
+    if min_distance and positions is None:
+        raise ValueError("Electrode positions are required for a minimum inter-electrode distance")
+    if min_distance:
+        check_electrode_positions(E1_plus + E1_minus + E2_plus + E2_minus, positions)
+
     combinations = []
+    seen = set()
+    pruned = {'same electrode in a pair': 0, 'equivalent montage': 0,
+              'shared electrode': 0, 'electrodes too close': 0}
     for e1p, e1m in product(E1_plus, E1_minus):
         for e2p, e2m in product(E2_plus, E2_minus):
-            combinations.append(((e1p, e1m), (e2p, e2m)))
+            combination = ((e1p, e1m), (e2p, e2m))
+            if deduplicate:
+                # A pair with the same electrode twice carries no current
+                if e1p == e1m or e2p == e2m:
+                    pruned['same electrode in a pair'] += 1
+                    continue
+                key = canonical_combination(combination)
+                if key in seen:
+                    pruned['equivalent montage'] += 1
+                    continue
+                seen.add(key)
+            reason = excluded_reason(combination, allow_shared, min_distance, positions)
+            if reason:
+                pruned[reason] += 1
+                continue
+            combinations.append(combination)
+
+    total_pruned = sum(pruned.values())
     print(f"{GREEN}Total combinations generated: {len(combinations)}{RESET}")
+    if total_pruned:
+        details = ', '.join(f"{count} {reason}" for reason, count in pruned.items() if count)
+        print(f"{GREEN}Pruned {total_pruned} combinations ({details}).{RESET}")
     return combinations
 
 # Function to get user input for electrode lists
@@ -51,6 +173,10 @@ def get_electrode_list(prompt):
     pattern = re.compile(r'^E\d{3}$')  # Match 'E' followed by exactly three digits
     while True:
         user_input = input(f"{GREEN}{prompt}{RESET}").strip()
+        # 'all' selects every electrode of the leadfield (EEG cap)
+        if user_input.lower() == ALL_ELECTRODES:
+            print(f"{GREEN}Electrode list accepted: all electrodes of the cap{RESET}")
+            return [ALL_ELECTRODES]
         # Replace commas with spaces and split into a list
         electrodes = user_input.replace(',', ' ').split()
         # Validate electrodes
@@ -71,107 +197,514 @@ def get_intensity(prompt):
         except ValueError:
             print(f"{RED}Please enter a valid number for the intensity of stimulation.{RESET}")
 
-# Function to process lead field and generate the meshes
-def process_leadfield(leadfield_type, E1_plus, E1_minus, E2_plus, E2_minus, intensity, project_dir, subject_name):
-    print(f"{CYAN}Starting processing for {leadfield_type} leadfield...{RESET}")
-    
-    # Construct leadfield directory and HDF5 file path
-    leadfield_dir = os.path.join(project_dir, f"Subjects/leadfield_{leadfield_type}_{subject_name}")
-    leadfield_hdf = os.path.join(leadfield_dir, f"{subject_name}_leadfield_{os.getenv('EEG_CAP', 'EGI_template')}.hdf5")
-    
-    print(f"{CYAN}Leadfield Directory: {leadfield_dir}{RESET}")
-    print(f"{CYAN}Leadfield HDF5 Path: {leadfield_hdf}{RESET}")
-    
-    # Attempt to load leadfield
-    try:
-        print(f"{CYAN}Loading leadfield from {leadfield_hdf}...{RESET}")
-        leadfield, mesh, idx_lf = TI.load_leadfield(leadfield_hdf)
-        print(f"{GREEN}Leadfield loaded successfully.{RESET}")
-    except Exception as e:
-        print(f"{RED}Error loading leadfield: {e}{RESET}")
-        return
-    
-    # Set the output directory based on the project directory and subject name
-    output_dir = os.path.join(project_dir, f"Simulations/opt_{subject_name}")
-    print(f"{CYAN}Output Directory: {output_dir}{RESET}")
-    
-    # Create output directory if it doesn't exist
-    if not os.path.exists(output_dir):
-        print(f"{CYAN}Output directory does not exist. Creating {output_dir}...{RESET}")
-        os.makedirs(output_dir)
-        print(f"{GREEN}Output directory created.{RESET}")
-    else:
-        print(f"{GREEN}Output directory already exists.{RESET}")
-    
-    # Generate all electrode pair combinations
-    all_combinations = generate_combinations(E1_plus, E1_minus, E2_plus, E2_minus)
-    total_combinations = len(all_combinations)  # Calculate total configurations
-    print(f"{CYAN}Starting TI simulation for {total_combinations} electrode combinations...{RESET}")
-    
-    # Iterate through all combinations of electrode pairs
-    for i, ((e1p, e1m), (e2p, e2m)) in enumerate(all_combinations):
-        print(f"{CYAN}Processing combination {i+1}/{total_combinations}: "
-              f"{e1p}-{e1m} and {e2p}-{e2m}{RESET}")
-        TIpair1 = [e1p, e1m, intensity]
-        TIpair2 = [e2p, e2m, intensity]
-    
-        # Get fields for the two pairs
-        try:
-            print(f"{CYAN}Calculating fields for {e1p}-{e1m} and {e2p}-{e2m}...{RESET}")
-            ef1 = TI.get_field(TIpair1, leadfield, idx_lf)
-            ef2 = TI.get_field(TIpair2, leadfield, idx_lf)
-            print(f"{GREEN}Fields calculated successfully.{RESET}")
-        except Exception as e:
-            print(f"{RED}Error calculating fields for electrodes {e1p}, {e1m}, {e2p}, {e2m}: {e}{RESET}")
-            continue
-    
+# Function to write the TI_max mesh (and its optimized view) of every combination
+# Yields (index, combination, mesh filename, error message or None) in combination order
+def write_TI_meshes(combinations, start, leadfield, mesh, idx_lf, intensity, output_dir, block_size, cache=None):
+    results = ti_engine.iter_TImax(combinations, leadfield, idx_lf, intensity, block_size, cache)
+    for i, combination, TImax in results:
+        (e1p, e1m), (e2p, e2m) = combination
+        mesh_filename = os.path.join(output_dir, f"TI_field_{e1p}_{e1m}_and_{e2p}_{e2m}.msh")
+
         # Add to mesh for later visualization
         mout = copy.deepcopy(mesh)
-        print(f"{CYAN}Deep copied mesh for modification.{RESET}")
-    
-        # Calculate the maximal TI amplitude for vol
-        print(f"{CYAN}Calculating TI_max for the current electrode pair...{RESET}")
-        try:
-            TImax = TI.get_maxTI(ef1, ef2)
-            print(f"{GREEN}TI_max calculated: {TImax}{RESET}")
-        except Exception as e:
-            print(f"{RED}Error calculating TI_max: {e}{RESET}")
-            continue
-    
         mout.add_element_field(TImax, "TImax")  # for visualization
-        mesh_filename = os.path.join(output_dir, f"TI_field_{e1p}_{e1m}_and_{e2p}_{e2m}.msh")
         visible_field = "TImax"
-        print(f"{CYAN}Mesh Filename: {mesh_filename}{RESET}")
-    
+
         # Save the updated mesh with a unique name in the output directory
         try:
-            print(f"{CYAN}Writing mesh to file...{RESET}")
             mesh_io.write_msh(mout, mesh_filename)
-            print(f"{GREEN}Mesh written to {mesh_filename}.{RESET}")
         except Exception as e:
-            print(f"{RED}Error writing mesh to file: {e}{RESET}")
+            yield start + i, combination, mesh_filename, f"Error writing mesh to file: {e}"
             continue
-        
+
         # Attempt to create an optimized view of the mesh
         try:
-            print(f"{CYAN}Creating optimized view for mesh...{RESET}")
             v = mout.view(
                 visible_tags=[1, 2, 1006],
                 visible_fields=visible_field,
             )
             v.write_opt(mesh_filename)
-            print(f"{GREEN}Optimized view written to {mesh_filename}.{RESET}")
         except Exception as e:
-            print(f"{RED}Error creating optimized view: {e}{RESET}")
+            yield start + i, combination, mesh_filename, f"Error creating optimized view: {e}"
             continue
+
+        yield start + i, combination, mesh_filename, None
+
+# Worker task of the parallel mesh mode: writes the meshes of one chunk of combinations
+def _write_mesh_chunk(chunk):
+    start, combinations = chunk
+    state = ti_parallel.worker_state()
+    return list(write_TI_meshes(combinations, start, ti_parallel.worker_leadfield(), state['mesh'],
+                                state['idx_lf'], state['intensity'], state['output_dir'], state['block_size'],
+                                _worker_cache(state)))
+
+# Function to get the pair field cache of a worker process (kept across the chunks of the worker)
+def _worker_cache(state):
+    if not state['cache_bytes']:
+        return None
+    return ti_engine.get_pair_cache(ti_parallel.worker_leadfield(), state['idx_lf'], state['cache_bytes'])
+
+# Function to get the session's pair field cache of a leadfield, or None if caching is disabled
+def get_pair_cache(leadfield, idx_lf, cache_bytes):
+    if not cache_bytes:
+        return None
+    if isinstance(leadfield, ti_parallel.SharedLeadfield):
+        leadfield = leadfield.array
+    return ti_engine.get_pair_cache(leadfield, idx_lf, cache_bytes)
+
+# Function to report the hits of a pair field cache
+def print_cache_stats(cache):
+    if cache is not None:
+        print(f"{GREEN}Pair field cache: {cache.misses} pair fields computed, {cache.hits} reused, "
+              f"{cache.evictions} evicted ({cache.nbytes / 1024 ** 2:.0f} MB cached).{RESET}")
+
+# Function to store the TImax of all combinations in one results file (see ti_results.py)
+def write_TI_results(all_combinations, leadfield, mesh, idx_lf, intensity, output_dir, block_size, workers=1,
+                     cache_bytes=ti_engine.DEFAULT_CACHE_BYTES):
+    results_file = os.path.join(output_dir, ti_results.RESULTS_FILENAME)
+    total_combinations = len(all_combinations)
+    print(f"{CYAN}Writing TI_max of {total_combinations} combinations to {results_file}...{RESET}")
+    if workers > 1:
+        cache = None
+        state = dict(idx_lf=idx_lf, intensity=intensity, block_size=block_size, cache_bytes=cache_bytes)
+        chunks = ti_parallel.index_chunks(all_combinations, workers * 4)
+        blocks = zip((start for start, _ in chunks),
+                     ti_parallel.imap_chunks(_TImax_chunk, chunks, leadfield, workers, state))
+    else:
+        cache = get_pair_cache(leadfield, idx_lf, cache_bytes)
+        blocks = ((start, TImax_block) for start, _, TImax_block in
+                  ti_engine.iter_TImax_blocks(all_combinations, leadfield, idx_lf, intensity, block_size, cache))
+
+    with ti_results.TIResultsWriter(results_file, mesh, all_combinations) as writer:
+        for start, TImax_block in blocks:
+            writer.write_block(start, TImax_block)
+            progress_str = f"{start + len(TImax_block):03}/{total_combinations}"
+            print(f"{BOLD}Progress: {progress_str} - TI_max stored.{RESET}")
+    print_cache_stats(cache)
+    print(f"{GREEN}Results written to {results_file}. Export single combinations with ti_results.py.{RESET}")
+
+# Worker task of the parallel results file mode: computes the float32 TImax rows of one chunk
+def _TImax_chunk(chunk):
+    _, combinations = chunk
+    state = ti_parallel.worker_state()
+    return np.concatenate([TImax_block.astype(np.float32) for _, _, TImax_block in
+                           ti_engine.iter_TImax_blocks(combinations, ti_parallel.worker_leadfield(),
+                                                       state['idx_lf'], state['intensity'], state['block_size'],
+                                                       _worker_cache(state))])
+
+# Function to compute the gray matter peak and focality metrics of every combination and write summary.csv
+# With the sketch backend the percentiles and focality are approximate (see field_metrics.QuantileSketch),
+# except for the exact_top combinations with the highest rank_by metric, which are recomputed exactly
+def write_gm_summary(all_combinations, leadfield_hdf, mesh, intensity, output_dir, block_size,
+                     tags=gm_leadfield.DEFAULT_TAGS, cache_bytes=ti_engine.DEFAULT_CACHE_BYTES, backend='exact',
+                     exact_top=10, rank_by='PercentileValue_99.9', geometry_store=None):
+    get_metrics_batch = field_metrics.get_metrics_sketch_batch if backend == 'sketch' \
+        else field_metrics.get_metrics_batch
+    with gm_leadfield.load_gm_leadfield(leadfield_hdf, tags, mesh, geometry_store=geometry_store) as gm:
+        print(f"{CYAN}Computing peak and focality metrics ({backend}) on {len(gm.elements)} elements of tags "
+              f"{list(gm.tags)}...{RESET}")
+        cache = get_pair_cache(gm.leadfield, gm.idx_lf, cache_bytes)
+        results = [(ti_results.mesh_filename(combination), metrics)
+                   for _, block, TImax_block in ti_engine.iter_TImax_blocks(all_combinations, gm.leadfield,
+                                                                            gm.idx_lf, intensity, block_size, cache)
+                   for combination, metrics in zip(block, get_metrics_batch(TImax_block, gm.volumes,
+                                                                            gm.centroids))]
+
+        if backend == 'sketch' and exact_top:
+            column = field_metrics.summary_header().index(rank_by)
+            ranking = np.array([field_metrics.summary_row(name, metrics)[column] for name, metrics in results])
+            top = np.argsort(-ranking, kind='stable')[:exact_top]
+            print(f"{CYAN}Recomputing the exact metrics of the top {len(top)} combinations by {rank_by}...{RESET}")
+            top_combinations = [all_combinations[i] for i in top]
+            for start, block, TImax_block in ti_engine.iter_TImax_blocks(top_combinations, gm.leadfield, gm.idx_lf,
+                                                                         intensity, block_size, cache):
+                exact = field_metrics.get_metrics_batch(TImax_block, gm.volumes, gm.centroids)
+                for j, (combination, metrics) in enumerate(zip(block, exact)):
+                    results[top[start + j]] = (ti_results.mesh_filename(combination), metrics)
+
+        results_dir = os.path.join(output_dir, 'results')
+        os.makedirs(results_dir, exist_ok=True)
+        csv_path = os.path.join(results_dir, 'summary.csv')
+        with results_store.open_store(output_dir) as store:
+            n_rows = field_metrics.write_summary_csv(csv_path, results, region_idx=gm.tags, store=store)
+        print_cache_stats(cache)
+    print(f"{GREEN}Metrics of {n_rows} combinations written to {csv_path}.{RESET}")
+
+# Function to read the ROIs of a subject and compute their interpolation weights on the leadfield mesh
+def load_rois(mesh, project_dir, subject_name):
+    roi_directory = os.path.join(project_dir, f"Subjects/m2m_{subject_name}/ROIs")
+    roi_names, roi_coordinates = roi_scoring.read_roi_coordinates(roi_directory)
+    print(f"{CYAN}Computing interpolation weights for ROIs {roi_names}...{RESET}")
+    support, weights, inside = roi_scoring.get_interpolation_weights(mesh, roi_coordinates)
+    for name, is_inside in zip(roi_names, inside):
+        if not is_inside:
+            print(f"{RED}ROI {name} lies outside the leadfield mesh; its TImax is left empty.{RESET}")
+    print(f"{GREEN}Interpolation uses {len(support)} leadfield elements.{RESET}")
+    return roi_names, support, weights, inside
+
+# Function to build a grid of current ratios (fraction of the total current carried by pair 1)
+# The grid is symmetric around 0.5, so that swapping the two pairs maps it onto itself and equivalent
+# montages stay equivalent
+def get_current_ratios(n_ratios, min_ratio=0.1):
+    if not 0 < min_ratio <= 0.5:
+        raise ValueError("The minimum current ratio must be in (0, 0.5]")
+    return np.linspace(min_ratio, 1 - min_ratio, n_ratios)
+
+# Function to score all combinations at the ROIs in memory and write output.csv directly
+def score_rois(all_combinations, leadfield, mesh, idx_lf, intensity, project_dir, subject_name, output_dir,
+               block_size=ti_engine.DEFAULT_ROI_BLOCK_SIZE, workers=1, ratios=None):
+    roi_names, support, weights, inside = load_rois(mesh, project_dir, subject_name)
+
+    print(f"{CYAN}Scoring {len(all_combinations)} combinations in blocks of {block_size}...{RESET}")
+    if ratios is not None:
+        print(f"{CYAN}Sweeping {len(ratios)} current ratios of pair 1 from {ratios[0]:.3g} to {ratios[-1]:.3g} "
+              f"at a total current of {2 * intensity} V...{RESET}")
+    results = roi_scoring.score_combinations(all_combinations, leadfield, idx_lf, intensity,
+                                             support, weights, inside, block_size, workers, ratios)
+    csv_output_path = os.path.join(output_dir, 'output.csv')
+    with results_store.open_store(output_dir) as store:
+        n_rows = roi_scoring.write_output_csv(csv_output_path, roi_names, results, current_ratio=ratios is not None,
+                                              store=store)
+    print(f"{GREEN}ROI values of {n_rows} combinations written to {csv_output_path}.{RESET}")
+
+# Function to search the top-K combinations by ROI TImax and write them to output.csv
+# The search objective is the mean TImax over the ROIs that lie inside the mesh
+def search_rois(E1_plus, E1_minus, E2_plus, E2_minus, leadfield, mesh, idx_lf, intensity, project_dir,
+                subject_name, output_dir, top_k, block_size=ti_engine.DEFAULT_ROI_BLOCK_SIZE, deduplicate=False,
+                allow_shared=True, min_distance=None, positions=None):
+    roi_names, support, weights, inside = load_rois(mesh, project_dir, subject_name)
+    if not inside.any():
+        print(f"{RED}Error: no ROI lies inside the leadfield mesh.{RESET}")
+        return
+    roi_weight = weights[inside].mean(axis=0)
+    leadfield_roi = np.ascontiguousarray(leadfield[:, support, :])
+
+    pairs1 = ti_search.candidate_pairs(E1_plus, E1_minus, collapse_polarity=deduplicate)
+    pairs2 = ti_search.candidate_pairs(E2_plus, E2_minus, collapse_polarity=deduplicate)
+    exclude = None
+    if not allow_shared or min_distance:
+        exclude = lambda combination: excluded_reason(combination, allow_shared, min_distance, positions) is not None
+    print(f"{CYAN}Searching the top {top_k} of {len(pairs1)} x {len(pairs2)} electrode pair combinations...{RESET}")
+    top, stats = ti_search.search_topk(pairs1, pairs2, leadfield_roi, idx_lf, intensity, roi_weight, top_k,
+                                       block_size, key=canonical_combination if deduplicate else None,
+                                       exclude=exclude)
+    print(f"{GREEN}Evaluated {stats['evaluated']} of {stats['candidates']} candidates "
+          f"({stats['pruned']} pruned by the bound, {stats['skipped']} skipped as equivalent or excluded).{RESET}")
+
+    # Per-ROI values of the best combinations, in the output.csv format of the roi mode
+    results = roi_scoring.score_combinations([combination for _, combination in top], leadfield_roi, idx_lf,
+                                             intensity, np.arange(len(support)), weights, inside, block_size)
+    csv_output_path = os.path.join(output_dir, 'output.csv')
+    with results_store.open_store(output_dir) as store:
+        n_rows = roi_scoring.write_output_csv(csv_output_path, roi_names, results, store=store)
+    print(f"{GREEN}ROI values of the top {n_rows} combinations written to {csv_output_path}.{RESET}")
+
+# Function to sample off-target elements: gray matter tetrahedra outside the ROI support
+def sample_off_target_elements(mesh, support, n_samples, seed=None, tag=2):
+    candidates = np.flatnonzero((mesh.elm.elm_type == 4) & (mesh.elm.tag1 == tag))
+    candidates = np.setdiff1d(candidates, support)
+    if n_samples >= len(candidates):
+        return candidates
+    return np.sort(np.random.default_rng(seed).choice(candidates, size=n_samples, replace=False))
+
+# Function to search montages with the genetic algorithm and write the best ones to output.csv
+def evolve_rois(E1_plus, E1_minus, E2_plus, E2_minus, leadfield, mesh, idx_lf, intensity, project_dir,
+                subject_name, output_dir, top_k, options, allow_shared=True, min_distance=None, positions=None):
+    roi_names, support, weights, inside = load_rois(mesh, project_dir, subject_name)
+    if not inside.any():
+        print(f"{RED}Error: no ROI lies inside the leadfield mesh.{RESET}")
+        return
+    roi_weight = weights[inside].mean(axis=0)
+    options = dict(DEFAULT_EVOLVE_OPTIONS, **(options or {}))
+    if options['max_evaluations'] is None and options['max_seconds'] is None:
+        options['max_evaluations'] = 100 * options['population']
+
+    off_target = np.array([], dtype=int)
+    if options['off_target_weight']:
+        off_target = sample_off_target_elements(mesh, support, options['off_target_samples'], options['seed'])
+        print(f"{CYAN}Penalizing the mean TImax at {len(off_target)} off-target gray matter elements "
+              f"with weight {options['off_target_weight']}.{RESET}")
+    leadfield_sel = np.ascontiguousarray(leadfield[:, np.concatenate([support, off_target]), :])
+
+    electrodes = list(dict.fromkeys(E1_plus + E1_minus + E2_plus + E2_minus))
+    index = {e: i for i, e in enumerate(electrodes)}
+    candidates = [[index[e] for e in electrode_list] for electrode_list in (E1_plus, E1_minus, E2_plus, E2_minus)]
+    exclude = None
+    if not allow_shared or min_distance:
+        exclude = lambda montage: excluded_reason(((electrodes[montage[0]], electrodes[montage[1]]),
+                                                   (electrodes[montage[2]], electrodes[montage[3]])),
+                                                  allow_shared, min_distance, positions) is not None
+
+    fitness = ti_evolve.MontageFitness(leadfield_sel, idx_lf, electrodes, intensity, roi_weight,
+                                       options['off_target_weight'])
+    search = ti_evolve.EvolutionarySearch(fitness, candidates, options['population'], options['seed'], exclude,
+                                          electrodes=electrodes)
+    checkpoint = options['checkpoint'] or os.path.join(output_dir, 'evolve_checkpoint.npz')
+    if options['resume'] and os.path.exists(checkpoint):
+        search.load(checkpoint)
+        print(f"{GREEN}Resumed search from {checkpoint} at generation {search.generation} "
+              f"({search.evaluations} montages evaluated).{RESET}")
+
+    def report(search):
+        best_fitness, best_roi, best_off_target, _ = search.best()[0]
+        print(f"{BOLD}Generation {search.generation:03}: {search.evaluations} montages evaluated, "
+              f"best fitness {best_fitness:.6g} (ROI {best_roi:.6g}, off-target {best_off_target:.6g}){RESET}")
+
+    print(f"{CYAN}Evolving a population of {options['population']} montages...{RESET}")
+    search.run(options['max_evaluations'], options['max_seconds'], checkpoint, report)
+    print(f"{GREEN}Search finished after {search.generation} generations and {search.evaluations} evaluations; "
+          f"population checkpointed to {checkpoint}.{RESET}")
+
+    # Per-ROI values of the best montages, in the output.csv format of the roi mode
+    top = [((electrodes[m[0]], electrodes[m[1]]), (electrodes[m[2]], electrodes[m[3]]))
+           for _, _, _, m in search.best(top_k)]
+    results = roi_scoring.score_combinations(top, leadfield_sel, idx_lf, intensity, np.arange(len(support)),
+                                             weights, inside)
+    csv_output_path = os.path.join(output_dir, 'output.csv')
+    with results_store.open_store(output_dir) as store:
+        n_rows = roi_scoring.write_output_csv(csv_output_path, roi_names, results, store=store)
+    print(f"{GREEN}ROI values of the best {n_rows} montages written to {csv_output_path}.{RESET}")
+
+# Function to process lead field and generate the meshes
+def process_leadfield(leadfield_type, E1_plus, E1_minus, E2_plus, E2_minus, intensity, project_dir, subject_name,
+                      block_size=None, mode='mesh', workers=1, lazy_leadfield=True,
+                      output_format='msh', deduplicate=False, allow_shared=True, min_distance=None,
+                      cache_bytes=ti_engine.DEFAULT_CACHE_BYTES, top_k=10, evolve_options=None, ratios=None,
+                      metrics_tags=None, metrics_backend='exact', metrics_exact_top=10,
+                      metrics_rank_by='PercentileValue_99.9'):
+    print(f"{CYAN}Starting processing for {leadfield_type} leadfield...{RESET}")
+    
+    # Construct leadfield directory and HDF5 file path
+    leadfield_dir = os.path.join(project_dir, f"Subjects/leadfield_{leadfield_type}_{subject_name}")
+    leadfield_hdf = os.path.join(leadfield_dir, f"{subject_name}_leadfield_{os.getenv('EEG_CAP', 'EGI_template')}.hdf5")
     
-        # Progress indicator (formatted as 003/256)
-        progress_str = f"{i+1:03}/{total_combinations}"
-        print(f"{BOLD}Progress: {progress_str} - Mesh saved.{RESET}\n")
+    print(f"{CYAN}Leadfield Directory: {leadfield_dir}{RESET}")
+    print(f"{CYAN}Leadfield HDF5 Path: {leadfield_hdf}{RESET}")
     
-    print(f"{BOLD_CYAN}TI simulation and mesh generation completed for subject {subject_name}.{RESET}")
+    # Attempt to load leadfield; by default only the rows of the selected electrodes are read
+    electrodes = list(dict.fromkeys(E1_plus + E1_minus + E2_plus + E2_minus))
+    cache_rows = None if ALL_ELECTRODES in electrodes else len(electrodes)
+    try:
+        leadfield = None
+        if lazy_leadfield:
+            print(f"{CYAN}Opening leadfield {leadfield_hdf} for lazy access...{RESET}")
+            try:
+                leadfield, mesh, idx_lf = leadfield_access.load_leadfield(leadfield_hdf, cache_rows=cache_rows)
+                access = "memory-mapped" if leadfield.memory_mapped else "chunk-read"
+                print(f"{GREEN}Leadfield opened ({access}, caching up to {cache_rows or len(leadfield)} "
+                      f"electrode rows).{RESET}")
+            except (KeyError, ValueError) as e:
+                print(f"{RED}Lazy leadfield access not possible ({e}); loading the full leadfield.{RESET}")
+        if leadfield is None:
+            print(f"{CYAN}Loading leadfield from {leadfield_hdf}...{RESET}")
+            leadfield, mesh, idx_lf = TI.load_leadfield(leadfield_hdf)
+            print(f"{GREEN}Leadfield loaded successfully.{RESET}")
+    except Exception as e:
+        print(f"{RED}Error loading leadfield: {e}{RESET}")
+        return
+
+    # The lazy leadfield keeps its HDF5 file open until processing ends
+    with (leadfield if isinstance(leadfield, leadfield_access.LazyLeadfield) else contextlib.nullcontext()):
+        # Expand 'all' to every electrode of the leadfield
+        E1_plus, E1_minus, E2_plus, E2_minus = [list(idx_lf) if ALL_ELECTRODES in electrode_list else electrode_list
+                                                for electrode_list in (E1_plus, E1_minus, E2_plus, E2_minus)]
+        electrodes = list(dict.fromkeys(E1_plus + E1_minus + E2_plus + E2_minus))
+
+        # Set the output directory based on the project directory and subject name
+        output_dir = os.path.join(project_dir, f"Simulations/opt_{subject_name}")
+        print(f"{CYAN}Output Directory: {output_dir}{RESET}")
+
+        # Create output directory if it doesn't exist
+        if not os.path.exists(output_dir):
+            print(f"{CYAN}Output directory does not exist. Creating {output_dir}...{RESET}")
+            os.makedirs(output_dir)
+            print(f"{GREEN}Output directory created.{RESET}")
+        else:
+            print(f"{GREEN}Output directory already exists.{RESET}")
+
+        # Read the electrode positions of the EEG cap if a minimum inter-electrode distance is set
+        positions = None
+        if min_distance:
+            cap_file = os.path.join(project_dir, f"Subjects/m2m_{subject_name}/eeg_positions",
+                                    f"{os.getenv('EEG_CAP', 'EGI_template')}.csv")
+            print(f"{CYAN}Reading electrode positions from {cap_file}...{RESET}")
+            positions = read_electrode_positions(cap_file)
+
+        # In top-K and evolve mode the combinations are searched instead of being enumerated
+        if mode in ('topk', 'evolve'):
+            missing = [e for e in electrodes if e not in idx_lf]
+            if missing:
+                print(f"{RED}Electrodes not found in leadfield, skipping them: {missing}{RESET}")
+                E1_plus, E1_minus, E2_plus, E2_minus = [[e for e in electrode_list if e in idx_lf] for electrode_list
+                                                        in (E1_plus, E1_minus, E2_plus, E2_minus)]
+            if min_distance:
+                check_electrode_positions(E1_plus + E1_minus + E2_plus + E2_minus, positions)
+        if mode == 'evolve':
+            evolve_rois(E1_plus, E1_minus, E2_plus, E2_minus, leadfield, mesh, idx_lf, intensity, project_dir,
+                        subject_name, output_dir, top_k, evolve_options, allow_shared, min_distance, positions)
+            print(f"{BOLD_CYAN}TI evolutionary search completed for subject {subject_name}.{RESET}")
+            return
+        if mode == 'topk':
+            search_rois(E1_plus, E1_minus, E2_plus, E2_minus, leadfield, mesh, idx_lf, intensity, project_dir,
+                        subject_name, output_dir, top_k, block_size or ti_engine.DEFAULT_ROI_BLOCK_SIZE,
+                        deduplicate, allow_shared, min_distance, positions)
+            print(f"{BOLD_CYAN}TI top-{top_k} search completed for subject {subject_name}.{RESET}")
+            return
+
+        # Generate all electrode pair combinations
+        all_combinations = generate_combinations(E1_plus, E1_minus, E2_plus, E2_minus, deduplicate=deduplicate,
+                                                 allow_shared=allow_shared, min_distance=min_distance,
+                                                 positions=positions)
+        total_combinations = len(all_combinations)  # Calculate total configurations
+        print(f"{CYAN}Starting TI simulation for {total_combinations} electrode combinations...{RESET}")
+
+        # Skip combinations with electrodes that are not part of the leadfield
+        missing = sorted({e for combo in all_combinations for pair in combo for e in pair if e not in idx_lf})
+        if missing:
+            print(f"{RED}Electrodes not found in leadfield, skipping their combinations: {missing}{RESET}")
+            all_combinations = [combo for combo in all_combinations
+                                if not any(e in missing for pair in combo for e in pair)]
+            total_combinations = len(all_combinations)
+
+        # Gray matter metrics of every combination (summary.csv), computed on the cached gray matter leadfield
+        if metrics_tags:
+            write_gm_summary(all_combinations, leadfield_hdf, mesh, intensity, output_dir,
+                             block_size or ti_engine.DEFAULT_BLOCK_SIZE, metrics_tags, cache_bytes, metrics_backend,
+                             metrics_exact_top, metrics_rank_by,
+                             mesh_geometry.geometry_dir(os.path.join(project_dir, f"Subjects/m2m_{subject_name}")))
+
+        # In ROI mode no meshes are written; TImax is evaluated at the ROIs only
+        if mode == 'roi':
+            score_rois(all_combinations, leadfield, mesh, idx_lf, intensity, project_dir, subject_name, output_dir,
+                       block_size or ti_engine.DEFAULT_ROI_BLOCK_SIZE, workers, ratios)
+            print(f"{BOLD_CYAN}TI ROI scoring completed for subject {subject_name}.{RESET}")
+            return
+
+        block_size = block_size or ti_engine.DEFAULT_BLOCK_SIZE
+        if workers > 1:
+            print(f"{CYAN}Distributing combinations over {workers} worker processes...{RESET}")
+            # Move the leadfield into shared memory so that neither the parent nor the workers hold a copy
+            # Only the electrodes of the remaining combinations (those missing from the leadfield were dropped)
+            if isinstance(leadfield, leadfield_access.LazyLeadfield):
+                used = dict.fromkeys(e for combo in all_combinations for pair in combo for e in pair)
+                leadfield, idx_lf = leadfield.compact(list(used))
+            leadfield = ti_parallel.SharedLeadfield(leadfield)
+
+        # Store all TImax rows in a single results file instead of writing one mesh per combination
+        if output_format == 'hdf5':
+            write_TI_results(all_combinations, leadfield, mesh, idx_lf, intensity, output_dir, block_size, workers,
+                             cache_bytes)
+            if isinstance(leadfield, ti_parallel.SharedLeadfield):
+                leadfield.close()
+            print(f"{BOLD_CYAN}TI simulation completed for subject {subject_name}.{RESET}")
+            return
+
+        # Iterate through all combinations; TI_max is computed for a whole block of combinations at once
+        print(f"{CYAN}Calculating TI_max in blocks of {block_size} combinations...{RESET}")
+        cache = None
+        if workers > 1:
+            state = dict(mesh=mesh, idx_lf=idx_lf, intensity=intensity, output_dir=output_dir, block_size=block_size,
+                         cache_bytes=cache_bytes)
+            chunks = ti_parallel.index_chunks(all_combinations, workers * 4)
+            results = (result for chunk_results in ti_parallel.imap_chunks(_write_mesh_chunk, chunks, leadfield,
+                                                                           workers, state)
+                       for result in chunk_results)
+        else:
+            cache = get_pair_cache(leadfield, idx_lf, cache_bytes)
+            results = write_TI_meshes(all_combinations, 0, leadfield, mesh, idx_lf, intensity, output_dir, block_size,
+                                      cache)
+
+        for i, ((e1p, e1m), (e2p, e2m)), mesh_filename, error in results:
+            print(f"{CYAN}Processed combination {i+1}/{total_combinations}: "
+                  f"{e1p}-{e1m} and {e2p}-{e2m}{RESET}")
+            if error:
+                print(f"{RED}{error}{RESET}")
+                continue
+            print(f"{GREEN}Mesh and optimized view written to {mesh_filename}.{RESET}")
+
+            # Progress indicator (formatted as 003/256)
+            progress_str = f"{i+1:03}/{total_combinations}"
+            print(f"{BOLD}Progress: {progress_str} - Mesh saved.{RESET}\n")
+
+        print_cache_stats(cache)
+        if isinstance(leadfield, ti_parallel.SharedLeadfield):
+            leadfield.close()
+
+        print(f"{BOLD_CYAN}TI simulation and mesh generation completed for subject {subject_name}.{RESET}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run TI simulations for all electrode pair combinations.')
+    parser.add_argument('--block-size', type=int, default=None,
+                        help='Number of combinations whose TI_max is computed at once '
+                             f'(default: {ti_engine.DEFAULT_BLOCK_SIZE} in mesh mode, '
+                             f'{ti_engine.DEFAULT_ROI_BLOCK_SIZE} in roi mode)')
+    parser.add_argument('--mode', choices=['mesh', 'roi', 'topk', 'evolve'], default='mesh',
+                        help="'mesh' writes one mesh per combination; 'roi' evaluates TImax at the ROIs "
+                             "in roi_list.txt in memory and writes output.csv directly; 'topk' searches the "
+                             "best --top-k combinations by ROI TImax with branch-and-bound; 'evolve' searches "
+                             "them with a genetic algorithm (default: %(default)s)")
+    parser.add_argument('--top-k', type=int, default=10,
+                        help='Number of combinations returned in topk and evolve mode (default: %(default)s)')
+    parser.add_argument('--current-ratios', type=int, default=0,
+                        help='In roi mode, score every combination for this many splits of the total current '
+                             'between the two pairs and record the best split in output.csv (default: off)')
+    parser.add_argument('--min-current-ratio', type=float, default=0.1,
+                        help='Smallest fraction of the total current carried by one pair in the current ratio '
+                             'sweep (default: %(default)s)')
+    parser.add_argument('--metrics', action='store_true',
+                        help='In mesh and roi mode, compute the peak and focality metrics of every combination '
+                             'on the cached gray matter leadfield and write results/summary.csv')
+    parser.add_argument('--metrics-tags', type=int, nargs='+', default=list(gm_leadfield.DEFAULT_TAGS),
+                        help='Tissue tags of the elements used for --metrics (default: %(default)s)')
+    parser.add_argument('--metrics-backend', choices=['exact', 'sketch'], default='exact',
+                        help="'exact' sorts every TImax vector; 'sketch' estimates the percentiles and focality "
+                             f"with a quantile sketch (relative accuracy {field_metrics.DEFAULT_SKETCH_ACCURACY}) "
+                             "(default: %(default)s)")
+    parser.add_argument('--metrics-exact-top', type=int, default=10,
+                        help='With the sketch backend, recompute the exact metrics of this many best combinations '
+                             '(default: %(default)s)')
+    parser.add_argument('--metrics-rank-by', default='PercentileValue_99.9',
+                        choices=[c for c in field_metrics.summary_header() if c.startswith(('Max', 'Percentile'))],
+                        help='Metric that selects the combinations of --metrics-exact-top (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed of the evolve mode')
+    parser.add_argument('--population', type=int, default=DEFAULT_EVOLVE_OPTIONS['population'],
+                        help='Population size of the evolve mode (default: %(default)s)')
+    parser.add_argument('--max-evaluations', type=int, default=None,
+                        help='Number of distinct montages evaluated in evolve mode (default: 100 x population '
+                             'if --max-time is not set)')
+    parser.add_argument('--max-time', type=float, default=None,
+                        help='Wall-clock budget (seconds) of the evolve mode')
+    parser.add_argument('--off-target-weight', type=float, default=DEFAULT_EVOLVE_OPTIONS['off_target_weight'],
+                        help='Weight of the mean off-target gray matter TImax subtracted from the ROI TImax '
+                             'in evolve mode (default: %(default)s)')
+    parser.add_argument('--off-target-samples', type=int, default=DEFAULT_EVOLVE_OPTIONS['off_target_samples'],
+                        help='Number of sampled off-target elements in evolve mode (default: %(default)s)')
+    parser.add_argument('--checkpoint', default=None,
+                        help='Population checkpoint of the evolve mode (default: evolve_checkpoint.npz '
+                             'in the output directory)')
+    parser.add_argument('--resume', action='store_true', help='Resume the evolve mode from its checkpoint')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes sharing the leadfield (default: %(default)s)')
+    parser.add_argument('--full-leadfield', action='store_true',
+                        help='Load the whole leadfield into memory instead of reading only the rows '
+                             'of the selected electrodes')
+    parser.add_argument('--output', choices=['msh', 'hdf5'], default='msh',
+                        help="Mesh mode output: 'msh' writes one mesh per combination; 'hdf5' stores the geometry "
+                             f"once and TImax of every combination in {ti_results.RESULTS_FILENAME} "
+                             "(default: %(default)s)")
+    parser.add_argument('--deduplicate', action='store_true',
+                        help='Skip pairs of the same electrode and montages that only differ by pair polarity '
+                             'or pair order (TI_max is the same)')
+    parser.add_argument('--no-shared-electrodes', action='store_true',
+                        help='Skip montages that use the same electrode in both pairs')
+    parser.add_argument('--min-distance', type=float, default=None,
+                        help='Minimum distance (mm) between any two electrodes of a montage, '
+                             'using the positions in the EEG cap CSV')
+    parser.add_argument('--pair-cache-mb', type=float, default=ti_engine.DEFAULT_CACHE_BYTES / 1024 ** 2,
+                        help='Memory budget (MB, per worker) of the cache of electrode pair fields that are '
+                             'reused across combinations; 0 disables the cache (default: %(default).0f)')
+    args = parser.parse_args()
+
     # Check for required environment variables
     project_dir = os.getenv('PROJECT_DIR')
     subject_name = os.getenv('SUBJECT_NAME')
@@ -183,10 +716,10 @@ if __name__ == "__main__":
     print(f"{BOLD_CYAN}Project Directory: {project_dir}{RESET}\n")
     
     # Get electrode lists from user input
-    E1_plus = get_electrode_list("Enter electrodes for E1_plus separated by spaces or commas (format E###): ")
-    E1_minus = get_electrode_list("Enter electrodes for E1_minus separated by spaces or commas (format E###): ")
-    E2_plus = get_electrode_list("Enter electrodes for E2_plus separated by spaces or commas (format E###): ")
-    E2_minus = get_electrode_list("Enter electrodes for E2_minus separated by spaces or commas (format E###): ")
+    E1_plus = get_electrode_list("Enter electrodes for E1_plus separated by spaces or commas (format E### or 'all'): ")
+    E1_minus = get_electrode_list("Enter electrodes for E1_minus separated by spaces or commas (format E### or 'all'): ")
+    E2_plus = get_electrode_list("Enter electrodes for E2_plus separated by spaces or commas (format E### or 'all'): ")
+    E2_minus = get_electrode_list("Enter electrodes for E2_minus separated by spaces or commas (format E### or 'all'): ")
     
     # Get intensity of stimulation
     intensity = get_intensity("Intensity of stimulation in mV: ")
@@ -198,6 +731,21 @@ if __name__ == "__main__":
     print(f"E2_minus: {E2_minus}")
     print(f"Stimulation Intensity: {intensity} V\n")
     
+    evolve_options = dict(seed=args.seed, population=args.population, max_evaluations=args.max_evaluations,
+                          max_seconds=args.max_time, off_target_weight=args.off_target_weight,
+                          off_target_samples=args.off_target_samples, checkpoint=args.checkpoint,
+                          resume=args.resume)
+
     # Start processing leadfield
-    process_leadfield("vol", E1_plus, E1_minus, E2_plus, E2_minus, intensity, project_dir, subject_name)
+    process_leadfield("vol", E1_plus, E1_minus, E2_plus, E2_minus, intensity, project_dir, subject_name,
+                      block_size=args.block_size, mode=args.mode, workers=args.workers,
+                      lazy_leadfield=not args.full_leadfield, output_format=args.output,
+                      deduplicate=args.deduplicate, allow_shared=not args.no_shared_electrodes,
+                      min_distance=args.min_distance, cache_bytes=int(args.pair_cache_mb * 1024 ** 2),
+                      top_k=args.top_k, evolve_options=evolve_options,
+                      ratios=get_current_ratios(args.current_ratios, args.min_current_ratio)
+                      if args.current_ratios else None,
+                      metrics_tags=tuple(args.metrics_tags) if args.metrics else None,
+                      metrics_backend=args.metrics_backend, metrics_exact_top=args.metrics_exact_top,
+                      metrics_rank_by=args.metrics_rank_by)
 
@@ -1,65 +1,65 @@
-import pandas as pd
+import csv
+import os
 import sys
-import re
+import results_store
 
 '''
 Ido Haber - ihaber@wisc.edu
 September 2, 2024
 Optimized for optimizer pipeline
 
-This script updates the output CSV file by merging data from the summary CSV.
-It extracts specific metrics related to TI simulations and maps them to the 
-corresponding mesh names in the output CSV.
+This script updates the output CSV file with the summary metrics of every montage.
+Both are read from the results store of the optimization (results_store.py), where
+ti_sim.py, roi-analyzer.py and mesh_metrics.py upsert them keyed by the electrode
+quadruple, so no CSV files are merged on mesh names.
 
 Key Features:
-- Maps mesh names from the summary CSV to the format used in the output CSV.
 - Extracts specific percentile and focality metrics for inclusion in the output.
-- Merges the data based on mesh names and updates the output CSV file.
+- Imports output.csv into the store if it was written without it, and summary.csv
+  whenever it is newer than the stored metrics (e.g. rewritten by the MATLAB summary step).
+- Exports output.csv from the store: the ROI columns followed by the metrics.
 '''
 
+# Columns to extract
+columns_to_extract = [
+    'PercentileValue_95', 'PercentileValue_99.9', 'FocalityValue_50', 'XYZ_Max'
+]
 
-def map_mesh_names(mesh_name):
-    # Convert output.csv mesh name to summary.csv mesh name format
-    return "TI_field_" + mesh_name.replace(" <> ", "_and_") + ".msh"
 
 def update_output_csv(project_dir, subject_name):
-    summary_csv_path = f"{project_dir}/Simulations/opt_{subject_name}/results/summary.csv"
-    output_csv_path = f"{project_dir}/Simulations/opt_{subject_name}/output.csv"
-    
-    # Load the summary CSV
-    summary_df = pd.read_csv(summary_csv_path)
-    print("Summary CSV columns:", summary_df.columns.tolist())  # Print column names for debugging
-    
-    # Columns to extract
-    columns_to_extract = [
-        'PercentileValue_95', 'PercentileValue_99.9', 'FocalityValue_50', 'XYZ_Max'
-    ]
-    
-    # Ensure the columns exist in the summary CSV
-    missing_columns = [col for col in columns_to_extract if col not in summary_df.columns]
-    if missing_columns:
-        print(f"Error: Missing columns in summary.csv: {', '.join(missing_columns)}")
-        sys.exit(1)
-    
-    # Extract the necessary columns and map FileName
-    summary_df['Mesh'] = summary_df['FileName'].apply(lambda x: re.sub(r"TI_field_(.*?)\.msh", r"\1", x).replace("_and_", " <> "))
-    extracted_df = summary_df[['Mesh'] + columns_to_extract]
-    
-    # Load the output CSV
-    output_df = pd.read_csv(output_csv_path)
-    print("Output CSV columns:", output_df.columns.tolist())  # Print column names for debugging
-    
-    # Ensure 'Mesh' exists in output_df
-    if 'Mesh' not in output_df.columns:
-        print("Error: 'Mesh' column is missing in output.csv")
-        sys.exit(1)
-    
-    # Merge the dataframes on Mesh
-    merged_df = pd.merge(output_df, extracted_df, on='Mesh', how='left')
-    
-    # Save the updated output CSV
-    merged_df.to_csv(output_csv_path, index=False)
-    print(f"Updated {output_csv_path} with new columns from summary.csv")
+    opt_dir = f"{project_dir}/Simulations/opt_{subject_name}"
+    summary_csv_path = f"{opt_dir}/results/summary.csv"
+    output_csv_path = f"{opt_dir}/output.csv"
+
+    # ROI columns in the order of the current output.csv
+    roi_columns = ['TImax']
+    if os.path.exists(output_csv_path):
+        with open(output_csv_path, 'r', newline='') as file:
+            header = next(csv.reader(file), ['Mesh'])
+        roi_columns = [c for c in header[1:] if c not in columns_to_extract] or roi_columns
+
+    with results_store.open_store(opt_dir) as store:
+        metric_names = set(store.metric_names())
+        if 'TImax' not in metric_names and os.path.exists(output_csv_path):
+            print(f"Importing {output_csv_path} into {store.filename}")
+            store.import_csv(output_csv_path, 'Mesh')
+        written = store.written(columns_to_extract)
+        if os.path.exists(summary_csv_path) and (len(written) < len(columns_to_extract) or
+                                                 os.path.getmtime(summary_csv_path) > min(written.values())):
+            print(f"Importing {summary_csv_path} into {store.filename}")
+            store.import_csv(summary_csv_path, 'FileName', exclude=('FieldName', 'RegionIndices'))
+        metric_names = set(store.metric_names())
+        print("Stored metrics:", sorted(metric_names))  # Print metric names for debugging
+
+        # Ensure the metrics exist in the store
+        missing_columns = [col for col in columns_to_extract + ['TImax'] if col not in metric_names]
+        if missing_columns:
+            print(f"Error: Missing metrics in the results store: {', '.join(missing_columns)}")
+            sys.exit(1)
+
+        # Export the montages with ROI values
+        n_rows = store.export_csv(output_csv_path, roi_columns + columns_to_extract, require='TImax')
+    print(f"Updated {output_csv_path} with new columns from summary.csv ({n_rows} montages)")
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
@@ -70,4 +70,3 @@ if __name__ == "__main__":
     subject_name = sys.argv[2]
     
     update_output_csv(project_dir, subject_name)
-
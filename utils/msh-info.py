@@ -10,24 +10,31 @@ This script allows you to quickly inspect the fields available in a mesh file
 from the command line. It lists both point data fields and cell data fields 
 contained within the mesh file, making it easier to understand the contents 
 and structure of the mesh.
+
+The field names are read from the section headers of the file (see optimizer/msh_reader.py),
+without parsing the nodes, elements or field values.
 '''
 
 
-import meshio
+import os
 import sys
 
+# msh_reader.py is one of the shared modules in ../optimizer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'optimizer'))
+import msh_reader
+
 def list_fields(mesh_file):
-    # Read the mesh file
-    mesh = meshio.read(mesh_file)
+    # Read the field names from the section headers
+    fields = msh_reader.list_fields(mesh_file)
 
     # List point data fields
     print("Point Data Fields:")
-    for field in mesh.point_data.keys():
+    for field in fields['NodeData']:
         print(f" - {field}")
 
     # List cell data fields
     print("\nCell Data Fields:")
-    for field in mesh.cell_data_dict.keys():
+    for field in fields['ElementData']:
         print(f" - {field}")
 
 if __name__ == "__main__":
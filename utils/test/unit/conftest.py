@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The scripts import their shared modules from the optimizer directory
+# (see the sys.path line at the top of the analyzer scripts)
+optimizer_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'optimizer'))
+if optimizer_dir not in sys.path:
+    sys.path.insert(0, optimizer_dir)
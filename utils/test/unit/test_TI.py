@@ -50,4 +50,61 @@ def test_validate_montage_valid_input(set_sys_variables):  # Pass the fixture
     result = TI.validate_montage(montage, montage_name)
     
     # Assert that the result is True
-    assert result is True
\ No newline at end of file
+    assert result is True
+def test_map_leadfield_elements_maps_tetrahedra_and_their_surfaces(set_sys_variables):
+    TI = set_sys_variables
+    import types
+
+    # Leadfield mesh of two tetrahedra; the head mesh has them in the other order, a triangle and an extra tetrahedron
+    node_coord = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 1, 1], [5, 5, 5]], dtype=float)
+    leadfield_mesh = types.SimpleNamespace(
+        nodes=types.SimpleNamespace(node_coord=node_coord),
+        elm=types.SimpleNamespace(elm_type=np.array([4, 4]), node_number_list=np.array([[1, 2, 3, 4], [2, 3, 4, 5]])))
+    head_tetrahedra = np.array([[2, 3, 4, 5], [1, 2, 3, 4], [2, 3, 4, 6]]) - 1
+    centroids = np.vstack([node_coord[head_tetrahedra].mean(axis=1), [[0.3, 0.3, 0]]])
+    head = types.SimpleNamespace(elm=types.SimpleNamespace(nr=4, elm_type=np.array([4, 4, 4, 2])),
+                                 elements_baricenters=lambda: types.SimpleNamespace(value=centroids),
+                                 find_corresponding_tetrahedra=lambda: np.array([2]))
+
+    elements = TI.map_leadfield_elements(head, leadfield_mesh)
+
+    assert list(elements) == [1, 0, -1, 0]
+
+def test_open_leadfield_requires_the_settings_of_the_simulations(set_sys_variables, tmp_path, monkeypatch):
+    TI = set_sys_variables
+    import h5py
+    import leadfield_access
+
+    leadfield_hdf = str(tmp_path / '001_leadfield_EGI_template.hdf5')
+    with h5py.File(leadfield_hdf, 'w') as f:
+        f.create_dataset('mesh_leadfield/values', data=np.zeros((1, 2, 3)))
+    monkeypatch.setenv('TI_LEADFIELD', leadfield_hdf)
+    monkeypatch.setattr(leadfield_access, 'load_leadfield', lambda path: ('leadfield', path))
+    TI.configure('001', 'scalar', str(tmp_path), str(tmp_path / 'simulations'))
+
+    # Without recorded settings, or with other ones, every montage is solved
+    assert TI.open_leadfield('001', str(tmp_path)) is None
+    settings = dict(TI.solution_cache.settings, conductivities=[c.value for c in TI.sim_struct.TDCSLIST().cond])
+    leadfield_access.write_settings(leadfield_hdf, dict(settings, anisotropy_type='vn'))
+    assert TI.open_leadfield('001', str(tmp_path)) is None
+
+    leadfield_access.write_settings(leadfield_hdf, settings)
+    assert TI.open_leadfield('001', str(tmp_path)) == ('leadfield', leadfield_hdf)
+
+def test_run_simulation_solves_montages_without_a_matching_leadfield(set_sys_variables, tmp_path, monkeypatch):
+    TI = set_sys_variables
+
+    monkeypatch.setenv('TI_LEADFIELD', str(tmp_path / 'missing.hdf5'))
+    TI.configure('001', 'scalar', str(tmp_path), str(tmp_path / 'simulations'))
+    assert TI.leadfield is None
+
+    class Solved(Exception):
+        pass
+
+    def run_simnibs(session):
+        raise Solved([[e.centre for e in tdcs.electrode] for tdcs in session.poslists])
+
+    monkeypatch.setattr(TI, 'run_simnibs', run_simnibs)
+    with pytest.raises(Solved) as solved:
+        TI.run_simulation('montage', [['E001', 'E002'], ['E003', 'E004']])
+    assert solved.value.args[0] == [['E001', 'E002'], ['E003', 'E004']]
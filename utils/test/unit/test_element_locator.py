@@ -0,0 +1,48 @@
+import numpy as np
+import element_locator
+
+def cube_mesh(n):
+    # n x n x n unit cubes, each split into 6 tetrahedra around its main diagonal
+    grid = np.stack(np.meshgrid(*[np.arange(n + 1)] * 3, indexing='ij'), axis=-1).reshape(-1, 3).astype(float)
+    index = np.arange((n + 1) ** 3).reshape(n + 1, n + 1, n + 1)
+    paths = [(1, 2, 4), (1, 4, 2), (2, 1, 4), (2, 4, 1), (4, 1, 2), (4, 2, 1)]
+    offsets = {1: (1, 0, 0), 2: (0, 1, 0), 4: (0, 0, 1)}
+    tetrahedra = []
+    for i, j, k in np.ndindex(n, n, n):
+        for path in paths:
+            corner = np.array([i, j, k])
+            tet = [index[tuple(corner)]]
+            for step in path:
+                corner = corner + offsets[step]
+                tet.append(index[tuple(corner)])
+            tetrahedra.append(tet)
+    return grid, np.array(tetrahedra)
+
+def test_locate_returns_containing_tetrahedron():
+    nodes, tetrahedra = cube_mesh(4)
+    locator = element_locator.ElementLocator(nodes, tetrahedra, elements=np.arange(len(tetrahedra)) + 10)
+    rng = np.random.default_rng(0)
+    points = np.vstack([rng.uniform(0, 4, size=(200, 3)), [[5, 1, 1], [-0.5, 2, 2]]])
+
+    th_indices, bar = locator.locate(points, neighbors=2)
+
+    inside = th_indices >= 0
+    assert inside[:200].all() and not inside[200:].any()
+    assert np.all(bar[inside] >= -1e-9)
+    assert np.allclose(bar[inside].sum(axis=1), 1)
+    # The barycentric coordinates reproduce the points from the vertices of their tetrahedra
+    vertices = nodes[tetrahedra[th_indices[inside] - 10]]
+    assert np.allclose(np.einsum('pi,pij->pj', bar[inside], vertices), points[inside])
+
+def test_match_finds_the_same_tetrahedra_of_another_mesh():
+    nodes, tetrahedra = cube_mesh(3)
+    locator = element_locator.ElementLocator(nodes, tetrahedra)
+    order = np.random.default_rng(1).permutation(len(tetrahedra))
+    centroids = nodes[tetrahedra[order]].mean(axis=1)
+    centroids[0] += 0.01
+
+    th_indices = locator.match(centroids)
+
+    assert th_indices[0] == -1
+    assert np.array_equal(th_indices[1:], order[1:])
+
@@ -0,0 +1,112 @@
+import os
+import types
+import numpy as np
+import fem_cache
+from test_msh_reader import write_msh
+
+
+def fake_head(n_elements):
+    return types.SimpleNamespace(elm=types.SimpleNamespace(nr=n_elements))
+
+
+def test_file_digest_memoized(tmp_path):
+    path = tmp_path / 'head.msh'
+    path.write_bytes(b'mesh')
+    memo = str(tmp_path / 'cache' / 'digests.json')
+    digest = fem_cache.file_digest(str(path), memo)
+    assert os.path.exists(memo)
+    assert fem_cache.file_digest(str(path), memo) == digest
+    assert fem_cache.file_digest(str(tmp_path / 'missing'), memo) is None
+
+
+def test_settings_key_the_cache(tmp_path):
+    electrode = {'shape': 'ellipse', 'dimensions': [8, 8], 'thickness': [4, 4]}
+    s1 = fem_cache.solution_settings(str(tmp_path), None, 'scalar', None, None, electrode)
+    s2 = fem_cache.solution_settings(str(tmp_path), None, 'vn', None, None, electrode)
+    assert fem_cache.PairSolutionCache(str(tmp_path), s1).directory != \
+        fem_cache.PairSolutionCache(str(tmp_path), s2).directory
+
+
+def test_pair_fields_reuses_scaled_and_swapped_pairs(tmp_path, monkeypatch):
+    cache = fem_cache.PairSolutionCache(str(tmp_path), {'mesh': 'x'})
+    heads = {}
+    monkeypatch.setattr(cache, 'load_head', lambda: heads.get('head'))
+    monkeypatch.setattr(cache, 'store_head', lambda mesh: heads.update(head=mesh))
+    rng = np.random.default_rng(0)
+    solutions = {('E1', 'E2'): rng.normal(size=(5, 3)), ('E3', 'E4'): rng.normal(size=(5, 3))}
+    solved = []
+
+    def solve(pairs):
+        solved.extend(pairs)
+        return fake_head(5), [solutions[tuple(pair)] * (current / 0.005) for pair in pairs]
+
+    current = 0.005
+    _, fields, n_solved = fem_cache.pair_fields(cache, [('E1', 'E2'), ('E3', 'E4')], current, solve)
+    assert n_solved == 2 and len(solved) == 2
+
+    # Same pairs at another current, one of them reversed: no solve
+    current = 0.0025
+    _, fields, n_solved = fem_cache.pair_fields(cache, [('E2', 'E1'), ('E3', 'E4')], current, solve)
+    assert n_solved == 0 and len(solved) == 2
+    np.testing.assert_allclose(fields[0], -solutions[('E1', 'E2')] / 2)
+    np.testing.assert_allclose(fields[1], solutions[('E3', 'E4')] / 2)
+
+    # Only the new pair is solved
+    solutions[('E5', 'E6')] = rng.normal(size=(5, 3))
+    _, fields, n_solved = fem_cache.pair_fields(cache, [('E1', 'E2'), ('E5', 'E6')], current, solve)
+    assert n_solved == 1 and solved[-1] == ('E5', 'E6')
+
+
+def test_load_pair_solutions_reads_geometry_once(tmp_path, monkeypatch):
+    paths = [str(tmp_path / 'TDCS_1.msh'), str(tmp_path / 'TDCS_2.msh')]
+    for path in paths:
+        write_msh(path, True)
+
+    read = []
+
+    class FakeMesh:
+        def __init__(self):
+            self.elm = types.SimpleNamespace(tag1=np.array([2, 2, 1002]), nr=3)
+            self.field = {'E': types.SimpleNamespace(value=np.arange(9.0).reshape(3, 3) + 100)}
+            self.elmdata, self.nodedata = ['E'], []
+
+        def crop_mesh(self, elements):
+            self.cropped = elements
+            return self
+
+    def read_msh(path):
+        read.append(path)
+        return FakeMesh()
+
+    def write_head(mesh, path):
+        open(path, 'w').close()
+
+    import simnibs
+    monkeypatch.setattr(simnibs, 'mesh_io', types.SimpleNamespace(read_msh=read_msh, write_msh=write_head),
+                        raising=False)
+    cache = fem_cache.PairSolutionCache(str(tmp_path), {'mesh': 'digest'})
+    head, fields = fem_cache.load_pair_solutions(paths, [1002], cache)
+    assert read == paths[:1]
+    assert list(head.cropped) == [3] and head.elmdata == []
+    assert np.allclose(fields[0], [[106, 107, 108]])
+    assert np.allclose(fields[1], [[6, 7, 8]])
+
+    # With the head in the cache, only the E fields are read
+    cached_head, fields = fem_cache.load_pair_solutions(paths, [1002], cache)
+    assert read == paths[:1] and cached_head is head
+    assert np.allclose(fields, [[[6, 7, 8]], [[6, 7, 8]]])
+
+
+def test_leadfield_elements_belong_to_the_head_and_leadfield(tmp_path, monkeypatch):
+    cache = fem_cache.PairSolutionCache(str(tmp_path), {'mesh': 'digest'})
+    heads = {'head': fake_head(3)}
+    monkeypatch.setattr(cache, 'load_head', lambda: heads.get('head'))
+    assert cache.load_leadfield_elements(5) is None
+
+    cache.store_leadfield_elements(np.array([4, 0, -1]), 5)
+    assert list(cache.load_leadfield_elements(5)) == [4, 0, -1]
+    # Stored for another leadfield mesh or another head mesh
+    assert cache.load_leadfield_elements(6) is None
+    heads['head'] = fake_head(4)
+    assert cache.load_leadfield_elements(5) is None
+
@@ -0,0 +1,91 @@
+import numpy as np
+import field_metrics
+
+def test_get_metrics_matches_matlab_definitions():
+    values = np.array([1.0, 4.0, 2.0, 8.0, 3.0])
+    volumes = np.array([10.0, 20.0, 30.0, 40.0, 900.0])
+    centroids = np.arange(15.0).reshape(5, 3)
+
+    metrics = field_metrics.get_metrics(values, volumes, centroids, percentiles=(50, 95), focality_cutoffs=(50,))
+
+    # Sorted values 1 2 3 4 8 with cumulative volume 1 4 94 96 100 % of 1000 mm^3
+    assert metrics['max'] == 8
+    assert np.allclose(metrics['XYZ_max'], [9, 10, 11])
+    assert np.allclose(metrics['perc_values'], [3, 4])
+    # The 99.9 percentile is 8: elements >= 4 hold 60 mm^3
+    assert np.allclose(metrics['focality_values'], [0.06])
+
+def test_format_matrix_matches_mat2str():
+    assert field_metrics.format_matrix([1.5, -2.0, 30.25]) == '[1.5 -2 30.25]'
+
+def matlab_metrics(data, elemsizes, elempos, percentiles, cutoffs):
+    # Line-by-line port of mesh_get_fieldpeaks_and_focality.m
+    idx = np.argsort(data, kind='stable')
+    data, elemsizes, elempos = data[idx], np.cumsum(elemsizes[idx]), elempos[idx]
+    normed = elemsizes / elemsizes[-1]
+    perc_values, XYZ_perc, XYZstd_perc = [], [], []
+    for p in percentiles:
+        i = np.flatnonzero(normed > p / 100)
+        i = i[0] if len(i) else len(data) - 1
+        perc_values.append(data[i])
+        w = elemsizes[i:]
+        mean = (elempos[i:] * w[:, None]).sum(0) / w.sum()
+        n = np.sum(w > 0)
+        XYZ_perc.append(mean)
+        XYZstd_perc.append(np.sqrt((w[:, None] * (elempos[i:] - mean) ** 2).sum(0) / ((n - 1) / n * w.sum())))
+    i = np.flatnonzero(normed > 0.999)
+    peak = data[i[0] if len(i) else len(data) - 1]
+    focality = []
+    for c in cutoffs:
+        i = np.flatnonzero(data >= c / 100 * peak)[0]
+        focality.append(elemsizes[-1] if i == 0 else elemsizes[-1] - elemsizes[i - 1])
+    return perc_values, XYZ_perc, XYZstd_perc, np.array(focality) / 1000
+
+def test_get_metrics_batch_matches_matlab_port():
+    rng = np.random.default_rng(8)
+    values = rng.gamma(2, size=(5, 2000))
+    values[3, 10] = np.nan
+    volumes = rng.uniform(0.5, 2, size=2000)
+    centroids = rng.normal(size=(2000, 3)) * 30
+
+    metrics = field_metrics.get_metrics_batch(values, volumes, centroids)
+
+    for row, m in zip(values, metrics):
+        valid = ~np.isnan(row)
+        expected = matlab_metrics(row[valid], volumes[valid], centroids[valid],
+                                  field_metrics.PERCENTILES, field_metrics.FOCALITY_CUTOFFS)
+        assert m['max'] == np.nanmax(row)
+        assert np.allclose(m['XYZ_max'], centroids[np.nanargmax(row)])
+        for value, reference in zip((m['perc_values'], m['XYZ_perc'], m['XYZstd_perc'], m['focality_values']),
+                                    expected):
+            assert np.allclose(value, reference)
+
+def test_summary_header_matches_process_mesh_files():
+    assert field_metrics.summary_header() == [
+        'FileName', 'FieldName', 'RegionIndices', 'MaxValue',
+        'PercentileValue_95', 'PercentileValue_99', 'PercentileValue_99.9',
+        'FocalityValue_50', 'FocalityValue_75', 'FocalityValue_90', 'FocalityValue_95',
+        'XYZ_Max',
+        'XYZ_Percentiles_95', 'XYZ_Percentiles_99', 'XYZ_Percentiles_99.9',
+        'XYZ_Std_Percentiles_95', 'XYZ_Std_Percentiles_99', 'XYZ_Std_Percentiles_99.9']
+
+def test_quantile_sketch_error_bound_and_merge():
+    rng = np.random.default_rng(9)
+    values = rng.lognormal(size=(3, 20000))
+    volumes = rng.uniform(0.5, 2, size=20000)
+    centroids = np.zeros((20000, 3))
+    exact = field_metrics.get_metrics_batch(values, volumes, centroids)
+
+    # Sketching in two chunks and merging gives the same sketch as one pass
+    whole = field_metrics.QuantileSketch(3, accuracy=0.01)
+    whole.add(values, volumes)
+    merged = field_metrics.QuantileSketch(3, accuracy=0.01)
+    part = field_metrics.QuantileSketch(3, accuracy=0.01)
+    merged.add(values[:, :5000], volumes[:5000])
+    part.add(values[:, 5000:], volumes[5000:])
+    merged.merge(part)
+    assert np.allclose(merged.weights, whole.weights)
+
+    for p, i in zip(field_metrics.PERCENTILES, range(3)):
+        reference = np.array([m['perc_values'][i] for m in exact])
+        assert np.all(np.abs(whole.quantile(p) / reference - 1) <= 0.01)
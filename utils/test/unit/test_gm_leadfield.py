@@ -0,0 +1,43 @@
+import os
+import types
+import h5py
+import numpy as np
+import gm_leadfield
+
+def write_leadfield(path, leadfield):
+    with h5py.File(path, 'w') as f:
+        dset = f.create_dataset('mesh_leadfield/values', data=leadfield)
+        dset.attrs['electrode_names'] = np.array([b'E001', b'E002', b'E003', b'E004'])
+        dset.attrs['reference_electrode'] = b'E001'
+
+def fake_mesh(tags, volumes, centroids):
+    # Minimal stand-in for the mesh_io.Msh attributes used by select_elements
+    elm = types.SimpleNamespace(elm_type=np.full(len(tags), 4), tag1=np.array(tags),
+                                node_number_list=np.arange(4 * len(tags)).reshape(-1, 4) + 1)
+    nodes = types.SimpleNamespace(node_coord=np.zeros((4 * len(tags), 3)))
+    return types.SimpleNamespace(elm=elm, nodes=nodes,
+                                 elements_volumes_and_areas=lambda: types.SimpleNamespace(value=volumes),
+                                 elements_baricenters=lambda: types.SimpleNamespace(value=centroids),
+                                 nodes_areas=lambda: types.SimpleNamespace(value=np.zeros(4 * len(tags))))
+
+def test_gm_cache_holds_selected_elements_and_is_invalidated(tmp_path):
+    rng = np.random.default_rng(7)
+    leadfield = rng.normal(size=(3, 6, 3))
+    source = str(tmp_path / 'subject_leadfield_EGI_template.hdf5')
+    write_leadfield(source, leadfield)
+    mesh = fake_mesh([1, 2, 2, 3, 2, 1], np.arange(1.0, 7.0), rng.normal(size=(6, 3)))
+
+    with gm_leadfield.load_gm_leadfield(source, mesh=mesh) as gm:
+        assert list(gm.elements) == [1, 2, 4]
+        assert np.allclose(gm.volumes, [2, 3, 5])
+        assert np.allclose(gm.leadfield[:, np.arange(3), :], leadfield[:, [1, 2, 4], :])
+        assert gm.idx_lf == {'E002': 0, 'E003': 1, 'E004': 2, 'E001': None}
+    cache = gm_leadfield.cache_filename(source)
+    assert gm_leadfield.is_valid(cache, source)
+    assert not gm_leadfield.is_valid(cache, source, tags=(1, 2))
+
+    write_leadfield(source, 2 * leadfield)
+    os.utime(source, ns=(0, 0))
+    assert not gm_leadfield.is_valid(cache, source)
+    with gm_leadfield.load_gm_leadfield(source, mesh=mesh) as gm:
+        assert np.allclose(gm.leadfield.row(0), 2 * leadfield[0, [1, 2, 4]])
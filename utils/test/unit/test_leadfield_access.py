@@ -0,0 +1,18 @@
+import numpy as np
+import leadfield_access
+from test_gm_leadfield import write_leadfield
+
+def test_leadfield_settings_round_trip(tmp_path):
+    source = str(tmp_path / 'subject_leadfield_EGI_template.hdf5')
+    write_leadfield(source, np.zeros((3, 2, 3)))
+    assert leadfield_access.read_settings(source) is None
+    settings = {'anisotropy_type': 'scalar', 'conductivities': [0.126, 0.275, None]}
+    leadfield_access.write_settings(source, settings)
+    assert leadfield_access.read_settings(source) == settings
+
+def test_lazy_leadfield_source_identifies_the_file(tmp_path):
+    source = str(tmp_path / 'subject_leadfield_EGI_template.hdf5')
+    write_leadfield(source, np.ones((3, 2, 3)))
+
+    with leadfield_access.LazyLeadfield(source) as first, leadfield_access.LazyLeadfield(source) as second:
+        assert first.source == second.source
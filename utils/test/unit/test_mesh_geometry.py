@@ -0,0 +1,49 @@
+import os
+import types
+import numpy as np
+import mesh_geometry
+
+def fake_mesh(tags, elm_type, seed=0):
+    # Minimal stand-in for the mesh_io.Msh attributes used by compute_geometry
+    rng = np.random.default_rng(seed)
+    n = len(tags)
+    calls = []
+    elm = types.SimpleNamespace(elm_type=np.array(elm_type), tag1=np.array(tags),
+                                node_number_list=np.arange(4 * n).reshape(-1, 4) + 1)
+    nodes = types.SimpleNamespace(node_coord=rng.normal(size=(4 * n, 3)))
+
+    def value(name, array):
+        def get():
+            calls.append(name)
+            return types.SimpleNamespace(value=array)
+        return get
+
+    return types.SimpleNamespace(elm=elm, nodes=nodes, calls=calls,
+                                 elements_volumes_and_areas=value('volumes', rng.random(n)),
+                                 elements_baricenters=value('centroids', rng.normal(size=(n, 3))),
+                                 nodes_areas=value('node_areas', rng.random(4 * n)))
+
+def test_geometry_is_stored_once_and_memory_mapped(tmp_path):
+    mesh = fake_mesh([2, 1, 1002, 2, 1, 2], [4, 4, 2, 4, 4, 2])
+    store = mesh_geometry.geometry_dir(str(tmp_path / 'm2m_ernie'))
+
+    geometry = mesh_geometry.get_geometry(mesh, store)
+    assert isinstance(geometry.volumes, np.memmap)
+    assert np.allclose(geometry.volumes, mesh.elements_volumes_and_areas().value)
+    assert list(geometry.elements_with_tags([2])) == [0, 3, 5]
+    assert list(geometry.elements_with_tags([2], elm_type=4)) == [0, 3]
+    assert list(geometry.elements_with_tags([1, 1002, 7])) == [1, 2, 4]
+    assert len(geometry.elements_with_tags([7])) == 0
+
+    # A second mesh with the same geometry reads the stored arrays
+    same = fake_mesh([2, 1, 1002, 2, 1, 2], [4, 4, 2, 4, 4, 2])
+    again = mesh_geometry.get_geometry(same, store)
+    assert same.calls == []
+    assert again.key == geometry.key
+    assert np.allclose(again.centroids, geometry.centroids)
+    assert os.listdir(store) == [geometry.key]
+
+    # A different mesh gets its own entry
+    other = mesh_geometry.get_geometry(fake_mesh([2, 2, 1002, 2, 1, 2], [4, 4, 2, 4, 4, 2]), store)
+    assert other.key != geometry.key
+    assert sorted(os.listdir(store)) == sorted([geometry.key, other.key])
@@ -0,0 +1,46 @@
+import csv
+import pytest
+import numpy as np
+import montage_ranking
+
+def brute_force_front(values, signs):
+    costs = -values * signs
+    return [i for i in range(len(costs))
+            if not any(np.all(costs[j] <= costs[i]) and np.any(costs[j] < costs[i]) for j in range(len(costs)))]
+
+def test_pareto_front_matches_brute_force():
+    rng = np.random.default_rng(5)
+    signs = np.array([1.0, -1.0, -1.0])
+    # Rounded values give ties and duplicate rows
+    values = np.round(rng.normal(size=(600, 3)), 1)
+    front = montage_ranking.pareto_front(values, signs, chunk_size=37)
+    assert list(front) == brute_force_front(values, signs)
+
+def test_weighted_top_k():
+    values = np.array([[1.0, 10.0], [3.0, 30.0], [2.0, 5.0], [3.0, 40.0]])
+    signs = np.array([1.0, -1.0])
+    scores = montage_ranking.weighted_scores(values, signs, [1, 1])
+    assert np.allclose(scores, [(0 + 30 / 35) / 2, (1 + 10 / 35) / 2, (0.5 + 1) / 2, (1 + 0) / 2])
+    assert list(montage_ranking.top_k(scores, 2)) == [2, 1]
+    assert list(montage_ranking.top_k(scores, 2, candidates=[0, 3])) == [3, 0]
+    with pytest.raises(ValueError):
+        montage_ranking.parse_objective('TImax')
+
+def test_rank_montages_writes_mesh_list(tmp_path):
+    import results_store
+    rows = {('E001', 'E002', 'E003', 'E004'): {'TImax': 0.5, 'FocalityValue_50': 10.0},
+            ('E005', 'E006', 'E007', 'E008'): {'TImax': 0.4, 'FocalityValue_50': 20.0},
+            ('E009', 'E010', 'E011', 'E012'): {'TImax': 0.6, 'FocalityValue_50': 30.0},
+            ('E013', 'E014', 'E015', 'E016'): {'TImax': None, 'FocalityValue_50': 1.0}}
+    with results_store.open_store(str(tmp_path)) as store:
+        store.upsert(rows.items())
+
+    best = montage_ranking.rank_montages(str(tmp_path), ['TImax:max', 'FocalityValue_50:min'], k=1)
+
+    assert best == [('E001', 'E002', 'E003', 'E004')]
+    with open(tmp_path / montage_ranking.MESH_LIST_FILENAME) as f:
+        assert f.read().split() == ['TI_field_E001_E002_and_E003_E004.msh']
+    with open(tmp_path / montage_ranking.RANKING_FILENAME, newline='') as f:
+        ranking = list(csv.reader(f))
+    assert [row[0] for row in ranking[1:]] == ['E001_E002 <> E003_E004', 'E009_E010 <> E011_E012']
+    assert [row[-2:] for row in ranking[1:]] == [['1', '1'], ['1', '']]
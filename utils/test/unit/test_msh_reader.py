@@ -0,0 +1,86 @@
+import pytest
+import numpy as np
+import msh_reader
+
+def data_block(section, name, ids, values, binary):
+    values = values.reshape(len(ids), -1)
+    header = f'${section}\n1\n"{name}"\n1\n0.0\n3\n0\n{values.shape[1]}\n{len(ids)}\n'.encode()
+    if binary:
+        dtype = np.dtype([('id', '<i4'), ('value', '<f8', (values.shape[1],))])
+        records = np.zeros(len(ids), dtype=dtype)
+        records['id'], records['value'] = ids, values
+        body = records.tobytes() + b'\n'
+    else:
+        body = ''.join(f'{i} ' + ' '.join(repr(float(v)) for v in row) + '\n' for i, row in zip(ids, values)).encode()
+    return header + body + f'$End{section}\n'.encode()
+
+def write_msh(path, binary, element_ids=None):
+    # Two tetrahedra and a triangle on 5 nodes, with a scalar and a vector element field and a node field
+    nodes = np.arange(15, dtype=float).reshape(5, 3)
+    out = b'$MeshFormat\n2.2 %d 8\n' % binary
+    out += np.array([1], dtype='<i4').tobytes() + b'\n' if binary else b''
+    out += b'$EndMeshFormat\n$Nodes\n5\n'
+    if binary:
+        records = np.zeros(5, dtype=[('id', '<i4'), ('xyz', '<f8', (3,))])
+        records['id'], records['xyz'] = np.arange(1, 6), nodes
+        out += records.tobytes() + b'\n'
+    else:
+        out += ''.join(f'{i + 1} {x} {y} {z}\n' for i, (x, y, z) in enumerate(nodes)).encode()
+    out += b'$EndNodes\n$Elements\n3\n'
+    if binary:
+        out += np.array([4, 2, 2, 1, 2, 2, 1, 2, 3, 4, 2, 2, 2, 2, 3, 4, 5], dtype='<i4').tobytes()
+        out += np.array([2, 1, 2, 3, 1002, 1002, 1, 2, 3], dtype='<i4').tobytes() + b'\n'
+    else:
+        out += b'1 4 2 2 1 1 2 3 4\n2 4 2 2 1 2 3 4 5\n3 2 2 1002 1002 1 2 3\n'
+    out += b'$EndElements\n'
+    ids = np.arange(1, 4) if element_ids is None else np.asarray(element_ids)
+    out += data_block('ElementData', 'TImax', ids, np.array([0.1, 0.2, 0.3]), binary)
+    out += data_block('ElementData', 'E', ids, np.arange(9.0), binary)
+    out += data_block('NodeData', 'v', np.arange(1, 6), np.arange(5.0) * 2, binary)
+    with open(path, 'wb') as f:
+        f.write(out)
+
+@pytest.mark.parametrize('binary', [True, False])
+def test_reads_fields_without_parsing_geometry(tmp_path, binary):
+    path = str(tmp_path / 'mesh.msh')
+    write_msh(path, binary)
+
+    with msh_reader.MshFile(path) as msh:
+        assert (msh.binary, msh.n_nodes, msh.n_elements) == (binary, 5, 3)
+        assert msh.fields == {'TImax': ('ElementData', 1, 3), 'E': ('ElementData', 3, 3), 'v': ('NodeData', 1, 5)}
+        assert np.allclose(msh.element_data('TImax'), [0.1, 0.2, 0.3])
+        assert np.allclose(msh.element_data('E', [2, 0]), [[6, 7, 8], [0, 1, 2]])
+        assert np.allclose(msh.node_data('v'), [0, 2, 4, 6, 8])
+        with pytest.raises(KeyError):
+            msh.element_data('v')
+        if binary:
+            # Binary blocks are views into the memory-mapped file
+            assert not msh.element_data('TImax').flags.owndata
+    assert msh_reader.list_fields(path) == {'ElementData': ['TImax', 'E'], 'NodeData': ['v']}
+
+def test_element_selection_follows_ids(tmp_path):
+    path = str(tmp_path / 'mesh.msh')
+    write_msh(path, True, element_ids=[3, 1, 2])
+    with msh_reader.MshFile(path) as msh:
+        assert np.allclose(msh.element_data('TImax', [0, 2]), [0.2, 0.1])
+
+@pytest.mark.parametrize('binary', [True, False])
+def test_geometry_key_ignores_fields(tmp_path, binary):
+    paths = [str(tmp_path / 'a.msh'), str(tmp_path / 'b.msh')]
+    write_msh(paths[0], binary)
+    write_msh(paths[1], binary, element_ids=[3, 1, 2])
+    keys = []
+    for path in paths:
+        with msh_reader.MshFile(path) as msh:
+            keys.append(msh.geometry_key())
+    assert keys[0] == keys[1]
+
+    # Same counts, other node coordinates
+    with open(paths[1], 'rb') as f:
+        data = f.read()
+    with open(paths[1], 'wb') as f:
+        first_node = np.array([1], dtype='<i4').tobytes()
+        f.write(data.replace(b'$Nodes\n5\n1 0.0', b'$Nodes\n5\n1 9.0') if not binary else
+                data.replace(first_node + np.zeros(1).tobytes(), first_node + np.array([9.0]).tobytes()))
+    with msh_reader.MshFile(paths[1]) as msh:
+        assert (msh.n_nodes, msh.n_elements) == (5, 3) and msh.geometry_key() != keys[0]
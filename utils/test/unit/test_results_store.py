@@ -0,0 +1,55 @@
+import csv
+import numpy as np
+import results_store
+import roi_scoring
+
+def read_csv(path):
+    with open(path, newline='') as f:
+        return list(csv.reader(f))
+
+def test_parse_mesh_name():
+    quadruple = ('E001', 'E002', 'E003', 'E004')
+    assert results_store.parse_mesh_name('TI_field_E001_E002_and_E003_E004.msh') == quadruple
+    assert results_store.parse_mesh_name('/opt/TI_field_E001_E002_and_E003_E004.msh') == quadruple
+    assert results_store.parse_mesh_name('E001_E002 <> E003_E004') == quadruple
+    assert results_store.parse_mesh_name('TI.msh') is None
+    assert results_store.format_mesh_name(quadruple) == 'E001_E002 <> E003_E004'
+
+def test_upserts_and_csv_export(tmp_path):
+    a, b, c = ('E001', 'E002', 'E003', 'E004'), ('E005', 'E006', 'E007', 'E008'), ('E009', 'E010', 'E011', 'E012')
+    with results_store.open_store(str(tmp_path)) as store:
+        assert store.upsert([(a, {'TImax': 0.5}), (b, {'TImax': ''})]) == 2
+        # Metrics of a later stage only add rows; values of existing metrics are updated in place
+        store.upsert([(a, {'PercentileValue_95': 0.1, 'XYZ_Max': '[1 2 3]'}), (c, {'PercentileValue_95': 0.3})])
+        store.upsert([(a, {'TImax': 0.7})])
+        assert len(store) == 3
+        assert store.metric_names() == ['PercentileValue_95', 'TImax', 'XYZ_Max']
+
+        path = str(tmp_path / 'output.csv')
+        assert store.export_csv(path, ['TImax', 'PercentileValue_95', 'XYZ_Max'], require='TImax') == 2
+        assert read_csv(path) == [['Mesh', 'TImax', 'PercentileValue_95', 'XYZ_Max'],
+                                  ['E001_E002 <> E003_E004', '0.7', '0.1', '[1 2 3]'],
+                                  ['E005_E006 <> E007_E008', '', '', '']]
+
+        store.clear(['TImax'])
+        assert store.metric_names() == ['PercentileValue_95', 'XYZ_Max']
+
+    # The store persists; CSV files written without it can be imported
+    summary = str(tmp_path / 'summary.csv')
+    with open(summary, 'w', newline='') as f:
+        csv.writer(f).writerows([['FileName', 'FieldName', 'PercentileValue_95'],
+                                 ['TI_field_E005_E006_and_E007_E008.msh', 'TImax', '0.25'],
+                                 ['TI.msh', 'TImax', '1']])
+    with results_store.open_store(str(tmp_path)) as store:
+        assert store.import_csv(summary, 'FileName', exclude=('FieldName',)) == 1
+        rows = dict(store.iter_rows(['PercentileValue_95']))
+        assert rows == {a: [0.1], b: [0.25], c: [0.3]}
+
+def test_output_csv_replaces_only_its_columns(tmp_path):
+    a, old = ('E001', 'E002', 'E003', 'E004'), ('E005', 'E006', 'E007', 'E008')
+    with results_store.open_store(str(tmp_path)) as store:
+        # An earlier run: ROI values of another montage, and metrics of another stage
+        store.upsert([(old, {'TImax': 0.9}), (a, {'TImax': 0.1, 'PercentileValue_95': 0.2})])
+        results = [(0, (('E001', 'E002'), ('E003', 'E004')), np.array([0.5]))]
+        assert roi_scoring.write_output_csv(str(tmp_path / 'output.csv'), ['roi'], results, store=store) == 1
+        assert dict(store.iter_rows(['TImax', 'PercentileValue_95'], require='TImax')) == {a: [0.5, 0.2]}
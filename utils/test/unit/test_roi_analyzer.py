@@ -0,0 +1,38 @@
+import os
+import csv
+import json
+import importlib.util
+import pytest
+
+@pytest.fixture
+def roi_analyzer():
+    # roi-analyzer.py is not an importable module name
+    optimizer_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'optimizer'))
+    spec = importlib.util.spec_from_file_location('roi_analyzer', os.path.join(optimizer_dir, 'roi-analyzer.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_resume_keeps_unchanged_meshes_and_drops_cut_off_lines(roi_analyzer, tmp_path):
+    progress_path = str(tmp_path / roi_analyzer.PROGRESS_FILENAME)
+    csv_path = str(tmp_path / 'output.csv')
+    a, b, c = 'TI_field_E001_E002_and_E003_E004.msh', 'TI_field_E005_E006_and_E007_E008.msh', 'other.msh'
+    with open(progress_path, 'w') as f:
+        f.write(roi_analyzer.progress_line(a, 1, {'TImax': 0.5}))
+        f.write(roi_analyzer.progress_line(b, 2, {'TImax': None}))
+        f.write(roi_analyzer.progress_line(c, 3, {'TImax': 0.1}))
+        f.write('{"mesh": "cut')
+
+    # b was rewritten since it was analyzed
+    done = roi_analyzer.resume_progress(progress_path, csv_path, ['Mesh', 'TImax'], {a: 1, b: 5, c: 3}, False)
+
+    assert done == {a, c}
+    with open(csv_path) as f:
+        assert list(csv.reader(f)) == [['Mesh', 'TImax'], ['E001_E002 <> E003_E004', '0.5'], ['other.msh', '0.1']]
+    json_path = str(tmp_path / 'mesh_data.json')
+    roi_analyzer.write_mesh_data(progress_path, json_path)
+    with open(json_path) as f:
+        assert json.load(f) == {a: {'TImax': 0.5}, c: {'TImax': 0.1}}
+
+    assert roi_analyzer.resume_progress(progress_path, csv_path, ['Mesh', 'TImax'], {a: 1, c: 3}, True) == set()
+    assert list(roi_analyzer.read_progress(progress_path)) == []
@@ -0,0 +1,28 @@
+import warnings
+import numpy as np
+import pytest
+import roi_scoring
+
+def test_score_combinations_without_rois_inside_the_mesh():
+    leadfield = np.ones((2, 4, 3))
+    idx_lf = {'E001': None, 'E002': 0, 'E003': 1}
+    combinations = [(('E002', 'E003'), ('E003', 'E001'))] * 3
+    inside = np.array([False, False])
+
+    with pytest.warns(UserWarning, match='No ROI') as record:
+        results = list(roi_scoring.score_combinations(combinations, leadfield, idx_lf, 0.001, np.array([], dtype=int),
+                                                      np.zeros((2, 0)), inside, block_size=1,
+                                                      ratios=np.array([0.3, 0.5, 0.7])))
+    assert len(record) == 1
+    for i, (index, combination, values, ratio) in enumerate(results):
+        assert index == i and combination == combinations[i]
+        assert np.isnan(values).all() and values.shape == (2,)
+        assert np.isnan(ratio)
+
+    # Without ratios the blocks only hold the NaN values, and no RuntimeWarning of empty means is raised
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        warnings.simplefilter('ignore', UserWarning)
+        results = list(roi_scoring.score_combinations(combinations, leadfield, idx_lf, 0.001, np.array([], dtype=int),
+                                                      np.zeros((2, 0)), inside))
+    assert all(len(result) == 3 and np.isnan(result[2]).all() for result in results)
@@ -0,0 +1,32 @@
+import os
+import solver_pool
+
+
+def test_plan_workers_caps_by_cpus_memory_and_jobs():
+    # 12 montages on 32 CPUs and 64 GB: memory allows 8 solves of 8 GB
+    assert solver_pool.plan_workers(12, 0, cpus=32, memory_gb=64) == (8, 4)
+    # Explicit solver threads cap the workers to the CPUs
+    assert solver_pool.plan_workers(12, 0, solver_threads=8, cpus=32, memory_gb=1000) == (4, 8)
+    # Never more workers than montages, never fewer than one
+    assert solver_pool.plan_workers(3, 16, cpus=32, memory_gb=1000) == (3, 10)
+    assert solver_pool.plan_workers(12, 16, cpus=32, memory_gb=2) == (1, 32)
+    # Serial by default
+    assert solver_pool.plan_workers(12, cpus=32, memory_gb=1000) == (1, 32)
+
+
+def test_plan_from_environment(monkeypatch):
+    monkeypatch.setenv('TI_MAX_WORKERS', '4')
+    monkeypatch.setenv('TI_SOLVER_THREADS', '2')
+    monkeypatch.setenv('TI_SOLVE_MEMORY_GB', '0')
+    monkeypatch.setattr(solver_pool.os, 'cpu_count', lambda: 32)
+    assert solver_pool.plan_from_environment(12) == (4, 2)
+
+
+def test_imap_jobs_serial_runs_in_the_calling_process(monkeypatch):
+    monkeypatch.setenv('OMP_NUM_THREADS', '7')
+    calls = []
+    results = list(solver_pool.imap_jobs(divmod, [(7, 2), (9, 4)], 1, 3, initializer=calls.append, initargs=('x',)))
+    assert results == [(3, 1), (2, 1)]
+    # The caller has configured itself: no initializer call, and its environment is unchanged
+    assert calls == []
+    assert os.environ['OMP_NUM_THREADS'] == '7'
@@ -0,0 +1,137 @@
+import gc
+import weakref
+import numpy as np
+import ti_engine
+
+def reference_maxTI(E1_org, E2_org):
+    # Per-element reference implementation (same as TI_utils.get_maxTI)
+    E1 = E1_org.copy()
+    E2 = E2_org.copy()
+    idx = np.linalg.norm(E2, axis=1) > np.linalg.norm(E1, axis=1)
+    E1[idx] = E2[idx]
+    E2[idx] = E1_org[idx]
+    idx = np.sum(E1 * E2, axis=1) < 0
+    E2[idx] = -E2[idx]
+    normE1 = np.linalg.norm(E1, axis=1)
+    normE2 = np.linalg.norm(E2, axis=1)
+    cosalpha = np.sum(E1 * E2, axis=1) / (normE1 * normE2)
+    TImax = 2 * np.linalg.norm(np.cross(E2, E1 - E2), axis=1) / np.linalg.norm(E1 - E2, axis=1)
+    idx = normE2 <= normE1 * cosalpha
+    TImax[idx] = 2 * normE2[idx]
+    return TImax
+
+def test_get_maxTI_batch_matches_reference():
+    rng = np.random.default_rng(0)
+    E1 = rng.normal(size=(1000, 3))
+    E2 = rng.normal(size=(1000, 3)) * rng.uniform(0.1, 3, size=(1000, 1))
+
+    assert np.allclose(ti_engine.get_maxTI_batch(E1, E2), reference_maxTI(E1, E2))
+
+def test_get_maxTI_batch_zero_and_same_fields():
+    zeros = np.zeros((1, 3))
+    same = np.array([[1.0, 2.0, 3.0]])
+
+    assert np.all(ti_engine.get_maxTI_batch(zeros, zeros) == 0)
+    assert np.allclose(ti_engine.get_maxTI_batch(same, same), 2 * np.linalg.norm(same, axis=1))
+
+def test_iter_TImax_matches_per_combination_loop():
+    rng = np.random.default_rng(1)
+    leadfield = rng.normal(size=(4, 50, 3))
+    idx_lf = {'E001': None, 'E002': 0, 'E003': 1, 'E004': 2, 'E005': 3}
+    combinations = [(('E002', 'E003'), ('E004', 'E005')),
+                    (('E001', 'E003'), ('E004', 'E002')),
+                    (('E002', 'E003'), ('E005', 'E001'))]
+    intensity = 0.002
+
+    def field(e_plus, e_minus):
+        lf = lambda e: 0 if idx_lf[e] is None else leadfield[idx_lf[e]]
+        return intensity * (lf(e_plus) - lf(e_minus))
+
+    results = list(ti_engine.iter_TImax(combinations, leadfield, idx_lf, intensity, block_size=2))
+
+    assert [i for i, _, _ in results] == [0, 1, 2]
+    for i, (pair1, pair2), TImax in results:
+        assert (pair1, pair2) == combinations[i]
+        assert np.allclose(TImax, reference_maxTI(field(*pair1), field(*pair2)))
+
+def test_pair_field_cache_reuses_and_evicts():
+    rng = np.random.default_rng(2)
+    leadfield = rng.normal(size=(4, 50, 3))
+    idx_lf = {'E001': None, 'E002': 0, 'E003': 1, 'E004': 2, 'E005': 3}
+    combinations = [(('E002', 'E003'), ('E004', e)) for e in ('E005', 'E001')] * 3
+    field_bytes = 50 * 3 * 8
+
+    cache = ti_engine.PairFieldCache(leadfield, idx_lf, max_bytes=3 * field_bytes)
+    cached = list(ti_engine.iter_TImax(combinations, leadfield, idx_lf, 0.002, block_size=1, cache=cache))
+    uncached = list(ti_engine.iter_TImax(combinations, leadfield, idx_lf, 0.002, block_size=1))
+
+    for (_, _, TImax_cached), (_, _, TImax) in zip(cached, uncached):
+        assert np.array_equal(TImax_cached, TImax)
+    assert cache.misses == 3
+    assert cache.hits == 9
+    assert len(cache) == 3
+
+    cache.resize(field_bytes)
+    assert cache.nbytes <= field_bytes
+    assert cache.evictions == 2
+
+def test_get_pair_cache_is_shared_per_leadfield():
+    leadfield = np.ones((2, 5, 3))
+    idx_lf = {'E001': None, 'E002': 0, 'E003': 1}
+
+    cache = ti_engine.get_pair_cache(leadfield, idx_lf)
+    assert ti_engine.get_pair_cache(leadfield, idx_lf) is cache
+    assert ti_engine.get_pair_cache(np.ones((2, 5, 3)), idx_lf) is not cache
+
+def test_get_pair_cache_is_dropped_with_the_leadfield():
+    leadfield = np.ones((2, 5, 3))
+    idx_lf = {'E001': None, 'E002': 0, 'E003': 1}
+    cache = ti_engine.get_pair_cache(leadfield, idx_lf)
+    cache.get('E002', 'E003', 0.001)
+    released = weakref.ref(leadfield)
+    key = ('id', id(leadfield))
+
+    # The cache does not keep the leadfield alive, and its session entry goes away with it
+    del leadfield
+    gc.collect()
+    assert released() is None
+    assert key not in ti_engine._session_caches
+
+def test_get_maxTI_ratios_matches_scaled_fields():
+    rng = np.random.default_rng(6)
+    E1 = rng.normal(size=(4, 100, 3))
+    E2 = rng.normal(size=(4, 100, 3))
+    ratios = np.array([0.2, 0.5, 0.7])
+
+    TImax = ti_engine.get_maxTI_ratios(E1, E2, ratios)
+
+    assert TImax.shape == (3, 4, 100)
+    for r, TImax_r in zip(ratios, TImax):
+        assert np.allclose(TImax_r, reference_maxTI((2 * r * E1).reshape(-1, 3),
+                                                    (2 * (1 - r) * E2).reshape(-1, 3)).reshape(4, 100))
+
+def test_chunked_kernels_match_batch_and_mTI_vectors():
+    rng = np.random.default_rng(3)
+    E1 = rng.normal(size=(1001, 3))
+    E2 = rng.normal(size=(1001, 3)) * rng.uniform(0.1, 3, size=(1001, 1))
+    E2[:10] = 0.5 * E1[:10]
+
+    TImax = ti_engine.get_maxTI_chunked(E1, E2, chunk_size=64)
+    assert np.array_equal(TImax, ti_engine.get_maxTI_batch(E1, E2))
+    assert np.allclose(ti_engine.get_maxTI_chunked(E1, E2, dtype=np.float32), TImax, rtol=1e-4)
+
+    # The norm of the TI vectors is TI_max
+    vectors = ti_engine.get_TI_vectors_chunked(E1, E2, chunk_size=64)
+    assert np.allclose(np.linalg.norm(vectors, axis=1), reference_maxTI(E1, E2))
+    assert ti_engine.get_TI_vectors_chunked(E1, E2, dtype=np.float32).dtype == np.float32
+
+def test_get_TImax_block_chunked_path(monkeypatch):
+    rng = np.random.default_rng(4)
+    leadfield = rng.normal(size=(4, 50, 3))
+    idx_lf = {'E0': 0, 'E1': 1, 'E2': 2, 'E3': 3, 'E4': None}
+    block = [(('E0', 'E1'), ('E2', 'E3')), (('E0', 'E4'), ('E2', 'E1'))]
+    expected = ti_engine.get_TImax_block(block, leadfield, idx_lf, 0.001)
+    monkeypatch.setattr(ti_engine, 'MIN_CHUNKED_ELEMENTS', 1)
+    # Slices of 16 elements across the block, the last one partial
+    monkeypatch.setattr(ti_engine, 'DEFAULT_CHUNK_SIZE', 32)
+    assert np.array_equal(ti_engine.get_TImax_block(block, leadfield, idx_lf, 0.001), expected)
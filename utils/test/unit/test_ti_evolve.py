@@ -0,0 +1,34 @@
+import numpy as np
+import ti_evolve
+
+def make_search(seed):
+    rng = np.random.default_rng(5)
+    electrodes = [f'E{i:03}' for i in range(1, 11)]
+    idx_lf = {e: i - 1 for i, e in enumerate(electrodes)}
+    idx_lf['E001'] = None
+    leadfield = rng.normal(size=(9, 6, 3))
+    fitness = ti_evolve.MontageFitness(leadfield, idx_lf, electrodes, 0.002, np.full(4, 0.25), 0.5)
+    candidates = [np.arange(10)] * 4
+    return ti_evolve.EvolutionarySearch(fitness, candidates, population_size=20, seed=seed, electrodes=electrodes)
+
+def test_evolutionary_search_finds_exhaustive_optimum():
+    search = make_search(seed=0)
+    best_fitness = search.run(max_evaluations=2000)[0][0]
+
+    montages = np.array([m for m in np.ndindex(10, 10, 10, 10) if m[0] != m[1] and m[2] != m[3]])
+    assert np.isclose(best_fitness, search.fitness.evaluate(montages)[0].max())
+
+def test_evolutionary_search_is_reproducible_and_resumable(tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.npz')
+    full = make_search(seed=1)
+    full.run(max_evaluations=300)
+
+    first = make_search(seed=1)
+    first.run(max_evaluations=150, checkpoint=checkpoint)
+    resumed = make_search(seed=1)
+    resumed.load(checkpoint)
+    resumed.run(max_evaluations=300)
+
+    assert resumed.generation == full.generation
+    assert np.array_equal(resumed.population, full.population)
+    assert resumed.best(5) and [b[0] for b in resumed.best(5)] == [b[0] for b in full.best(5)]
@@ -0,0 +1,15 @@
+import os
+import pytest
+import ti_parallel
+
+def test_thread_limit_restores_the_environment(monkeypatch):
+    monkeypatch.setenv('OMP_NUM_THREADS', '7')
+    monkeypatch.delenv('MKL_NUM_THREADS', raising=False)
+
+    with pytest.raises(RuntimeError):
+        with ti_parallel.thread_limit(1):
+            assert all(os.environ[var] == '1' for var in ti_parallel.BLAS_THREAD_VARIABLES)
+            raise RuntimeError
+    # Set variables get their value back, unset ones are removed again
+    assert os.environ['OMP_NUM_THREADS'] == '7'
+    assert 'MKL_NUM_THREADS' not in os.environ
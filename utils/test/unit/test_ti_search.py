@@ -0,0 +1,41 @@
+import numpy as np
+import ti_search
+
+def canonical(combination):
+    return tuple(sorted(tuple(sorted(pair)) for pair in combination))
+
+def test_search_topk_matches_exhaustive_search():
+    import ti_engine
+    rng = np.random.default_rng(3)
+    electrodes = [f'E{i:03}' for i in range(1, 13)]
+    idx_lf = {e: i - 1 for i, e in enumerate(electrodes)}
+    idx_lf['E001'] = None
+    leadfield = rng.normal(size=(11, 6, 3)) * rng.uniform(0.1, 2, size=(11, 1, 1))
+    roi_weight = rng.uniform(0, 1, size=6)
+    roi_weight /= roi_weight.sum()
+
+    pairs = ti_search.candidate_pairs(electrodes, electrodes, collapse_polarity=True)
+    top, stats = ti_search.search_topk(pairs, pairs, leadfield, idx_lf, 0.002, roi_weight, 5,
+                                       block_size=7, key=canonical)
+
+    values = {}
+    for p1 in pairs:
+        for p2 in pairs:
+            fields = ti_engine.get_pair_fields([p1 + (0.002,), p2 + (0.002,)], leadfield, idx_lf)
+            values[canonical((p1, p2))] = ti_engine.get_maxTI_batch(fields[0], fields[1]) @ roi_weight
+    expected = sorted(values.values(), reverse=True)[:5]
+
+    assert np.allclose([value for value, _ in top], expected)
+    assert stats['evaluated'] + stats['pruned'] + stats['skipped'] == stats['candidates']
+    assert stats['pruned'] > 0
+
+def test_pair_bound_holds_for_every_combination():
+    import ti_engine
+    rng = np.random.default_rng(4)
+    fields = rng.normal(size=(20, 8, 3))
+    roi_weight = rng.uniform(0, 1, size=8)
+    bounds = ti_search.get_pair_bounds(fields, roi_weight)
+
+    for i in range(20):
+        values = ti_engine.get_maxTI_batch(np.broadcast_to(fields[i], fields.shape), fields) @ roi_weight
+        assert np.all(values <= np.minimum(bounds[i], bounds) + 1e-12)
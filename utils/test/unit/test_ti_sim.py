@@ -0,0 +1,95 @@
+import csv
+import h5py
+import numpy as np
+import pytest
+import leadfield_access
+import ti_engine
+import ti_sim
+
+def test_generate_combinations_removes_equivalent_montages():
+    electrodes = ['E001', 'E002', 'E003']
+
+    combinations = ti_sim.generate_combinations(electrodes, electrodes, electrodes, electrodes, deduplicate=True)
+    keys = [ti_sim.canonical_combination(c) for c in combinations]
+
+    # Every montage appears once, and no pair uses the same electrode twice
+    assert len(keys) == len(set(keys))
+    assert all(p[0] != p[1] for c in combinations for p in c)
+    # 3 distinct pairs -> 3 montages with two different pairs + 3 with the same pair twice
+    assert len(combinations) == 6
+
+def test_generate_combinations_keeps_all_without_deduplication():
+    combinations = ti_sim.generate_combinations(['E001', 'E002'], ['E003'], ['E003'], ['E001', 'E002'])
+
+    assert len(combinations) == 4
+    # By default every combination is generated, as before deduplication existed
+    electrodes = ['E001', 'E002', 'E003']
+    assert len(ti_sim.generate_combinations(electrodes, electrodes, electrodes, electrodes)) == 81
+
+def test_generate_combinations_constraints():
+    positions = {'E001': np.array([0.0, 0, 0]), 'E002': np.array([10.0, 0, 0]),
+                 'E003': np.array([50.0, 0, 0]), 'E004': np.array([90.0, 0, 0])}
+
+    no_shared = ti_sim.generate_combinations(['E001'], ['E002', 'E003'], ['E003'], ['E004'],
+                                             allow_shared=False)
+    far_apart = ti_sim.generate_combinations(['E001'], ['E002', 'E003'], ['E003', 'E004'], ['E004'],
+                                             deduplicate=True, min_distance=20, positions=positions)
+
+    assert no_shared == [(('E001', 'E002'), ('E003', 'E004'))]
+    assert far_apart == [(('E001', 'E003'), ('E003', 'E004'))]
+
+def test_process_leadfield_reuses_pair_fields_of_the_same_file(tmp_path, monkeypatch):
+    leadfield_dir = tmp_path / 'Subjects' / 'leadfield_vol_001'
+    leadfield_dir.mkdir(parents=True)
+    with h5py.File(leadfield_dir / '001_leadfield_EGI_template.hdf5', 'w') as f:
+        dset = f.create_dataset('mesh_leadfield/values', data=np.random.default_rng(3).normal(size=(3, 20, 3)))
+        dset.attrs['electrode_names'] = np.array([b'E001', b'E002', b'E003', b'E004'])
+        dset.attrs['reference_electrode'] = b'E001'
+
+    # Every run reopens the leadfield file; mesh writing is replaced by the TImax computation only
+    def load_leadfield(leadfield_hdf, cache_rows=None):
+        leadfield = leadfield_access.LazyLeadfield(leadfield_hdf, cache_rows=cache_rows)
+        return leadfield, None, leadfield.idx_lf
+
+    def write_TI_meshes(combinations, start, leadfield, mesh, idx_lf, intensity, output_dir, block_size, cache=None):
+        for i, combination, _ in ti_engine.iter_TImax(combinations, leadfield, idx_lf, intensity, block_size, cache):
+            yield start + i, combination, 'TI.msh', None
+
+    monkeypatch.delenv('EEG_CAP', raising=False)
+    monkeypatch.setattr(leadfield_access, 'load_leadfield', load_leadfield)
+    monkeypatch.setattr(ti_sim, 'write_TI_meshes', write_TI_meshes)
+    ti_engine.clear_session_caches()
+
+    pairs = (['E001', 'E002'], ['E003', 'E004'], ['E002', 'E003'], ['E004', 'E001'])
+    ti_sim.process_leadfield('vol', *pairs, 0.001, str(tmp_path), '001')
+    cache, = ti_engine._session_caches.values()
+    misses, hits = cache.misses, cache.hits
+    ti_sim.process_leadfield('vol', *pairs, 0.001, str(tmp_path), '001')
+
+    assert list(ti_engine._session_caches.values()) == [cache]
+    assert cache.misses == misses
+    assert cache.hits > hits
+    ti_engine.clear_session_caches()
+
+def test_evolve_rois_fills_in_default_options(tmp_path, monkeypatch):
+    leadfield = np.random.default_rng(4).normal(size=(4, 6, 3))
+    idx_lf = {'E001': None, 'E002': 0, 'E003': 1, 'E004': 2, 'E005': 3}
+    monkeypatch.setattr(ti_sim, 'load_rois', lambda mesh, project_dir, subject_name:
+                        (['roi'], np.arange(4), np.full((1, 4), 0.25), np.array([True])))
+    electrodes = list(idx_lf)
+
+    # Only the options that differ from DEFAULT_EVOLVE_OPTIONS are given
+    ti_sim.evolve_rois(electrodes, electrodes, electrodes, electrodes, leadfield, None, idx_lf, 0.001,
+                       str(tmp_path), '001', str(tmp_path), 3, {'seed': 1, 'population': 6, 'max_evaluations': 30})
+
+    with open(tmp_path / 'output.csv', newline='') as f:
+        assert len(list(csv.reader(f))) == 4
+    assert (tmp_path / 'evolve_checkpoint.npz').exists()
+
+def test_generate_combinations_requires_positions_of_all_electrodes(capsys):
+    positions = {'E001': np.array([0.0, 0, 0]), 'E002': np.array([10.0, 0, 0])}
+
+    with pytest.raises(SystemExit):
+        ti_sim.generate_combinations(['E001'], ['E002'], ['E003'], ['E004', 'E001'], min_distance=5,
+                                     positions=positions)
+    assert 'E003, E004' in capsys.readouterr().out
@@ -0,0 +1,30 @@
+import csv
+import os
+import time
+import results_store
+import update_output_csv
+
+def write_summary(path, value, mtime):
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows([['FileName', 'FieldName'] + update_output_csv.columns_to_extract,
+                                 ['TI_field_E001_E002_and_E003_E004.msh', 'TImax', value, value, value, '[0 0 0]']])
+    os.utime(path, (mtime, mtime))
+
+def test_newer_summary_csv_replaces_stored_metrics(tmp_path):
+    opt_dir = tmp_path / 'Simulations' / 'opt_001'
+    (opt_dir / 'results').mkdir(parents=True)
+    summary = str(opt_dir / 'results' / 'summary.csv')
+    montage = ('E001', 'E002', 'E003', 'E004')
+    with results_store.open_store(str(opt_dir)) as store:
+        store.upsert([(montage, dict({name: 0.1 for name in update_output_csv.columns_to_extract}, TImax=0.5))])
+
+    def exported_percentile():
+        update_output_csv.update_output_csv(str(tmp_path), '001')
+        with open(opt_dir / 'output.csv', newline='') as f:
+            return next(csv.DictReader(f))['PercentileValue_95']
+
+    # A summary.csv older than the stored metrics is not imported; one written after them is
+    write_summary(summary, '0.2', time.time() - 3600)
+    assert exported_percentile() == '0.1'
+    write_summary(summary, '0.3', time.time() + 3600)
+    assert exported_percentile() == '0.3'